@@ -0,0 +1,656 @@
+"""Benchmarks the pipeline against synthetic workloads and a scripted, offline LLM."""
+
+import contextlib
+import threading
+
+from project_lib import (
+    CallableBackend,
+    CalendarDataset,
+    ChatResult,
+    current_span,
+    estimate_tokens,
+    get_event_store,
+    get_events,
+    get_weather,
+    isolated_llm_environment,
+    trip_dates,
+    use_calendar,
+    write_jsonl,
+)
+
+
+_SYNTHETIC_CITY_NAMES = ["AgentsVille", "Promptford", "Tokenham", "Vectorburg", "Latentia"]
+_SYNTHETIC_CATEGORIES = [
+    "Music", "Culinary", "Fitness", "Science", "Crafts", "Theater", "Literature",
+    "Photography", "Comedy", "Family", "Technology", "History",
+]
+_SYNTHETIC_LOCATIONS = [
+    "Central Park", "Public Library", "Old Town Square", "City Museum", "Community Center",
+    "Botanical Gardens", "Grand Theater", "Beach Boardwalk", "Convention Center",
+]
+_SYNTHETIC_CONDITIONS = ["clear", "sunny", "partly cloudy", "rainy", "thunderstorm"]
+
+
+def synthetic_city_name(idx: int) -> str:
+    """Returns the name of the idx-th synthetic city; the first one is AgentsVille."""
+    if idx < len(_SYNTHETIC_CITY_NAMES):
+        return _SYNTHETIC_CITY_NAMES[idx]
+    return f"City {idx}"
+
+
+def generate_synthetic_calendar(
+    cities: int = 1,
+    days: int = 6,
+    events_per_day: int = 10,
+    start_date: str = "2025-06-10",
+    seed: int = 0,
+) -> tuple[list[dict], list[dict]]:
+    """Generates a reproducible calendar of events and weather forecasts.
+
+    Args:
+        cities: The number of cities, named by `synthetic_city_name`.
+        days: The number of days, starting at `start_date`.
+        events_per_day: The number of events per city and day.
+        start_date: The first day, as YYYY-MM-DD.
+        seed: The random seed.
+
+    Returns:
+        An (events, forecasts) tuple, shaped like EVENT_CALENDAR and WEATHER_FORECAST.
+
+    Examples:
+        >>> events, forecasts = generate_synthetic_calendar(cities=2, days=3, events_per_day=4)
+        >>> len(events), len(forecasts), events[0]["city"], forecasts[-1]["date"]
+        (24, 6, 'AgentsVille', '2025-06-12')
+    """
+    import datetime
+    import random
+
+    rng = random.Random(seed)
+    first_day = datetime.date.fromisoformat(start_date)
+    events = []
+    forecasts = []
+    for city_idx in range(cities):
+        city = synthetic_city_name(city_idx)
+        for day in range(days):
+            date = (first_day + datetime.timedelta(days=day)).isoformat()
+            condition = rng.choice(_SYNTHETIC_CONDITIONS)
+            forecasts.append(
+                {
+                    "date": date,
+                    "city": city,
+                    "temperature": rng.randint(15, 35),
+                    "temperature_unit": "celsius",
+                    "condition": condition,
+                    "description": f"A {condition} day in {city}.",
+                }
+            )
+            for idx in range(events_per_day):
+                category = rng.choice(_SYNTHETIC_CATEGORIES)
+                location = rng.choice(_SYNTHETIC_LOCATIONS)
+                events.append(
+                    {
+                        "name": f"{city} {category} Event {day * events_per_day + idx + 1}",
+                        "time": f"{date} {rng.randint(8, 21):02d}:{rng.choice(['00', '30'])}",
+                        "location": location,
+                        "category": category,
+                        "description": f"A {category.lower()} event at the {location} in {city}.",
+                        "price": rng.choice(["Free", "Donation-based"] + [str(5 * n) for n in range(1, 11)]),
+                        "city": city,
+                    }
+                )
+    return events, forecasts
+
+
+def write_synthetic_calendar(directory: str, compress: bool = False, **kwargs) -> tuple[str, str]:
+    """Generates a synthetic calendar and writes it as data files.
+
+    Point AGENTSVILLE_EVENTS_PATH and AGENTSVILLE_WEATHER_PATH at the files
+    (or pass them to `CalendarDataset`) to plan against a calendar of any size.
+
+    Args:
+        directory: The directory to write event_calendar.jsonl and
+            weather_forecast.jsonl to.
+        compress: Whether to gzip the files.
+        **kwargs: Arguments of `generate_synthetic_calendar`, e.g. cities, days
+            or events_per_day.
+
+    Returns:
+        The (events path, weather path) tuple.
+
+    Examples:
+        >>> import tempfile
+        >>> events_path, weather_path = write_synthetic_calendar(tempfile.mkdtemp(), cities=3, days=2)
+        >>> len(CalendarDataset(events_path).records()), len(CalendarDataset(weather_path).records())
+        (60, 6)
+    """
+    import os
+
+    events, forecasts = generate_synthetic_calendar(**kwargs)
+    suffix = ".jsonl.gz" if compress else ".jsonl"
+    os.makedirs(directory, exist_ok=True)
+    events_path = os.path.join(directory, "event_calendar" + suffix)
+    weather_path = os.path.join(directory, "weather_forecast" + suffix)
+    write_jsonl(events_path, events)
+    write_jsonl(weather_path, forecasts)
+    return events_path, weather_path
+
+
+class BenchmarkWorkload:
+    """A parameterised, synthetic planning workload.
+
+    Args:
+        name: The name of the workload, used in reports and baselines.
+        travelers: The number of travelers.
+        trip_days: The length of the trip, in days.
+        events_per_day: The number of calendar events per city and day.
+        cities: The number of cities in the calendar. The trip goes to the first one.
+        calendar_days: The number of days in the calendar. Defaults to the trip length.
+        seed: The random seed of the calendar and the travelers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        travelers: int = 2,
+        trip_days: int = 2,
+        events_per_day: int = 10,
+        cities: int = 1,
+        calendar_days: int | None = None,
+        seed: int = 0,
+    ):
+        self.name = name
+        self.travelers = travelers
+        self.trip_days = trip_days
+        self.events_per_day = events_per_day
+        self.cities = cities
+        self.calendar_days = max(calendar_days or trip_days, trip_days)
+        self.seed = seed
+
+    def __repr__(self):
+        return (
+            f"BenchmarkWorkload({self.name!r}, travelers={self.travelers}, "
+            f"trip_days={self.trip_days}, events_per_day={self.events_per_day}, "
+            f"cities={self.cities})"
+        )
+
+    def vacation_info(self) -> dict:
+        """Returns the synthetic vacation info of the workload."""
+        import datetime
+        import random
+
+        rng = random.Random(self.seed)
+        arrival = datetime.date(2025, 6, 10)
+        departure = arrival + datetime.timedelta(days=self.trip_days - 1)
+        restrictions = ["vegetarian", "vegan", "nut allergies", "gluten-free"]
+        return {
+            "travelers": [
+                {
+                    "name": f"Traveler {idx + 1}",
+                    "age": rng.randint(18, 70),
+                    "interests": [c.lower() for c in rng.sample(_SYNTHETIC_CATEGORIES, 2)],
+                    "dietary_restrictions": rng.sample(restrictions, rng.randint(0, 1)),
+                }
+                for idx in range(self.travelers)
+            ],
+            "destination": synthetic_city_name(0),
+            "date_of_arrival": arrival.isoformat(),
+            "date_of_departure": departure.isoformat(),
+            "budget": 100 * self.travelers * self.trip_days,
+        }
+
+    @contextlib.contextmanager
+    def install(self):
+        """Swaps in the workload's synthetic event and weather stores."""
+        events, forecasts = generate_synthetic_calendar(
+            self.cities, self.calendar_days, self.events_per_day, seed=self.seed
+        )
+        with use_calendar(events, forecasts):
+            yield
+
+
+DEFAULT_BENCHMARK_WORKLOADS = [
+    BenchmarkWorkload("small", travelers=2, trip_days=2, events_per_day=8, cities=1),
+    BenchmarkWorkload("medium", travelers=4, trip_days=4, events_per_day=20, cities=3),
+    BenchmarkWorkload("large", travelers=8, trip_days=6, events_per_day=50, cities=10, calendar_days=30),
+]
+
+
+class OfflineLLM:
+    """A scripted, deterministic stand-in for the LLM, for benchmarks.
+
+    It recognizes the caller by the span the call is made in (see `span`):
+    yes/no questions by the span names of `BoolResponseAgent`, whatever the
+    agent, slot filling by "slot_extraction", and the other agents by the
+    "agent" tag of the span, i.e. their class name. It plays their part
+    without any network access: the traveler answers questions,
+    the onboarding agent outputs the vacation info after a few turns (or,
+    when slot filling, every requested field is extracted at once), the
+    itinerary agent fetches the weather and activities of every day (one
+    multi-tool step per day, unless they were prefetched) before submitting a
+    plan built from the event store, the revision agent runs
+    the evals once and submits the plan, and yes/no questions (single or
+    batched) get answers derived from a hash of the question. ReAct steps get
+    a <thought>, an <act>, or both, depending on what the prompt asks for.
+
+    Calls from any other caller raise a ValueError. Use it with
+    `CallableBackend`. Token usage is estimated with `estimate_tokens`.
+    Cached prompt tokens are simulated like a provider's prompt cache: the
+    longest prefix of the prompt already sent in an earlier call, in blocks
+    of 128 tokens, once it reaches 1024 tokens.
+
+    Args:
+        vacation_info: The vacation info the traveler and onboarding agent use.
+        onboarding_turns: The onboarding turns before the vacation info is output.
+        latency: Simulated seconds per call.
+        seconds_per_token: Simulated seconds per completion token.
+    """
+
+    def __init__(self, vacation_info: dict, onboarding_turns: int = 2, latency: float = 0.0, seconds_per_token: float = 0.0):
+        self.vacation_info = vacation_info
+        self.onboarding_turns = onboarding_turns
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.itinerary = None
+        self.calls = 0
+        self.act_steps = 0
+        self.tool_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self._prefix_blocks = set()
+        self._lock = threading.Lock()
+
+    # The scripted part of each caller, by span name and then by agent name
+    SPAN_HANDLERS = {
+        "bool_query": "_answer_question",
+        "bool_vote_round": "_answer_question",
+        "bool_batch": "_answer_questions",
+        "slot_extraction": "_extract_slots",
+    }
+    AGENT_HANDLERS = {
+        "Traveler": "_traveler_reply",
+        "OnboardingAgent": "_onboarding_reply",
+        "ItineraryAgent": "_planning_step",
+        "ItineraryRevisionAgent": "_revision_step",
+    }
+
+    # Prompt cache granularity, in characters (about 4 per token)
+    CACHE_BLOCK_CHARS = 128 * 4
+    CACHE_MIN_CHARS = 1024 * 4
+
+    def counters(self) -> dict:
+        with self._lock:
+            return {
+                "llm_calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "cached_tokens": self.cached_tokens,
+                "react_steps": self.act_steps,
+                "tool_calls": self.tool_calls,
+            }
+
+    def __call__(self, messages, model, **kwargs):
+        import time
+
+        text = self.respond(messages)
+        usage = {
+            "prompt_tokens": estimate_tokens(messages),
+            "completion_tokens": estimate_tokens(text),
+        }
+        with self._lock:
+            cached_chars = self._cache_prompt(messages)
+            usage["prompt_tokens_details"] = {
+                "cached_tokens": min(usage["prompt_tokens"], cached_chars // 4)
+            }
+            self.calls += 1
+            self.prompt_tokens += usage["prompt_tokens"]
+            self.completion_tokens += usage["completion_tokens"]
+            self.cached_tokens += usage["prompt_tokens_details"]["cached_tokens"]
+        delay = self.latency + self.seconds_per_token * usage["completion_tokens"]
+        if delay:
+            time.sleep(delay)
+        return ChatResult([text], usage=usage, model=model)
+
+    def _cache_prompt(self, messages) -> int:
+        """Returns how many leading characters of the prompt were cached, and caches it."""
+        import hashlib
+
+        prompt = "".join(f"<{m['role']}>{m['content']}" for m in messages)
+        digest = hashlib.sha256()
+        cached = 0
+        hit = True
+        for end in range(self.CACHE_BLOCK_CHARS, len(prompt) + 1, self.CACHE_BLOCK_CHARS):
+            digest.update(prompt[end - self.CACHE_BLOCK_CHARS : end].encode("utf-8"))
+            block = digest.digest()
+            if hit and block in self._prefix_blocks:
+                cached = end
+            else:
+                hit = False
+                self._prefix_blocks.add(block)
+        return cached if cached >= self.CACHE_MIN_CHARS else 0
+
+    def respond(self, messages) -> str:
+        """Plays the part of the agent making the call.
+
+        Raises:
+            ValueError: If the call is not made inside the span of a scripted caller.
+        """
+        current = current_span()
+        if current is None:
+            raise ValueError("OfflineLLM only answers calls made inside an agent span")
+        # The innermost span is the "llm_call" of the request itself
+        node = current
+        while node is not None and node.name not in self.SPAN_HANDLERS:
+            node = node.parent
+        if node is not None:
+            handler = self.SPAN_HANDLERS[node.name]
+        else:
+            agent = current.tags().get("agent")
+            handler = self.AGENT_HANDLERS.get(agent)
+            if handler is None:
+                raise ValueError(f"OfflineLLM has no script for agent {agent!r}")
+        return getattr(self, handler)(messages, messages[-1]["content"])
+
+    def _answer_question(self, messages, last: str) -> str:
+        return f"<think>Deciding.</think><response>{self._bool(last)}</response>"
+
+    def _answer_questions(self, messages, last: str) -> str:
+        import re
+
+        ids = re.findall(r"<question id=(\d+)>(.*?)</question>", last, re.DOTALL)
+        return "".join(f"<response id={qid}>{self._bool(question)}</response>" for qid, question in ids)
+
+    def _extract_slots(self, messages, last: str) -> str:
+        import json
+        import re
+
+        # The requested fields are listed as "- field: ..."
+        fields = re.findall(r"^- (\w+):", last, re.MULTILINE)
+        return json.dumps({key: self.vacation_info[key] for key in fields if key in self.vacation_info})
+
+    def _traveler_reply(self, messages, last: str) -> str:
+        return f"Happy to help! Here are our trip details: {self.vacation_info}"
+
+    def _onboarding_reply(self, messages, last: str) -> str:
+        import json
+
+        turns = sum(1 for m in messages if m["role"] == "assistant")
+        if turns >= self.onboarding_turns:
+            return f"Thanks! Here is everything:\n```json\n{json.dumps(self.vacation_info)}\n```"
+        return "Could you tell me more about your group, dates and budget?"
+
+    @staticmethod
+    def _bool(question: str) -> bool:
+        import hashlib
+
+        return int(hashlib.sha256(question.encode("utf-8")).hexdigest(), 16) % 3 != 0
+
+    def _act(self, action: dict | list[dict]) -> str:
+        import json
+
+        actions = action if isinstance(action, list) else [action]
+        with self._lock:
+            self.act_steps += 1
+            self.tool_calls += sum(1 for a in actions if not a["tool"].startswith("final"))
+        return f"<act>{json.dumps(action)}</act>"
+
+    @staticmethod
+    def _step_number(messages) -> int:
+        import re
+
+        for message in reversed(messages):
+            match = re.search(r"start the (\d+)th step", message["content"])
+            if match:
+                return int(match.group(1))
+        return 1
+
+    def _trip_dates(self) -> list[str]:
+        return trip_dates(self.vacation_info)
+
+    def _plan(self) -> dict:
+        city = self.vacation_info["destination"]
+        days = []
+        for date in self._trip_dates():
+            activities = [
+                {
+                    "name": event.name,
+                    "description": event.description,
+                    "time": event.time[11:],
+                    "duration": "2 hours",
+                    "price": event.price_amount,
+                    "category": event.category,
+                    "location": event.location,
+                }
+                for event in get_event_store().by_date(city, date, as_records=True)[:2]
+            ]
+            weather = get_weather(date, city).get("condition", "unknown")
+            days.append({"date": date, "weather": weather, "activities": activities})
+        return {
+            "city": city,
+            "start_date": self.vacation_info["date_of_arrival"],
+            "end_date": self.vacation_info["date_of_departure"],
+            "itinerary": days,
+            "total_cost": sum(a["price"] for day in days for a in day["activities"]),
+        }
+
+    def _planning_step(self, messages, last: str) -> str:
+        thought = "<thought>I will gather the weather and activities for each day.</thought>"
+        if "<act>" not in last:
+            return thought
+        # A single-call step asks for the thought and the act in one response
+        thought = thought if "<thought>" in last else ""
+        step = self._step_number(messages)
+        dates = self._trip_dates()
+        city = self.vacation_info["destination"]
+        # Without prefetched data, fetch each date's weather and activities in one step
+        prefetched = any(
+            m["content"].startswith("<observation>{") and '"activities":' in m["content"] for m in messages
+        )
+        if not prefetched and step <= len(dates):
+            date = dates[step - 1]
+            return thought + self._act(
+                [
+                    {"tool": "weather", "date": date, "city": city},
+                    {"tool": "get_activities_by_date", "date": date, "city": city},
+                ]
+            )
+        self.itinerary = self._plan()
+        return thought + self._act(dict(tool="final_output", **self.itinerary))
+
+    def _revision_step(self, messages, last: str) -> str:
+        thought = "<thought>I will run the evaluations, then submit the itinerary.</thought>"
+        if "<act>" not in last:
+            return thought
+        thought = thought if "<thought>" in last else ""
+        itinerary = self.itinerary or self._plan()
+        if self._step_number(messages) == 1:
+            return thought + self._act(
+                {"tool": "run_evals_tool", "vacation_info": self.vacation_info, "itinerary": itinerary}
+            )
+        return thought + self._act(dict(tool="final_answer_tool", **itinerary))
+
+
+class BenchmarkRegression(AssertionError):
+    """Raised by `run_benchmark` when a metric regresses past its baseline tolerance."""
+
+
+# Relative slack allowed over the baseline before a metric counts as a regression.
+# Counts from the scripted LLM are deterministic; timings and memory are noisy.
+DEFAULT_BENCHMARK_TOLERANCES = {
+    "llm_calls": 0.0,
+    "tool_calls": 0.0,
+    "react_steps": 0.0,
+    "prompt_tokens": 0.05,
+    "completion_tokens": 0.05,
+    "wall_seconds": 0.5,
+    "peak_memory_kb": 0.25,
+}
+
+# Absolute slack, so that tiny baselines do not fail on noise
+_BENCHMARK_ABSOLUTE_SLACK = {"wall_seconds": 0.05, "peak_memory_kb": 256}
+
+
+def run_benchmark(
+    stages,
+    workloads=None,
+    baseline_path: str | None = None,
+    update_baseline: bool = False,
+    tolerances: dict | None = None,
+    latency: float = 0.0,
+    seconds_per_token: float = 0.0,
+) -> dict:
+    """Runs pipeline stages against synthetic workloads and an offline LLM.
+
+    Each workload installs its synthetic calendar, then the stages run in
+    order, sharing a `state` dict that starts with the workload's
+    "vacation_info" and the "llm" (an `OfflineLLM`). Each stage is a
+    (name, fn) pair; fn(state) may store its output in state for the next
+    stages. While the benchmark runs, the offline LLM is the default backend,
+    the response cache is disabled and traces go to a NullTraceSink.
+
+    Per stage, the wall time, LLM calls, prompt and completion tokens,
+    ReAct steps, tool calls (and tool calls per step) and peak traced memory
+    are reported.
+
+    If baseline_path is given, the results are compared with the baselines
+    stored there: a metric that exceeds baseline * (1 + tolerance) raises
+    BenchmarkRegression. Missing baselines (or update_baseline=True) write the
+    current results as the new baseline instead.
+
+    Args:
+        stages: A list of (name, fn(state)) pairs.
+        workloads: BenchmarkWorkloads. Defaults to DEFAULT_BENCHMARK_WORKLOADS.
+        baseline_path: A JSON file of baseline results.
+        update_baseline: Whether to overwrite the baselines with these results.
+        tolerances: Overrides of DEFAULT_BENCHMARK_TOLERANCES.
+        latency: Simulated seconds per LLM call.
+        seconds_per_token: Simulated seconds per completion token.
+
+    Returns:
+        A dict of {workload name: {stage name: metrics}}.
+
+    Raises:
+        BenchmarkRegression: If a metric regresses past its tolerance.
+
+    Examples:
+        >>> def fetch(state):
+        ...     info = state["vacation_info"]
+        ...     state["events"] = get_events(info["date_of_arrival"], info["destination"], max_events=100)
+        >>> results = run_benchmark([("fetch", fetch)], [BenchmarkWorkload("tiny", events_per_day=3)])
+        >>> results["tiny"]["fetch"]["llm_calls"], sorted(results["tiny"]["fetch"])[:3]
+        (0, ['cached_tokens', 'completion_tokens', 'llm_calls'])
+    """
+    import json
+    import os
+    import time
+    import tracemalloc
+
+    workloads = DEFAULT_BENCHMARK_WORKLOADS if workloads is None else workloads
+    tolerances = {**DEFAULT_BENCHMARK_TOLERANCES, **(tolerances or {})}
+
+    was_tracing = tracemalloc.is_tracing()
+
+    results = {}
+    try:
+        if not was_tracing:
+            tracemalloc.start()
+        for workload in workloads:
+            vacation_info = workload.vacation_info()
+            llm = OfflineLLM(vacation_info, latency=latency, seconds_per_token=seconds_per_token)
+            state = {"vacation_info": vacation_info, "llm": llm, "workload": workload}
+            stage_results = results[workload.name] = {}
+            with isolated_llm_environment(CallableBackend(llm)), workload.install():
+                for name, fn in stages:
+                    before = llm.counters()
+                    tracemalloc.reset_peak()
+                    base_memory = tracemalloc.get_traced_memory()[0]
+                    start = time.perf_counter()
+                    fn(state)
+                    wall = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1] - base_memory
+                    metrics = {k: v - before[k] for k, v in llm.counters().items()}
+                    metrics["tool_calls_per_step"] = round(
+                        metrics["tool_calls"] / metrics["react_steps"], 3
+                    ) if metrics["react_steps"] else 0.0
+                    metrics["wall_seconds"] = round(wall, 4)
+                    metrics["peak_memory_kb"] = round(peak / 1024, 1)
+                    stage_results[name] = metrics
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    if baseline_path is None:
+        return results
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    if not update_baseline:
+        for workload_name, stage_results in results.items():
+            for stage_name, metrics in stage_results.items():
+                baseline = baselines.get(workload_name, {}).get(stage_name)
+                if baseline is None:
+                    continue
+                for metric, tolerance in tolerances.items():
+                    if metric not in baseline or metric not in metrics:
+                        continue
+                    limit = baseline[metric] * (1 + tolerance) + _BENCHMARK_ABSOLUTE_SLACK.get(metric, 0)
+                    if metrics[metric] > limit:
+                        regressions.append(
+                            f"{workload_name}/{stage_name}: {metric} {metrics[metric]} > {baseline[metric]} (+{tolerance:.0%})"
+                        )
+
+    if regressions:
+        raise BenchmarkRegression("Benchmark regressions:\n" + "\n".join(regressions))
+
+    # Record new baselines, keeping existing ones unless asked to overwrite them
+    for workload_name, stage_results in results.items():
+        for stage_name, metrics in stage_results.items():
+            stored = baselines.setdefault(workload_name, {})
+            if update_baseline or stage_name not in stored:
+                stored[stage_name] = metrics
+    with open(baseline_path, "w") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+    return results
+
+
+def format_benchmark_report(results: dict) -> str:
+    """Formats the results of `run_benchmark` as a table.
+
+    Examples:
+        >>> print(format_benchmark_report({"small": {"plan": {"wall_seconds": 0.5, "llm_calls": 4,
+        ...     "prompt_tokens": 900, "cached_tokens": 512, "completion_tokens": 80, "react_steps": 3,
+        ...     "tool_calls": 2, "tool_calls_per_step": 0.667, "peak_memory_kb": 12.5}}}))
+        workload  stage  wall s  calls  prompt tok  cached tok  compl tok  steps  tools/step  peak KB
+        small     plan    0.500      4         900         512         80      3       0.667     12.5
+    """
+    header = (
+        "workload", "stage", "wall s", "calls", "prompt tok", "cached tok", "compl tok",
+        "steps", "tools/step", "peak KB",
+    )
+    rows = [header]
+    for workload_name, stage_results in results.items():
+        for stage_name, m in stage_results.items():
+            rows.append(
+                (
+                    workload_name,
+                    stage_name,
+                    f"{m['wall_seconds']:.3f}",
+                    str(m["llm_calls"]),
+                    str(m["prompt_tokens"]),
+                    str(m["cached_tokens"]),
+                    str(m["completion_tokens"]),
+                    str(m["react_steps"]),
+                    f"{m['tool_calls_per_step']:.3f}",
+                    f"{m['peak_memory_kb']:.1f}",
+                )
+            )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = []
+    for row in rows:
+        cells = [cell.ljust(widths[i]) if i < 2 else cell.rjust(widths[i]) for i, cell in enumerate(row)]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
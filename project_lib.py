@@ -1,5 +1,11 @@
 """Provides utility functions for the project."""
 
+import contextlib
+import contextvars
+import enum
+import functools
+import threading
+
 SINGLE_TAB_LEVEL = 4
 
 
@@ -21,15 +27,24 @@ def compare_dicts_case_insensitive(d1, d2):
     )
 
 
-def print_in_box(text, title="", cols=100, tab_level=0):
+def format_in_box(text, title="", cols=100, tab_level=0) -> str:
     """
-    Prints the given text in a box with the specified title and dimensions.
+    Formats the given text in a box with the specified title and dimensions.
 
     Args:
-        text: The text to print in the box.
+        text: The text to put in the box.
         title: The title of the box.
         cols: The width of the box.
         tab_level: The level of indentation for the box.
+
+    Returns:
+        str: The lines of the box.
+
+    Examples:
+        >>> print(format_in_box("Hello", title="Hi", cols=14))
+        ╔═══[ Hi ]═══╗
+        ║ Hello      ║
+        ╚════════════╝
     """
     import textwrap
 
@@ -47,745 +62,4184 @@ def print_in_box(text, title="", cols=100, tab_level=0):
         + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
         + "\u2557"
     )
-    if tab_level == 0:
-        print()  # Print a newline before any box at level 0
 
     if title:
         # replace the middle of the top with the title
         title = "[ " + title + " ]"
         top = top[: (cols - len(title)) // 2] + title + top[(cols + len(title)) // 2 :]
-    print(top)
+    lines = [top]
 
     for line in text.split("\n"):
         for wrapped_line in textwrap.wrap(
             line, cols - 4 - tab_level * SINGLE_TAB_LEVEL
         ):
-            print(
+            lines.append(
                 f"{tabs}\u2551 {wrapped_line:<{cols - 4 - tab_level * SINGLE_TAB_LEVEL}} \u2551"
             )
 
-    print(
+    lines.append(
         f"{tabs}\u255a"
         + "\u2550" * (cols - 2 - tab_level * SINGLE_TAB_LEVEL)
         + "\u255d"
     )
+    return "\n".join(lines)
 
 
-def do_chat_completion(messages: list[dict[str, str]], **kwargs):
-    """A simple wrapper around OpenAI's chat completion API.
+def print_in_box(text, title="", cols=100, tab_level=0):
+    """
+    Prints the given text in a box with the specified title and dimensions.
 
     Args:
-        messages: A list of messages to send to the chat completion API.
+        text: The text to print in the box.
+        title: The title of the box.
+        cols: The width of the box.
+        tab_level: The level of indentation for the box.
+    """
+    if tab_level == 0:
+        print()  # Print a newline before any box at level 0
+    print(format_in_box(text, title=title, cols=cols, tab_level=tab_level))
 
-    Returns:
-        str: The response from the chat completion API.
 
-    Raises:
-        openai.OpenAIError: If the chat completion API returns an error.
+class TraceSink:
+    """Receives the trace of agent messages, prompts and responses.
 
-    Examples:
-        >>> messages = [
-        ...     {"role": "user", "content": "Hello, how are you?"},
-        ...     {"role": "assistant", "content": "I'm good, thanks!"},
-        ... ]
-        >>> from unittest.mock import patch
-        >>> with patch('openai.OpenAI') as mock_openai:
-        ...     # Setup mock response
-        ...     mock_client = mock_openai.return_value
-        ...     mock_chat = mock_client.chat
-        ...     mock_completions = mock_chat.completions
-        ...     mock_create = mock_completions.create
-        ...     mock_response = mock_create.return_value
-        ...     mock_response.choices = [type('obj', (object,), {'message': type('msg', (object,), {'content': "I'm good, thanks!"})()})]
-        ...     response = do_chat_completion(messages)
-        >>> response
-        "I'm good, thanks!"
+    Agents report what they send and receive through `trace`, which hands an
+    event to the active sink (see `set_trace_sink`). Events are plain dicts
+    with the keys "time", "source", "title", "content" and "tab_level". The
+    content is passed as is, e.g. a dict itinerary, and only formatted by sinks
+    that need text, so tracing costs almost nothing on the agents' hot path.
+
+    Attributes:
+        enabled: Whether the sink wants events. `trace` does not even build
+            the event for disabled sinks.
     """
-    import openai
 
-    client = openai.OpenAI(
-        base_url="https://openai.vocareum.com/v1",
-        api_key="voc-1528689085160736365463468376c73845a55.15105883",
-    )
+    enabled = True
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini", messages=messages, **kwargs
-    )
-    return response.choices[0].message.content
+    def emit(self, event: dict):
+        raise NotImplementedError
 
+    def close(self):
+        """Flushes and releases the sink's resources."""
 
-EVENT_CALENDAR = [
-    {
-        "name": "Yoga in the Park",
-        "time": "2025-06-10 13:00",
-        "location": "Riverfront Stage",
-        "category": "Fitness",
-        "description": "Join us for a refreshing outdoor yoga session with certified instructor Maria Zen. This all-levels class will focus on breathwork, stretching, and relaxation, set against the beautiful backdrop of the Riverfront. Attendees are encouraged to bring their own mats and water. Perfect for anyone seeking to improve their mental and physical well-being in a tranquil environment. Note: This event is suitable for all ages; however, some poses may require modification for beginners or those with physical limitations.",
-        "price": "10",
-    },
-    {
-        "name": "Capture the Moment: Photography Workshop",
-        "time": "2025-06-10 13:00",
-        "location": "Community Center",
-        "category": "Photography",
-        "description": "Join us for an engaging photography workshop where participants will learn the fundamentals of photography, including composition, lighting, and editing techniques. Perfect for beginners and hobbyists! Bring your own camera or smartphone and unleash your creativity. Participants will also get the chance to showcase their work in a friendly group critiquing session at the end. All ages welcome!",
-        "price": "25",
-    },
-    {
-        "name": "AgentsVille Book Fair",
-        "time": "2025-06-10 13:00",
-        "location": "Community Center",
-        "category": "Literature",
-        "description": "Join us for the annual AgentsVille Book Fair! Discover new authors, participate in engaging workshops, and attend readings from local literary talents. A wonderful event for all ages to encourage reading and creativity.",
-        "price": "10",
-    },
-    {
-        "name": "AgentsVille Artisan Market",
-        "time": "2025-06-10 13:00",
-        "location": "Old Town Square",
-        "category": "Crafts",
-        "description": "Join us for the AgentsVille Artisan Market, a vibrant gathering of local craftspeople showcasing handmade goods. Explore unique jewelry, pottery, textiles, and artwork while supporting our community. Enjoy live music, crafting demonstrations, and a fun atmosphere for all ages!",
-        "price": "20",
-    },
-    {
-        "name": "AgentsVille Summer Jam",
-        "time": "2025-06-10 15:00",
-        "location": "Sports Arena",
-        "category": "Music",
-        "description": "Join us for the annual AgentsVille Summer Jam featuring live performances from local bands and artists! Enjoy great music, dancing, and a lively atmosphere. Bring your family and friends for an afternoon of fun and entertainment!",
-        "price": "Free",
-    },
-    {
-        "name": "Crafting for a Cause",
-        "time": "2025-06-10 18:00",
-        "location": "Convention Center",
-        "category": "Crafts",
-        "description": "Join us for an evening of creativity and community at the Crafting for a Cause event! Attendees will have the opportunity to create their own personalized crafts, with supplies provided. This event is suitable for all ages and skill levels. All materials are environmentally friendly and suitable for vegans. A portion of the proceeds will go to local charities supporting children's programs in AgentsVille.",
-        "price": "5",
-    },
-    {
-        "name": "Cinematic Under the Stars",
-        "time": "2025-06-10 18:00",
-        "location": "Grand Theater",
-        "category": "Film",
-        "description": "Join us for an enchanting evening of classic films under the stars at the Grand Theater! Bring your friends and family for a cozy outdoor screening featuring timeless favorites. Snacks and refreshments will be available for purchase. Proceeds from donations will support local arts initiatives.",
-        "price": "Donation-based",
-    },
-    {
-        "name": "Under the Stars: Poetry Night",
-        "time": "2025-06-10 20:00",
-        "location": "Downtown Plaza",
-        "category": "Literature",
-        "description": "Join us for an enchanting evening of poetry reading under the stars! Local poets will take the stage to share their works, encouraging community engagement and appreciation for the art of spoken word. Bring a blanket to sit on and enjoy the ambiance of Downtown Plaza. Ideal for poetry lovers and newcomers alike!",
-        "price": "Free",
-    },
-    {
-        "name": "Laughs Under the Stars",
-        "time": "2025-06-10 20:00",
-        "location": "Old Town Square",
-        "category": "Comedy",
-        "description": "Join us for an evening of laughter under the stars with top-notch comedians from across the country. Set in the charming Old Town Square, this comedy event promises to be a night full of joy and fun. Bring your friends and prepare for a bellyful of laughter!",
-        "price": "25",
-    },
-    {
-        "name": "Night Under the Stars: Photography Workshop",
-        "time": "2025-06-10 20:00",
-        "location": "Community Center",
-        "category": "Photography",
-        "description": "Join us for an enchanting evening of photography as we capture the beauty of the night sky. Participants will learn about astrophotography techniques and have the opportunity to try them out with provided telescopes and cameras. Bring your own camera if you have one! This workshop is suitable for all skill levels, and a portion of the donations will go to local art initiatives. No prior experience necessary.",
-        "price": "Donation-based",
-    },
-    {
-        "name": "Laughter Fest 2025",
-        "time": "2025-06-11 10:00",
-        "location": "Cultural Center",
-        "category": "Comedy",
-        "description": "Join us for a morning of laughter at the Laughter Fest 2025! Enjoy stand-up performances from top comedians, along with surprise guests that will leave you in stitches. This event is perfect for those aged 18 and up, and it promises to be a fun-filled experience for everyone!",
-        "price": "50",
-    },
-    {
-        "name": "Summer Serenades",
-        "time": "2025-06-11 10:00",
-        "location": "Botanical Gardens",
-        "category": "Music",
-        "description": "Join us at the beautiful Botanical Gardens for a captivating morning of live music performances. Enjoy an array of local bands playing a mix of genres while surrounded by breathtaking floral displays. Bring a picnic blanket and relax in the sun with family and friends!",
-        "price": "25",
-    },
-    {
-        "name": "AgentsVille Summer Festival",
-        "time": "2025-06-11 13:00",
-        "location": "Old Town Square",
-        "category": "Festival",
-        "description": "Join us for the annual AgentsVille Summer Festival, a day filled with live music, dance performances, and local artisans showcasing their crafts. Enjoy delicious food from various food trucks featuring selections including vegan tacos, gluten-free pizza, and scrumptious desserts. Plenty of activities for kids, and there's a special petting zoo for the little ones!",
-        "price": "40",
-    },
-    {
-        "name": "AgentsVille Summer Music Fest",
-        "time": "2025-06-11 13:00",
-        "location": "Convention Center",
-        "category": "Music",
-        "description": "Join us for the AgentsVille Summer Music Fest featuring live performances from local bands, food trucks, and a vibrant arts & crafts market. Enjoy a variety of music genres, family-friendly activities, and the chance to support local talent!",
-        "price": "50",
-    },
-    {
-        "name": "Afternoon Acoustic Session",
-        "time": "2025-06-11 15:00",
-        "location": "Public Library",
-        "category": "Music",
-        "description": "Join us for a cozy afternoon of live acoustic music featuring local artists. Enjoy soothing melodies while surrounded by the serene atmosphere of the library. This event is perfect for music lovers of all ages. Bring a friend or family member and relax!",
-        "price": "Donation-based",
-    },
-    {
-        "name": "AgentsVille Summer Festival",
-        "time": "2025-06-11 18:00",
-        "location": "Downtown Plaza",
-        "category": "Family",
-        "description": "Join us for the annual AgentsVille Summer Festival! This family-friendly event features fun games, live music, and a variety of activities for all ages. Enjoy delicious food like grilled corn on the cob, cheeseburgers, vegan tacos, and gluten-free brownie bites. Don't miss out on the exciting face painting for kids and the evening's spectacular firework display!",
-        "price": "40",
-    },
-    {
-        "name": "AgentsVille Historical Walk",
-        "time": "2025-06-11 18:00",
-        "location": "Cultural Center",
-        "category": "History",
-        "description": "Join us for an enlightening evening as we explore the rich history of AgentsVille on our guided historical walk. The event will feature expert local historians who will share fascinating stories and insights about the town's past, leading participants through significant historical sites. Get ready to learn, engage, and marvel at the legacy of our vibrant town!",
-        "price": "40",
-    },
-    {
-        "name": "AgentsVille Cooking Class: Italian Night",
-        "time": "2025-06-11 19:30",
-        "location": "Public Library",
-        "category": "Culinary",
-        "description": "Join us for a delightful evening of Italian cooking! We'll be making classic dishes such as homemade pasta, marinara sauce, and tiramisu, all from scratch. This hands-on class is perfect for all skill levels. Participants will enjoy tasting each dish. Please note, all dishes are vegetarian, and we can accommodate gluten-free substitutes if requested in advance. Come hungry and ready to learn!",
-        "price": "Donation-based",
-    },
-    {
-        "name": "Poetry Under the Stars",
-        "time": "2025-06-11 20:00",
-        "location": "Botanical Gardens",
-        "category": "Literature",
-        "description": "Join us for a magical evening of poetry readings under the stars, featuring local poets and immersive performances. Bring a blanket to sit on and enjoy the beauty of nature while you listen to heartfelt verses. Perfect for poetry lovers of all ages!",
-        "price": "30",
-    },
-    {
-        "name": "Midsummer Night's Dream",
-        "time": "2025-06-11 20:00",
-        "location": "University Campus",
-        "category": "Theater",
-        "description": "Join us for a magical evening as the University Theater presents Shakespeare's enchanting comedy, 'Midsummer Night's Dream.' Experience a captivating performance filled with love, mischief, and fairies under the moonlit sky.",
-        "price": "30",
-    },
-    {
-        "name": "Whispers of the Wind Poetry Festival",
-        "time": "2025-06-12 10:00",
-        "location": "Old Town Square",
-        "category": "Poetry",
-        "description": "Join us for the Whispers of the Wind Poetry Festival in the heart of AgentsVille! Experience an inspiring day with local poets sharing their works and engaging in open mic sessions. Enjoy a creative atmosphere, live music, and the opportunity to connect with fellow poetry enthusiasts. Don't miss our special guest poet who will be delivering a keynote address. Suitable for all ages.",
-        "price": "30",
-    },
-    {
-        "name": "Taste of AgentsVille",
-        "time": "2025-06-12 10:00",
-        "location": "City Museum",
-        "category": "Food",
-        "description": "Join us for the annual Taste of AgentsVille, where local chefs showcase their best dishes! Enjoy a variety of delectable offerings including gluten-free pasta, vegan curry, and traditional peach cobbler. Come hungry and sample tasty bites from all around town!",
-        "price": "Free",
-    },
-    {
-        "name": "Yoga in the Gallery",
-        "time": "2025-06-12 13:00",
-        "location": "Art Gallery",
-        "category": "Fitness",
-        "description": "Join us for a refreshing yoga session amidst beautiful artworks at the Art Gallery. This class is suitable for all levels and will be led by certified instructors. Bring your own mat and water bottle. Perfect for stress relief and flexibility!",
-        "price": "10",
-    },
-    {
-        "name": "Annual Fitness Expo",
-        "time": "2025-06-12 15:00",
-        "location": "Convention Center",
-        "category": "Fitness",
-        "description": "Join us for the Annual Fitness Expo where you can participate in various workshops, fitness demonstrations, and meet fitness experts. Discover new workout routines, healthy living tips, and exciting fitness gear. All levels of fitness enthusiasts are welcome!",
-        "price": "30",
-    },
-    {
-        "name": "Science Odyssey: A Day of Discovery",
-        "time": "2025-06-12 15:00",
-        "location": "City Museum",
-        "category": "Science",
-        "description": "Join us for an interactive exploration of the wonders of science! This event features engaging demonstrations, hands-on experiments, and lectures from renowned scientists. Suitable for all ages, attendees will learn about physics, chemistry, and biology through fun and exciting activities. Don't miss out on the chance to spark curiosity and imagination!",
-        "price": "50",
-    },
-    {
-        "name": "AgentsVille Tech Expo 2025",
-        "time": "2025-06-12 18:00",
-        "location": "Downtown Plaza",
-        "category": "Technology",
-        "description": "Join us for the AgentsVille Tech Expo 2025, a showcase of innovative technologies and tech start-ups in our town! Network with industry experts and get hands-on experience with the latest gadgets. Enjoy interactive workshops, keynote speakers, and an exhibition area featuring cutting-edge products. Don't miss the opportunity to learn about the future of technology!",
-        "price": "25",
-    },
-    {
-        "name": "Understanding Artificial Intelligence",
-        "time": "2025-06-12 19:30",
-        "location": "Public Library",
-        "category": "Education",
-        "description": "Join us for an enlightening workshop on the basics of Artificial Intelligence. Learn how AI is transforming our world through practical examples and interactive discussions. Open to all ages, this event will feature local experts who will simplify complex topics and answer your burning questions.",
-        "price": "Donation-based",
-    },
-    {
-        "name": "Evening of Quantum Curiosities",
-        "time": "2025-06-12 19:30",
-        "location": "Public Library",
-        "category": "Science",
-        "description": "Join us for an enlightening evening delving into the mysteries of quantum physics. Renowned physicist Dr. Ellen Quark will lead a captivating talk and Q&A session on the principles of quantum mechanics, making complex topics accessible to all. Whether you're a science enthusiast or simply curious, this event promises to be both educational and engaging!",
-        "price": "10",
-    },
-    {
-        "name": "Starlit Poetry Night",
-        "time": "2025-06-12 20:00",
-        "location": "City Museum",
-        "category": "Poetry",
-        "description": "Join us for a magical evening of poetry under the stars in the beautiful gardens of the City Museum. Local poets will share their work, and audience members are encouraged to participate in an open mic segment. The event will also feature ambient music and a cozy atmosphere perfect for inspiration.",
-        "price": "Free",
-    },
-    {
-        "name": "Stargazing Night: The Wonders of the Universe",
-        "time": "2025-06-12 20:00",
-        "location": "Community Center",
-        "category": "Science",
-        "description": "Join us for a mesmerizing evening of stargazing and astronomy! Experts will guide you through the night sky, highlighting constellations, planets, and galaxies visible to the naked eye. Telescopes will be provided for those who want a closer look. Bring your blanket and enjoy this cosmic adventure! Perfect for families and space enthusiasts. The event is rain or shine, with indoor activities planned in case of inclement weather.",
-        "price": "15",
-    },
-    {
-        "name": "Sunny Shores Festival",
-        "time": "2025-06-13 10:00",
-        "location": "Beach Boardwalk",
-        "category": "Festival",
-        "description": "Join us for the annual Sunny Shores Festival at the scenic Beach Boardwalk! Enjoy live music, artisan craft booths, and activities for all ages. Savor delicious local food offerings including fresh seafood tacos, vegan burgers, and gluten-free desserts, all while enjoying the beautiful ocean view. Don't miss this lively celebration of community and summer fun!",
-        "price": "5",
-    },
-    {
-        "name": "AgentsVille Family Fun Day",
-        "time": "2025-06-13 13:00",
-        "location": "Sports Arena",
-        "category": "Family",
-        "description": "Join us for a day filled with games, activities, and entertainment for the whole family! Enjoy face painting, a bouncy castle, and live performances. There will be fun contests with great prizes, and a chance to meet local mascots!",
-        "price": "25",
-    },
-    {
-        "name": "AgentsVille Summer Splash Festival",
-        "time": "2025-06-13 13:00",
-        "location": "Beach Boardwalk",
-        "category": "Festival",
-        "description": "Join us for the annual AgentsVille Summer Splash Festival! Enjoy live music, exciting games, and various water activities suitable for families. Indulge in delicious summer treats, including grilled corn on the cob, watermelon slices, and a variety of ice cream flavors (including dairy-free options). Bring your sunscreen and enjoy a day of fun and relaxation by the beach!",
-        "price": "10",
-    },
-    {
-        "name": "AgentsVille Community Cook-off",
-        "time": "2025-06-13 13:00",
-        "location": "Historic District",
-        "category": "Culinary",
-        "description": "Join us for the annual AgentsVille Community Cook-off, where local chefs and home cooks will showcase their culinary skills! Enjoy a variety of dishes including vegetarian pasta salad, spicy vegan chili, and succulent barbecue pulled pork, perfect for all tastes. Gluten-free and nut-free options will also be available. Taste the flavors of our town while supporting local culinary talent!",
-        "price": "Donation-based",
-    },
-    {
-        "name": "AgentsVille Food Festival",
-        "time": "2025-06-13 15:00",
-        "location": "Historic District",
-        "category": "Culinary",
-        "description": "Join us for the AgentsVille Food Festival, where local chefs showcase their best dishes! Enjoy a variety of mouth-watering options including vegan tacos, gluten-free pasta, and a chocolate fountain. There will be something for everyone, including options for those with dietary restrictions such as nut-free and lactose-free dishes. Bring your appetite and enjoy a day full of flavor!",
-        "price": "20",
-    },
-    {
-        "name": "Culinary Delights: Tasting Evening",
-        "time": "2025-06-13 18:00",
-        "location": "Public Library",
-        "category": "Food",
-        "description": "Join us for a delightful evening of culinary tasting featuring a variety of international dishes. Enjoy vegan and gluten-free options alongside flavorful meat and dairy platters. Sample dishes from around the world and learn about the cultural significance behind each cuisine.",
-        "price": "15",
-    },
-    {
-        "name": "Taste of AgentsVille",
-        "time": "2025-06-13 19:30",
-        "location": "Historic District",
-        "category": "Food",
-        "description": "Join us for the annual Taste of AgentsVille, where local chefs showcase their culinary talents. Enjoy a variety of dishes, including vegan and gluten-free options. Featuring signature dishes like homemade pasta, barbecue pulled jackfruit sliders, and artisanal desserts to satisfy your sweet tooth. Perfect for food lovers of all dietary preferences!",
-        "price": "5",
-    },
-    {
-        "name": "Outdoor Yoga Under the Stars",
-        "time": "2025-06-13 19:30",
-        "location": "University Campus",
-        "category": "Fitness",
-        "description": "Join us for an evening of relaxation and rejuvenation with our Outdoor Yoga Under the Stars event! Experience the serenity of yoga while surrounded by nature. All levels are welcome, and please bring your own yoga mat. Enjoy a light refreshing herbal tea post-session, ideal for all dietary preferences including gluten-free and vegan options!",
-        "price": "10",
-    },
-    {
-        "name": "AgentsVille Annual Photography Exhibition",
-        "time": "2025-06-13 19:30",
-        "location": "Art Gallery",
-        "category": "Photography",
-        "description": "Join us for the AgentsVille Annual Photography Exhibition featuring local and international photographers showcasing their best works. Enjoy a night of creativity and inspiration as you explore various photography styles, including landscape, portrait, and abstract. A limited number of prints will be available for purchase. Refreshments will be provided, including gourmet finger foods, vegan snacks, and gluten-free options. Don't miss this opportunity to celebrate artistry in our vibrant community!",
-        "price": "50",
-    },
-    {
-        "name": "AgentsVille Arts Festival",
-        "time": "2025-06-13 20:00",
-        "location": "Sports Arena",
-        "category": "Arts",
-        "description": "Join us for the AgentsVille Arts Festival, a night celebrating local artists and their creative works! Enjoy live performances, art exhibits, and interactive art stations. Bring your loved ones and immerse yourself in the vibrant culture of AgentsVille! Admission is donation-based, with all proceeds going towards community arts programs.",
-        "price": "Donation-based",
-    },
-    {
-        "name": "Sunrise Photography Workshop",
-        "time": "2025-06-14 10:00",
-        "location": "University Campus",
-        "category": "Photography",
-        "description": "Join us for a captivating workshop where you'll learn the art of capturing stunning sunrise photos. Led by local photography expert Mia Rivers, this workshop is suitable for all skill levels. Make sure to bring your camera and tripod!",
-        "price": "30",
-    },
-    {
-        "name": "Laughter in the Park",
-        "time": "2025-06-14 10:00",
-        "location": "Historic District",
-        "category": "Comedy",
-        "description": "Join us for a morning of laughter at the Historic District of AgentsVille! 'Laughter in the Park' features a lineup of local comedians who will have you rolling in the aisles with their hilarious takes on everyday life. Bring your friends and family for a fun-filled outdoor comedy experience under the sun!",
-        "price": "30",
-    },
-    {
-        "name": "Starry Night Science Spectacular",
-        "time": "2025-06-14 18:00",
-        "location": "Riverfront Stage",
-        "category": "Science",
-        "description": "Join us for an evening of fascinating astronomical discoveries and hands-on activities as we explore the wonders of the universe. Engage with local scientists and enjoy stargazing through telescopes after the presentations. Perfect for families and those curious about the cosmos!",
-        "price": "10",
-    },
-    {
-        "name": "Laughter Under the Stars",
-        "time": "2025-06-14 19:30",
-        "location": "Cultural Center",
-        "category": "Comedy",
-        "description": "Join us for a night of laughter featuring local comedians as they take the stage to share their wittiest jokes and stories. It's a perfect evening for friends and family!",
-        "price": "Free",
-    },
-    {
-        "name": "Sonnets Under the Stars",
-        "time": "2025-06-14 19:30",
-        "location": "Cultural Center",
-        "category": "Poetry",
-        "description": "Join us for an enchanting evening of poetry where local poets will share their sonnets and spoken word pieces under the stars. The event aims to celebrate the power of words and the beauty of expression with a cozy and intimate atmosphere.",
-        "price": "15",
-    },
-    {
-        "name": "Gourmet Food Fest",
-        "time": "2025-06-14 19:30",
-        "location": "Sports Arena",
-        "category": "Food",
-        "description": "Join us for an evening of culinary delights at the Gourmet Food Fest! Enjoy a diverse selection of dishes from local chefs, featuring gluten-free, vegetarian, and vegan options. Indulge in mouth-watering appetizers, savory entrees, and delectable desserts while mingling with fellow food enthusiasts. Experience the flavors of AgentsVille like never before!",
-        "price": "50",
-    },
-    {
-        "name": "AgentsVille Family Movie Night",
-        "time": "2025-06-14 19:30",
-        "location": "Grand Theater",
-        "category": "Family",
-        "description": "Join us for an enchanting evening of family-friendly films! Enjoy a double feature showcasing classic animated movies that are sure to delight audiences of all ages. Come early to grab your favorite seat and participate in fun games and activities before the show!",
-        "price": "Donation-based",
-    },
-    {
-        "name": "AgentsVille Craft Fair",
-        "time": "2025-06-14 20:00",
-        "location": "Historic District",
-        "category": "Crafts",
-        "description": "Join us in the Historic District for the annual AgentsVille Craft Fair! Explore a variety of handmade crafts from local artisans, including pottery, jewelry, textiles, and woodwork. A great opportunity to pick up unique gifts and support local artists. Suitable for all ages!",
-        "price": "20",
-    },
-    {
-        "name": "AgentsVille Summer Food Festival",
-        "time": "2025-06-14 20:00",
-        "location": "Sports Arena",
-        "category": "Culinary",
-        "description": "Join us for a delightful evening at the AgentsVille Summer Food Festival! Savor an array of gourmet food from local vendors, featuring grilled shrimp tacos, vegan stir-fried noodles, and decadent chocolate mousse. All food options will be clearly labeled for allergens, with vegetarian and gluten-free selections available. Bring your appetite and enjoy live music while you taste the best our town has to offer!",
-        "price": "30",
-    },
-    {
-        "name": "Future Tech Showcase",
-        "time": "2025-06-14 20:00",
-        "location": "City Museum",
-        "category": "Technology",
-        "description": "Join us for an evening of innovation at the Future Tech Showcase, where cutting-edge technology meets creativity. Explore interactive exhibits showcasing the latest advancements in AI, robotics, virtual reality, and more. Meet industry leaders and visionary inventors who are shaping our tech-filled future. Don't miss this chance to network with fellow tech enthusiasts!",
-        "price": "40",
-    },
-    {
-        "name": "Summer Spectacular: A Musical Journey",
-        "time": "2025-06-15 10:00",
-        "location": "Community Center",
-        "category": "Theater",
-        "description": "Join us for the Summer Spectacular, an engaging musical theater performance featuring local talents. This event showcases a series of original songs and classic hits, suitable for all ages. Enjoy a lively atmosphere and witness the magic of theater come to life!",
-        "price": "15",
-    },
-    {
-        "name": "AgentsVille Science Fair",
-        "time": "2025-06-15 10:00",
-        "location": "Riverfront Stage",
-        "category": "Education",
-        "description": "Join us for the annual AgentsVille Science Fair where local students showcase their innovative science projects! Expect hands-on experiments, fascinating demonstrations, and the chance to vote for your favorite project. Ideal for families and science enthusiasts alike!",
-        "price": "25",
-    },
-    {
-        "name": "AgentsVille Arts Festival",
-        "time": "2025-06-15 10:00",
-        "location": "Old Town Square",
-        "category": "Arts",
-        "description": "Join us for the annual AgentsVille Arts Festival, showcasing local artists and crafters. Explore unique artworks, photography, and handmade crafts while enjoying live music and entertainment. Perfect for art lovers of all ages!",
-        "price": "15",
-    },
-    {
-        "name": "AgentsVille Artisan Market",
-        "time": "2025-06-15 13:00",
-        "location": "Botanical Gardens",
-        "category": "Market",
-        "description": "Join us for the AgentsVille Artisan Market at the stunning Botanical Gardens! Browse unique handmade crafts, local art, and delicious gourmet food from various vendors. Enjoy live music while you explore the offerings. Vegan, gluten-free, and nut-free options will be available to cater to all dietary needs.",
-        "price": "30",
-    },
-    {
-        "name": "AgentsVille Summer Craft Fair",
-        "time": "2025-06-15 13:00",
-        "location": "Central Park",
-        "category": "Crafts",
-        "description": "Join us in Central Park for the AgentsVille Summer Craft Fair! Enjoy a delightful afternoon immersed in creativity with local artisans showcasing their handmade goods. Participate in interactive craft workshops suitable for all ages, and create your own unique art pieces to take home. Ideal for families, friends, and anyone looking to unleash their inner artist!",
-        "price": "5",
-    },
-    {
-        "name": "AgentsVille Family Fun Day",
-        "time": "2025-06-15 13:00",
-        "location": "Downtown Plaza",
-        "category": "Family",
-        "description": "Join us for a day of fun activities for the whole family! Enjoy games, face painting, live music, and a variety of food stalls featuring delicious options including vegan and gluten-free treats. There will also be a bouncy castle and a petting zoo for kids of all ages!",
-        "price": "20",
-    },
-    {
-        "name": "History of the Botanical Gardens Tour",
-        "time": "2025-06-15 13:00",
-        "location": "Botanical Gardens",
-        "category": "History",
-        "description": "Join us for an enlightening tour through the rich history of the Botanical Gardens. Discover the rare plant collections, learn about the garden's development over the years, and enjoy beautiful landscapes while guided by a knowledgeable historian. Perfect for history buffs and nature lovers alike!",
-        "price": "15",
-    },
-    {
-        "name": "Discover the Stars: An Astronomy Exhibition",
-        "time": "2025-06-15 15:00",
-        "location": "Art Gallery",
-        "category": "Science",
-        "description": "Join us for an enlightening afternoon at the Art Gallery as we explore the wonders of astronomy. This exhibition features stunning visuals of celestial phenomena, interactive displays, and guest speakers from the local astronomy club who will share their insights about the universe. Perfect for all ages!",
-        "price": "25",
-    },
-    {
-        "name": "Shakespeare Under the Stars",
-        "time": "2025-06-15 18:00",
-        "location": "Public Library",
-        "category": "Theater",
-        "description": "Join us for a magical evening of theater featuring a performance of Shakespeare's timeless classic, 'A Midsummer Night's Dream.' Experience the enchanting world of fairies and romance right in your local park. Seating is available on a first-come, first-served basis, so arrive early to secure a good spot.",
-        "price": "40",
-    },
-    {
-        "name": "Artisan Craft Night",
-        "time": "2025-06-15 19:30",
-        "location": "Art Gallery",
-        "category": "Crafts",
-        "description": "Join us for an enchanting evening at the Art Gallery for Artisan Craft Night. Attendees will have the opportunity to create beautiful handmade crafts with guidance from talented local artists. All materials will be provided, and no prior experience is necessary. Perfect for all skill levels!",
-        "price": "50",
-    },
-]
 
-WEATHER_FORECAST = [
-    {
-        "date": "2025-06-10",
-        "city": "AgentsVille",
-        "temperature": 31,
-        "temperature_unit": "celsius",
-        "condition": "clear",
-        "description": "A bright and sunny day in AgentsVille with clear skies and warm temperatures. Perfect weather for outdoor activities!",
-    },
-    {
-        "date": "2025-06-11",
-        "city": "AgentsVille",
-        "temperature": 34,
-        "temperature_unit": "celsius",
-        "condition": "partly cloudy",
-        "description": "A warm day with periods of sunshine and mixed clouds, making it a perfect opportunity for outdoor activities.",
-    },
-    {
-        "date": "2025-06-12",
-        "city": "AgentsVille",
-        "temperature": 28,
-        "temperature_unit": "celsius",
-        "condition": "thunderstorm",
-        "description": "A thunderstorm is expected to roll in during the afternoon, bringing heavy rain and gusty winds. The atmosphere will feel charged with humidity, creating a sultry and dramatic setting as clouds build in the sky.",
-    },
-    {
-        "date": "2025-06-13",
-        "city": "AgentsVille",
-        "temperature": 15,
-        "temperature_unit": "celsius",
-        "condition": "rainy",
-        "description": "Cloudy skies with intermittent rain showers throughout the day, accompanied by a cool breeze and a chance of occasional thunderstorms.",
-    },
-    {
-        "date": "2025-06-14",
-        "city": "AgentsVille",
-        "temperature": 14,
-        "temperature_unit": "celsius",
-        "condition": "rainy",
-        "description": "A steady rain is expected throughout the day with overcast skies and cool temperatures. Residents should be prepared for slick roads and carry umbrellas.",
-    },
-    {
-        "date": "2025-06-15",
-        "city": "AgentsVille",
-        "temperature": 31,
-        "temperature_unit": "celsius",
-        "condition": "sunny",
-        "description": "A bright and sunny day perfect for outdoor activities with no chance of rain.",
-    },
-]
+class NullTraceSink(TraceSink):
+    """A sink that drops every event."""
 
+    enabled = False
 
-def get_events(date: str, city: str, max_events=5) -> list[dict[str, str | int]]:
-    """Returns a list of events for a given date and city.
+    def emit(self, event):
+        pass
 
-    Args:
-        date: The date to get events for. Must be in the format YYYY-MM-DD.
-        city: The city to get events for.
 
-    Returns:
-        A list of events for the given date and city. Currently only returns events
-        for AgentsVille between 2025-06-10 and 2025-06-15.
+class RingBufferTraceSink(TraceSink):
+    """Keeps the latest events in memory, e.g. for inspection after a failed run.
 
     Examples:
-        >>> from pprint import pprint
-        >>> pprint(get_events("2025-06-10", "AgentsVille")[0])
-        {'category': 'Fitness',
-         'description': 'Join us for a refreshing outdoor yoga session with certified '
-                        'instructor Maria Zen. This all-levels class will focus on '
-                        'breathwork, stretching, and relaxation, set against the '
-                        'beautiful backdrop of the Riverfront. Attendees are '
-                        'encouraged to bring their own mats and water. Perfect for '
-                        'anyone seeking to improve their mental and physical '
-                        'well-being in a tranquil environment. Note: This event is '
-                        'suitable for all ages; however, some poses may require '
-                        'modification for beginners or those with physical '
-                        'limitations.',
-         'location': 'Riverfront Stage',
-         'name': 'Yoga in the Park',
-         'price': '10',
-         'time': '2025-06-10 13:00'}
+        >>> sink = RingBufferTraceSink(maxlen=2)
+        >>> for idx in range(3):
+        ...     sink.emit({"content": idx})
+        >>> [event["content"] for event in sink.events]
+        [1, 2]
     """
-    import datetime
 
-    # If the city is not AgentsVille, return an empty list
-    if city != "AgentsVille":
-        return []
+    def __init__(self, maxlen: int = 1000):
+        import collections
 
-    # Verify the date format
-    try:
-        datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        print(f"Invalid date format: {date}")
-        return []
+        self.events = collections.deque(maxlen=maxlen)
 
-    # If the date is not between 2025-06-10 and 2025-06-15, return an empty list
-    if date < "2025-06-10" or date > "2025-06-15":
-        print(f"Date {date} is outside the valid range (2025-06-10 - 2025-06-15)")
-        return []
+    def emit(self, event):
+        self.events.append(event)
 
-    return [event for event in EVENT_CALENDAR if event["time"].startswith(date)][
-        max_events:
-    ]
 
+class JSONLTraceSink(TraceSink):
+    """Writes events as JSON lines from a background thread.
 
-def get_weather(date: str, city: str) -> dict[str, str | int]:
-    """
-    Returns the weather forecast for a given date and city.
+    `emit` only puts the event in a queue; serializing and writing happen in
+    the writer thread. Call `close` to flush the remaining events.
 
     Args:
-        date: The date to get weather for. Must be in the format YYYY-MM-DD.
-        city: The city to get weather for.
-
-    Returns:
-        A dictionary containing the weather forecast for the given date and city.
+        path: The file to append events to.
     """
-    import datetime
 
-    # If the city is not AgentsVille, return an empty dictionary
-    if city != "AgentsVille":
-        return {}
+    def __init__(self, path):
+        import queue
 
-    # Verify the date format
-    try:
-        datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        print(f"Invalid date format: {date}")
-        return {}
+        self.path = path
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="JSONLTraceSink", daemon=True)
+        self._thread.start()
 
-    # If the date is not between 2025-06-10 and 2025-06-15, return an empty dictionary
-    if date < "2025-06-10" or date > "2025-06-15":
-        print(f"Date {date} is outside the valid range (2025-06-10 - 2025-06-15)")
-        return {}
+    def emit(self, event):
+        self._queue.put(event)
 
-    return next(
-        (forecast for forecast in WEATHER_FORECAST if forecast["date"] == date), {}
-    )
+    def _write(self):
+        import json
+        import queue
 
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                event = self._queue.get()
+                if event is None:
+                    break
+                f.write(json.dumps(event, default=str) + "\n")
+                # Flush once the queue is drained rather than after every event
+                try:
+                    while (event := self._queue.get_nowait()) is not None:
+                        f.write(json.dumps(event, default=str) + "\n")
+                except queue.Empty:
+                    f.flush()
+                    continue
+                break
 
-def narrate_my_trip(vacation_info, itinerary, filename="speech.mp3"):
-    from IPython.display import Audio, Markdown, display
-    from openai import OpenAI
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
 
-    resp = do_chat_completion(
-        messages=[
-            {
-                "role": "user",
-                "content": f"""
-                Here is information on the trip collected by the Onboarding Agent:
-                {vacation_info}.
 
-                Here is the final itinerary:
-                {itinerary}
-                
-                Introduce the trip (travelers, interests, restrictions, and total cost) and
-                then discuss each day of the itinerary.
+class ConsoleTraceSink(TraceSink):
+    """Prints each event in a box with `print_in_box`, as the agents always did.
 
-                Do not specify the cost of each activity.
+    Args:
+        cols: The width of the boxes.
+    """
 
-                Do not reference the the narrative itself in the response.
-                """,
-            }
-        ]
-    )
-    display(Markdown(resp))
+    def __init__(self, cols: int = 100):
+        self.cols = cols
 
-    client = OpenAI(
-    base_url="https://openai.vocareum.com/v1",
-    api_key="voc-1528689085160736365463468376c73845a55.15105883",
-    )
+    def emit(self, event):
+        print_in_box(
+            event["content"], title=event["title"], cols=self.cols, tab_level=event["tab_level"]
+        )
 
-    with client.audio.speech.with_streaming_response.create(
-        model="gpt-4o-mini-tts",
-        voice="coral",
-        input=resp,
-        instructions="Speak in a cheerful and positive tone.",
-    ) as response:
-        response.stream_to_file(filename)
 
-    display(Audio(filename))
+_TRACE_SINK: TraceSink = ConsoleTraceSink()
 
 
-# List of available tools and their descriptions
-TOOLS = [
-    {
-        "name": "weather",
-        "description": "Get weather conditions for specific dates and locations",
-        "purpose": "Verify weather compatibility with planned activities",
-        "parameters": '{"tool": "weather", "date": "YYYY-MM-DD", "city": "CityName"}',
+def get_trace_sink() -> TraceSink:
+    """Returns the sink that receives agent traces."""
+    return _TRACE_SINK
+
+
+def set_trace_sink(sink: TraceSink | None) -> TraceSink:
+    """Replaces the trace sink, closing the previous one. None drops all events.
+
+    Returns:
+        TraceSink: The new sink.
+
+    Examples:
+        >>> sink = set_trace_sink(RingBufferTraceSink())
+        >>> trace("ChatAgent", "ChatAgent - User Prompt", "Hello")
+        >>> sink.events[0]["title"], sink.events[0]["content"]
+        ('ChatAgent - User Prompt', 'Hello')
+        >>> _ = set_trace_sink(ConsoleTraceSink())
+    """
+    global _TRACE_SINK
+
+    previous, _TRACE_SINK = _TRACE_SINK, sink or NullTraceSink()
+    if previous is not _TRACE_SINK:
+        previous.close()
+    return _TRACE_SINK
+
+
+def trace(source: str, title: str, content, tab_level: int = 0):
+    """Reports an agent message to the active trace sink.
+
+    Args:
+        source: The name of the agent or component.
+        title: A short description, e.g. "ItineraryAgent - User Prompt".
+        content: The message; any object, formatted only by sinks that need to.
+        tab_level: The indentation level used by the console sink.
+    """
+    sink = _TRACE_SINK
+    if not sink.enabled:
+        return
+    import time
+
+    sink.emit(
+        {
+            "time": time.time(),
+            "source": source,
+            "title": title,
+            "content": content,
+            "tab_level": tab_level,
+        }
+    )
+
+
+DEFAULT_LLM_BASE_URL = "https://openai.vocareum.com/v1"
+DEFAULT_LLM_MODEL = "gpt-4o-mini"
+DEFAULT_TTS_MODEL = "gpt-4o-mini-tts"
+
+
+class LLMConfig:
+    """Connection settings for an LLM backend.
+
+    Every setting can be overridden with an environment variable, see `from_env`.
+
+    Attributes:
+        base_url: The base URL of the OpenAI-compatible API.
+        api_key: The API key sent with every request. There is no default: set
+            the OPENAI_API_KEY environment variable.
+        model: The default chat completion model.
+        tts_model: The default text-to-speech model.
+        timeout: The read timeout of a request, in seconds.
+        connect_timeout: The timeout for establishing a connection, in seconds.
+        max_connections: The size of the HTTP connection pool.
+        max_keepalive_connections: How many idle connections to keep alive.
+        max_retries: How many times a failed request is retried, with backoff.
+        max_concurrency: How many requests may be in flight at once, across
+            threads and event loops (see `LLMScheduler`).
+        requests_per_minute: The request quota of the endpoint, or 0 for none.
+        tokens_per_minute: The token quota of the endpoint, or 0 for none.
+    """
+
+    ENV_VARS = {
+        "base_url": "AGENTSVILLE_LLM_BASE_URL",
+        "api_key": "OPENAI_API_KEY",
+        "model": "AGENTSVILLE_LLM_MODEL",
+        "tts_model": "AGENTSVILLE_TTS_MODEL",
+        "timeout": "AGENTSVILLE_LLM_TIMEOUT",
+        "connect_timeout": "AGENTSVILLE_LLM_CONNECT_TIMEOUT",
+        "max_connections": "AGENTSVILLE_LLM_POOL_SIZE",
+        "max_keepalive_connections": "AGENTSVILLE_LLM_KEEPALIVE",
+        "max_retries": "AGENTSVILLE_LLM_MAX_RETRIES",
+        "max_concurrency": "AGENTSVILLE_LLM_MAX_CONCURRENCY",
+        "requests_per_minute": "AGENTSVILLE_LLM_RPM",
+        "tokens_per_minute": "AGENTSVILLE_LLM_TPM",
+    }
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_LLM_BASE_URL,
+        api_key: str = "",
+        model: str = DEFAULT_LLM_MODEL,
+        tts_model: str = DEFAULT_TTS_MODEL,
+        timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_connections: int = 32,
+        max_keepalive_connections: int = 16,
+        max_retries: int = 4,
+        max_concurrency: int = 16,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.tts_model = tts_model
+        self.timeout = float(timeout)
+        self.connect_timeout = float(connect_timeout)
+        self.max_connections = int(max_connections)
+        self.max_keepalive_connections = int(max_keepalive_connections)
+        self.max_retries = int(max_retries)
+        self.max_concurrency = int(max_concurrency)
+        self.requests_per_minute = float(requests_per_minute)
+        self.tokens_per_minute = float(tokens_per_minute)
+
+    def __repr__(self):
+        return (
+            f"LLMConfig(base_url={self.base_url!r}, model={self.model!r}, "
+            f"timeout={self.timeout}, max_connections={self.max_connections})"
+        )
+
+    @classmethod
+    def from_env(cls, environ=None, **overrides) -> "LLMConfig":
+        """Creates a config from environment variables.
+
+        Args:
+            environ: The mapping to read from. Defaults to os.environ.
+            **overrides: Settings that take precedence over the environment.
+
+        Returns:
+            LLMConfig: The config, with defaults for unset variables.
+
+        Examples:
+            >>> config = LLMConfig.from_env({"AGENTSVILLE_LLM_POOL_SIZE": "4"})
+            >>> config.max_connections, config.model
+            (4, 'gpt-4o-mini')
+        """
+        import os
+
+        environ = os.environ if environ is None else environ
+        kwargs = {
+            field: environ[var] for field, var in cls.ENV_VARS.items() if environ.get(var)
+        }
+        kwargs.update(overrides)
+        return cls(**kwargs)
+
+
+class ChatResult:
+    """The backend-independent result of a chat completion request.
+
+    Attributes:
+        choices: The content of each returned choice.
+        usage: Token counts, e.g. {"prompt_tokens": 10, "completion_tokens": 5}.
+        model: The model that produced the result, if known.
+    """
+
+    __slots__ = ("choices", "usage", "model")
+
+    def __init__(self, choices: list[str], usage: dict | None = None, model=None):
+        self.choices = list(choices)
+        self.usage = dict(usage or {})
+        self.model = model
+
+    @property
+    def content(self) -> str:
+        """The content of the first choice."""
+        return self.choices[0] if self.choices else ""
+
+    def __repr__(self):
+        return f"ChatResult(choices={self.choices!r}, usage={self.usage!r})"
+
+
+class ChatStream:
+    """A chat completion received incrementally.
+
+    Iterating over the stream yields the text chunks as they arrive, and `text`
+    accumulates them. `close` stops the request early, e.g. once enough of
+    the response has been read.
+
+    Args:
+        chunks: An iterable of text chunks. Usage dicts may be interleaved;
+            they are merged into `usage` instead of being yielded.
+        close: Called to stop the underlying request.
+
+    Examples:
+        >>> stream = ChatStream(["Hel", "lo", {"completion_tokens": 2}])
+        >>> list(stream), stream.text, stream.usage, stream.finished
+        (['Hel', 'lo'], 'Hello', {'completion_tokens': 2}, True)
+    """
+
+    def __init__(self, chunks, close=None):
+        self._chunks = iter(chunks)
+        self._close = close
+        self.text = ""
+        self.usage = {}
+        self.finished = False
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if isinstance(chunk, dict):
+                self.usage.update(chunk)
+                continue
+            self.text += chunk
+            yield chunk
+        self.finished = True
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class LLMBackend:
+    """The interface between `do_chat_completion` and an LLM provider.
+
+    Subclasses implement `chat`, and `speech_to_file` if they support
+    text-to-speech. Backends are shared between threads and are expected to
+    hold on to their connections between calls.
+
+    Attributes:
+        supports_n: Whether `chat` can return several choices for one request
+            when called with the `n` parameter.
+    """
+
+    supports_n = False
+
+    def __init__(self, config: LLMConfig | None = None):
+        self.config = config or LLMConfig.from_env()
+
+    def chat(self, messages: list[dict[str, str]], model: str, **kwargs) -> ChatResult:
+        """Runs a chat completion request.
+
+        Args:
+            messages: The messages to send.
+            model: The model to use.
+            **kwargs: Extra request parameters, e.g. temperature.
+
+        Returns:
+            ChatResult: The completion.
+        """
+        raise NotImplementedError
+
+    async def achat(
+        self, messages: list[dict[str, str]], model: str, **kwargs
+    ) -> ChatResult:
+        """Runs a chat completion request without blocking the event loop.
+
+        The default implementation runs `chat` in a worker thread. Backends with
+        a native asyncio client should override it.
+        """
+        import asyncio
+
+        return await asyncio.to_thread(self.chat, messages, model, **kwargs)
+
+    def chat_stream(
+        self, messages: list[dict[str, str]], model: str, **kwargs
+    ) -> ChatStream:
+        """Runs a chat completion request, receiving the response incrementally.
+
+        The default implementation waits for `chat` and returns the whole
+        response as a single chunk. Backends that can stream should override it.
+        """
+        result = self.chat(messages, model, **kwargs)
+        return ChatStream([result.content, result.usage])
+
+    def speech_to_file(self, text: str, filename: str, model: str, **kwargs):
+        """Converts text to speech and saves the audio to a file.
+
+        Args:
+            text: The text to speak.
+            filename: Where to save the audio.
+            model: The text-to-speech model to use.
+            **kwargs: Extra request parameters, e.g. voice and instructions.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support speech")
+
+    def close(self):
+        """Releases any pooled connections held by the backend."""
+
+
+class OpenAIBackend(LLMBackend):
+    """An LLM backend for OpenAI-compatible APIs with a pooled HTTP client.
+
+    A single `openai.OpenAI` client is created on first use and reused for all
+    requests, so connections are kept alive between calls. The pool size and
+    timeouts come from the backend's `LLMConfig`. Async requests use one
+    `openai.AsyncOpenAI` client per event loop, since asyncio connections
+    cannot be shared between loops.
+    """
+
+    supports_n = True
+
+    def __init__(self, config: LLMConfig | None = None):
+        import weakref
+
+        super().__init__(config)
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """The shared `openai.OpenAI` client, created on first access."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._make_client()
+        return self._client
+
+    def _http_client_kwargs(self):
+        import httpx
+
+        config = self.config
+        return {
+            "limits": httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+            ),
+            "timeout": httpx.Timeout(config.timeout, connect=config.connect_timeout),
+        }
+
+    @staticmethod
+    def _count_attempt(request):
+        record_llm_attempt()
+
+    @staticmethod
+    async def _acount_attempt(request):
+        record_llm_attempt()
+
+    def _api_key(self) -> str:
+        if not self.config.api_key:
+            raise ValueError(
+                "No API key is configured for the LLM backend: set the OPENAI_API_KEY "
+                "environment variable, or pass api_key to LLMConfig."
+            )
+        return self.config.api_key
+
+    def _make_client(self):
+        import openai
+
+        return openai.OpenAI(
+            base_url=self.config.base_url,
+            api_key=self._api_key(),
+            # Retries are left to the LLMScheduler, which knows about the shared quota
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(
+                event_hooks={"request": [self._count_attempt]},
+                **self._http_client_kwargs(),
+            ),
+        )
+
+    def _async_client(self):
+        import asyncio
+
+        import openai
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._async_clients.get(loop)
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    base_url=self.config.base_url,
+                    api_key=self._api_key(),
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(
+                        event_hooks={"request": [self._acount_attempt]},
+                        **self._http_client_kwargs(),
+                    ),
+                )
+                self._async_clients[loop] = client
+        return client
+
+    @staticmethod
+    def _to_chat_result(response, model):
+        usage = getattr(response, "usage", None)
+        return ChatResult(
+            [choice.message.content for choice in response.choices],
+            usage=usage.model_dump() if hasattr(usage, "model_dump") else None,
+            model=getattr(response, "model", model),
+        )
+
+    def chat(self, messages, model, **kwargs):
+        response = self.client.chat.completions.create(
+            model=model, messages=messages, **kwargs
+        )
+        return self._to_chat_result(response, model)
+
+    async def achat(self, messages, model, **kwargs):
+        response = await self._async_client().chat.completions.create(
+            model=model, messages=messages, **kwargs
+        )
+        return self._to_chat_result(response, model)
+
+    def chat_stream(self, messages, model, **kwargs):
+        response = self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs,
+        )
+
+        def chunks():
+            for event in response:
+                if getattr(event, "usage", None) is not None:
+                    yield event.usage.model_dump()
+                for choice in event.choices:
+                    if choice.index == 0 and choice.delta.content:
+                        yield choice.delta.content
+
+        # Closing the response drops the connection, which stops the generation
+        return ChatStream(chunks(), close=response.close)
+
+    def speech_to_file(self, text, filename, model, **kwargs):
+        with self.client.audio.speech.with_streaming_response.create(
+            model=model, input=text, **kwargs
+        ) as response:
+            response.stream_to_file(filename)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+            # Async clients are closed with their event loop
+            self._async_clients.clear()
+
+
+class CallableBackend(LLMBackend):
+    """An LLM backend that answers with a Python function, for stubs and tests.
+
+    Args:
+        respond: A function called with (messages, model, **kwargs) that returns
+            either a string, a ChatResult, or an iterator of text chunks to
+            simulate a streamed response.
+        config: Optional config, mainly used for the default model name.
+
+    Examples:
+        >>> backend = CallableBackend(lambda messages, model, **kwargs: "Hi!")
+        >>> backend.chat([{"role": "user", "content": "Hello"}], "stub").content
+        'Hi!'
+    """
+
+    def __init__(self, respond, config: LLMConfig | None = None):
+        super().__init__(config or LLMConfig(api_key=""))
+        self.respond = respond
+
+    def chat(self, messages, model, **kwargs):
+        result = self.respond(messages, model, **kwargs)
+        if isinstance(result, ChatResult):
+            return result
+        if not isinstance(result, str):
+            result = "".join(result)
+        return ChatResult([result], model=model)
+
+    def chat_stream(self, messages, model, **kwargs):
+        result = self.respond(messages, model, **kwargs)
+        if isinstance(result, ChatResult):
+            return ChatStream([result.content, result.usage])
+        if isinstance(result, str):
+            return ChatStream([result])
+        return ChatStream(result, close=getattr(result, "close", None))
+
+
+class CassetteMissError(LookupError):
+    """Raised by a strict `CassetteBackend` for a request it has no recording of."""
+
+
+class CassetteBackend(LLMBackend):
+    """Records LLM requests to a cassette file and replays them offline.
+
+    In "record" mode, requests are sent to the `inner` backend and every
+    request/response pair is appended to the cassette, a JSON Lines file
+    (gzip-compressed if the path ends with ".gz"). Chat completions and
+    text-to-speech audio are both recorded.
+
+    In "replay" mode, responses are served from the cassette. Requests are
+    matched by a hash of their messages, model and parameters. A request
+    recorded several times (e.g. self-consistency samples) replays its
+    responses in the recorded order, then starts over. On a miss, a strict
+    cassette raises `CassetteMissError`; otherwise the request goes to the
+    inner backend and the new pair is recorded.
+
+    Args:
+        path: The cassette file.
+        mode: "record" or "replay".
+        inner: The backend that answers requests that are not replayed.
+            Defaults to an `OpenAIBackend`.
+        strict: In replay mode, whether misses raise instead of going to
+            the inner backend.
+        latency: Artificial latency of replayed responses: None for none, a
+            number of seconds, or "recorded" for the latency measured when
+            recording.
+        latency_scale: Multiplies the artificial latency.
+
+    Examples:
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "run.jsonl")
+        >>> live = CallableBackend(lambda messages, model, **kwargs: "Sunny!")
+        >>> recorder = CassetteBackend(path, mode="record", inner=live)
+        >>> recorder.chat([{"role": "user", "content": "Weather?"}], "stub").content
+        'Sunny!'
+        >>> player = CassetteBackend(path, mode="replay")
+        >>> player.chat([{"role": "user", "content": "Weather?"}], "stub").content
+        'Sunny!'
+        >>> player.chat([{"role": "user", "content": "Events?"}], "stub")  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        project_lib.CassetteMissError: No recording of chat request ...
+    """
+
+    def __init__(
+        self,
+        path,
+        mode: str = "replay",
+        inner: LLMBackend | None = None,
+        strict: bool = True,
+        latency: float | str | None = None,
+        latency_scale: float = 1.0,
+        config: LLMConfig | None = None,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self._inner = inner
+        super().__init__(config or (inner.config if inner is not None else None))
+        self.path = str(path)
+        self.mode = mode
+        self.strict = strict
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.supports_n = inner.supports_n if inner is not None else False
+        self._entries: dict[str, list[dict]] = {}
+        self._positions: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if mode == "record":
+            # Start a new cassette
+            with self._open("w"):
+                pass
+        else:
+            self._load()
+
+    @property
+    def inner(self) -> LLMBackend:
+        if self._inner is None:
+            self._inner = OpenAIBackend(self.config)
+        return self._inner
+
+    def _open(self, mode):
+        import gzip
+
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, mode + "t", encoding="utf-8")
+        return open(self.path, mode, encoding="utf-8")
+
+    def _load(self):
+        import json
+        import os
+
+        if not os.path.exists(self.path):
+            return
+        with self._open("r") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+
+    def _append(self, entry: dict):
+        import json
+
+        with self._lock:
+            self._entries.setdefault(entry["key"], []).append(entry)
+            with self._open("a") as f:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _next_entry(self, key: str) -> dict | None:
+        with self._lock:
+            entries = self._entries.get(key)
+            if self.mode == "record" or not entries:
+                self.misses += 1
+                return None
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            self.hits += 1
+            return entries[position % len(entries)]
+
+    def _replay_delay(self, entry: dict) -> float:
+        if self.latency is None:
+            return 0.0
+        if self.latency == "recorded":
+            return entry.get("latency", 0.0) * self.latency_scale
+        return float(self.latency) * self.latency_scale
+
+    def _miss(self, kind: str):
+        if self.mode == "replay" and self.strict:
+            raise CassetteMissError(f"No recording of {kind} request in {self.path}")
+
+    @staticmethod
+    def _chat_key(messages, model, kwargs):
+        return ResponseCache.make_key(messages, model, dict(kwargs, _kind="chat"))
+
+    @staticmethod
+    def _chat_entry(key, result: ChatResult, latency: float) -> dict:
+        return {
+            "kind": "chat",
+            "key": key,
+            "choices": result.choices,
+            "usage": result.usage,
+            "model": result.model,
+            "latency": round(latency, 4),
+        }
+
+    @staticmethod
+    def _chat_result(entry: dict) -> ChatResult:
+        return ChatResult(entry["choices"], usage=entry.get("usage"), model=entry.get("model"))
+
+    def chat(self, messages, model, **kwargs):
+        import time
+
+        key = self._chat_key(messages, model, kwargs)
+        entry = self._next_entry(key)
+        if entry is not None:
+            time.sleep(self._replay_delay(entry))
+            return self._chat_result(entry)
+
+        self._miss("chat")
+        start = time.perf_counter()
+        result = self.inner.chat(messages, model, **kwargs)
+        self._append(self._chat_entry(key, result, time.perf_counter() - start))
+        return result
+
+    async def achat(self, messages, model, **kwargs):
+        import asyncio
+        import time
+
+        key = self._chat_key(messages, model, kwargs)
+        entry = self._next_entry(key)
+        if entry is not None:
+            await asyncio.sleep(self._replay_delay(entry))
+            return self._chat_result(entry)
+
+        self._miss("chat")
+        start = time.perf_counter()
+        result = await self.inner.achat(messages, model, **kwargs)
+        self._append(self._chat_entry(key, result, time.perf_counter() - start))
+        return result
+
+    def speech_to_file(self, text, filename, model, **kwargs):
+        import base64
+        import time
+
+        key = ResponseCache.make_key(
+            [{"role": "user", "content": text}], model, dict(kwargs, _kind="speech")
+        )
+        entry = self._next_entry(key)
+        if entry is not None:
+            time.sleep(self._replay_delay(entry))
+            with open(filename, "wb") as f:
+                f.write(base64.b64decode(entry["audio"]))
+            return
+
+        self._miss("speech")
+        start = time.perf_counter()
+        self.inner.speech_to_file(text, filename, model, **kwargs)
+        latency = time.perf_counter() - start
+        with open(filename, "rb") as f:
+            audio = base64.b64encode(f.read()).decode("ascii")
+        self._append(
+            {"kind": "speech", "key": key, "audio": audio, "latency": round(latency, 4)}
+        )
+
+    def close(self):
+        if self._inner is not None:
+            self._inner.close()
+
+
+_LLM_BACKENDS: dict[str, LLMBackend] = {}
+_DEFAULT_LLM_BACKEND = "default"
+_LLM_REGISTRY_LOCK = threading.RLock()
+
+
+def register_llm_backend(name: str, backend: LLMBackend, make_default: bool = False):
+    """Registers an LLM backend under a name.
+
+    Args:
+        name: The name of the backend, e.g. "default" or "stub".
+        backend: The backend instance. It is shared by all callers.
+        make_default: Whether `do_chat_completion` should use this backend by default.
+    """
+    global _DEFAULT_LLM_BACKEND
+
+    with _LLM_REGISTRY_LOCK:
+        previous = _LLM_BACKENDS.get(name)
+        _LLM_BACKENDS[name] = backend
+        if make_default:
+            _DEFAULT_LLM_BACKEND = name
+    if previous is not None and previous is not backend:
+        previous.close()
+
+
+def get_llm_backend(name: str | None = None) -> LLMBackend:
+    """Returns a registered LLM backend.
+
+    The "default" backend is created on first use as an `OpenAIBackend`
+    configured from the environment (see `LLMConfig.from_env`).
+
+    Args:
+        name: The backend name. Defaults to the current default backend.
+
+    Returns:
+        LLMBackend: The backend.
+
+    Raises:
+        KeyError: If no backend is registered under the name.
+    """
+    with _LLM_REGISTRY_LOCK:
+        name = name or _DEFAULT_LLM_BACKEND
+        if name not in _LLM_BACKENDS and name == "default":
+            _LLM_BACKENDS[name] = OpenAIBackend(LLMConfig.from_env())
+        return _LLM_BACKENDS[name]
+
+
+def set_default_llm_backend(name: str):
+    """Makes the named, registered backend the default for `do_chat_completion`."""
+    global _DEFAULT_LLM_BACKEND
+
+    with _LLM_REGISTRY_LOCK:
+        if name not in _LLM_BACKENDS and name != "default":
+            raise KeyError(f"No LLM backend registered under {name!r}")
+        _DEFAULT_LLM_BACKEND = name
+
+
+def use_cassette(path, mode: str = "replay", **kwargs) -> "CassetteBackend":
+    """Makes a `CassetteBackend` the default backend.
+
+    Unless `inner` is given, the cassette wraps the current default backend,
+    so recording captures exactly what the pipeline would have sent.
+
+    Args:
+        path: The cassette file.
+        mode: "record" or "replay".
+        **kwargs: Other `CassetteBackend` arguments, e.g. strict or latency.
+
+    Returns:
+        CassetteBackend: The cassette, registered as "cassette".
+    """
+    kwargs.setdefault("inner", get_llm_backend())
+    cassette = CassetteBackend(path, mode=mode, **kwargs)
+    register_llm_backend("cassette", cassette, make_default=True)
+    return cassette
+
+
+def close_llm_backends():
+    """Closes and unregisters all LLM backends, and restores the default backend."""
+    global _DEFAULT_LLM_BACKEND
+
+    with _LLM_REGISTRY_LOCK:
+        backends = list(_LLM_BACKENDS.values())
+        _LLM_BACKENDS.clear()
+        _DEFAULT_LLM_BACKEND = "default"
+    for backend in backends:
+        backend.close()
+
+
+class ResponseCache:
+    """A content-addressed cache of chat completion results.
+
+    Results are keyed on a SHA-256 hash of the canonical JSON of the messages,
+    the model and the request parameters. Lookups go to an in-memory LRU first
+    and then, if a path is given, to an on-disk SQLite tier that survives
+    restarts. Both tiers evict by age (`ttl`) and by size.
+
+    Requests with a non-zero temperature are not cached unless
+    `cache_nonzero_temperature` is set, since their responses are meant to vary.
+    A request without a temperature uses the provider default of 1.0. With
+    `cache_nonzero_temperature`, identical requests all get the same answer, so
+    callers that sample the same messages several times must pass `cache=False`.
+
+    Attributes:
+        hits: Number of lookups served from either tier.
+        misses: Number of lookups not found in the cache.
+        memory_hits: Number of hits served from the in-memory LRU.
+        disk_hits: Number of hits served from SQLite.
+        bypasses: Number of requests that skipped the cache.
+
+    Examples:
+        >>> cache = ResponseCache(max_memory_entries=2)
+        >>> key = cache.make_key([{"role": "user", "content": "Hi"}], "m", {"temperature": 0})
+        >>> cache.get(key) is None
+        True
+        >>> cache.set(key, ChatResult(["Hello"]))
+        >>> cache.get(key).content
+        'Hello'
+        >>> cache.stats()["hits"], cache.stats()["misses"]
+        (1, 1)
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 100_000,
+        ttl: float | None = None,
+        cache_nonzero_temperature: bool = False,
+    ):
+        import collections
+        import sqlite3
+
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl = ttl
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.bypasses = 0
+
+        # key -> (created_at, ChatResult), least recently used first
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_accessed_at"
+                " ON responses (accessed_at)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def make_key(messages: list[dict[str, str]], model: str, kwargs: dict) -> str:
+        """Returns the content hash identifying a request."""
+        import hashlib
+        import json
+
+        payload = json.dumps(
+            {"messages": messages, "model": model, "kwargs": kwargs},
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, kwargs: dict) -> bool:
+        """Returns True if a request with these parameters may be cached."""
+        if kwargs.get("stream"):
+            return False
+        if self.cache_nonzero_temperature:
+            return True
+        return kwargs.get("temperature", 1.0) == 0
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key: str) -> "ChatResult | None":
+        """Looks up a result, returning None on a miss."""
+        import json
+        import time
+
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, result = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return result
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._db.execute(
+                            "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                            (now, key),
+                        )
+                        self._db.commit()
+                        result = ChatResult(**json.loads(value))
+                        self._remember(key, created_at, result)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return result
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, result: "ChatResult"):
+        """Stores a result in both tiers."""
+        import json
+        import time
+
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, result)
+            if self._db is not None:
+                value = json.dumps(
+                    {"choices": result.choices, "usage": result.usage, "model": result.model}
+                )
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, value, now, now),
+                )
+                self._evict_disk(now)
+                self._db.commit()
+
+    def _remember(self, key, created_at, result):
+        self._memory[key] = (created_at, result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            self._db.execute(
+                "DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)
+            )
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        if count > self.max_disk_entries:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_disk_entries,),
+            )
+
+    def clear(self):
+        """Removes all entries from both tiers. Counters are left untouched."""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self) -> dict[str, int | float]:
+        """Returns the hit/miss counters and the hit rate."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "bypasses": self.bypasses,
+            "memory_entries": len(self._memory),
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """Closes the SQLite connection, if any."""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_RESPONSE_CACHE: ResponseCache | None = None
+
+
+def configure_response_cache(path: str | None = None, **kwargs) -> ResponseCache:
+    """Enables the response cache used by `do_chat_completion`.
+
+    Args:
+        path: Optional path of the SQLite file for the on-disk tier.
+        **kwargs: Other `ResponseCache` arguments, e.g. ttl or
+            cache_nonzero_temperature.
+
+    Returns:
+        ResponseCache: The new cache. Any previous cache is closed.
+    """
+    global _RESPONSE_CACHE
+
+    previous, _RESPONSE_CACHE = _RESPONSE_CACHE, ResponseCache(path=path, **kwargs)
+    if previous is not None:
+        previous.close()
+    return _RESPONSE_CACHE
+
+
+def get_response_cache() -> ResponseCache | None:
+    """Returns the response cache used by `do_chat_completion`, or None if disabled."""
+    return _RESPONSE_CACHE
+
+
+def disable_response_cache():
+    """Disables and closes the response cache used by `do_chat_completion`."""
+    global _RESPONSE_CACHE
+
+    previous, _RESPONSE_CACHE = _RESPONSE_CACHE, None
+    if previous is not None:
+        previous.close()
+
+
+class Histogram:
+    """A cumulative histogram with fixed bucket upper bounds, as in Prometheus.
+
+    Examples:
+        >>> histogram = Histogram((1, 5))
+        >>> for value in (0.5, 2, 10):
+        ...     histogram.observe(value)
+        >>> histogram.to_dict()
+        {'buckets': {'1': 1, '5': 2, '+Inf': 3}, 'count': 3, 'sum': 12.5}
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * len(self.bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        import bisect
+
+        idx = bisect.bisect_left(self.bounds, value)
+        if idx < len(self.counts):
+            self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """Returns (upper bound, observations at or below it) pairs, ending with +Inf."""
+        pairs = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            pairs.append((f"{bound:g}", total))
+        pairs.append(("+Inf", self.count))
+        return pairs
+
+    def to_dict(self) -> dict:
+        return {"buckets": dict(self.cumulative()), "count": self.count, "sum": self.sum}
+
+
+class TokenBucket:
+    """A token bucket refilled continuously, for requests- or tokens-per-minute limits.
+
+    The bucket starts full. `take` may overdraw it, e.g. when a response used
+    more tokens than estimated; the debt is paid back by the refill.
+
+    Args:
+        capacity: How many units the bucket holds, i.e. the burst size.
+        per_seconds: How long it takes to refill an empty bucket.
+
+    Examples:
+        >>> bucket = TokenBucket(60)
+        >>> bucket.time_until(60)
+        0.0
+        >>> bucket.take(60)
+        >>> round(bucket.time_until(30))
+        30
+    """
+
+    __slots__ = ("capacity", "rate", "level", "updated")
+
+    def __init__(self, capacity: float, per_seconds: float = 60.0):
+        import time
+
+        self.capacity = float(capacity)
+        self.rate = self.capacity / per_seconds
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        import time
+
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        """Returns how many seconds until `amount` units are available.
+
+        Amounts larger than the capacity only wait for a full bucket.
+        """
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def give(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+LLM_PRIORITIES = {"interactive": 0, "normal": 1, "bulk": 2}
+
+_LLM_PRIORITY = contextvars.ContextVar("llm_priority", default="normal")
+
+
+@contextlib.contextmanager
+def llm_priority(priority: str):
+    """Sets the scheduling priority of the LLM calls made inside the block.
+
+    Priorities are "interactive" (agent responses a user waits for),
+    "normal" and "bulk" (e.g. eval judgments). Waiting interactive calls are
+    always admitted before waiting bulk calls, see `LLMScheduler`.
+
+    Examples:
+        >>> with llm_priority("bulk"):
+        ...     current_llm_priority()
+        'bulk'
+        >>> current_llm_priority()
+        'normal'
+    """
+    if priority not in LLM_PRIORITIES:
+        raise ValueError(f"Unknown LLM priority {priority!r}, expected one of {list(LLM_PRIORITIES)}")
+    token = _LLM_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _LLM_PRIORITY.reset(token)
+
+
+def current_llm_priority() -> str:
+    """Returns the scheduling priority of LLM calls made in the current context."""
+    return _LLM_PRIORITY.get()
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+    """Reads the delay requested by the server in the headers of a failed response.
+
+    Understands `retry-after-ms`, and `retry-after` as seconds or as an HTTP date.
+
+    Examples:
+        >>> class Response:
+        ...     headers = {"retry-after": "2"}
+        >>> class RateLimitError(Exception):
+        ...     response = Response()
+        >>> retry_after_seconds(RateLimitError())
+        2.0
+        >>> retry_after_seconds(ValueError()) is None
+        True
+    """
+    import email.utils
+    import time
+
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+            return max(0.0, retry_at - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_code(exc: BaseException) -> int | None:
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable_llm_error(exc: BaseException) -> bool:
+    """Tells whether a failed LLM request is worth retrying.
+
+    Rate limits (429), timeouts (408), conflicts (409), server errors (5xx)
+    and connection errors are retryable; other client errors are not.
+
+    Examples:
+        >>> class APIStatusError(Exception):
+        ...     def __init__(self, status_code):
+        ...         self.status_code = status_code
+        >>> is_retryable_llm_error(APIStatusError(429)), is_retryable_llm_error(APIStatusError(400))
+        (True, False)
+        >>> is_retryable_llm_error(ConnectionResetError())
+        True
+    """
+    status = _status_code(exc)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    # openai.APIConnectionError and its subclass APITimeoutError
+    return any(cls.__name__ == "APIConnectionError" for cls in type(exc).__mro__)
+
+
+# Returned by LLMScheduler._try_admit_head once the waiter has been admitted
+_ADMITTED = object()
+
+
+class _Waiter:
+    """A request waiting for admission: a thread's Event or a coroutine's future."""
+
+    __slots__ = ("key", "priority", "tokens", "event", "loop", "future")
+
+    def __init__(self, key, priority, tokens, loop=None):
+        self.key = key
+        self.priority = priority
+        self.tokens = tokens
+        self.loop = loop
+        self.event = None if loop is not None else threading.Event()
+        self.future = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        elif self.future is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(_wake_future, self.future)
+
+
+def _wake_future(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class LLMScheduler:
+    """Admits LLM requests under a shared quota, by priority, and retries them.
+
+    A request is admitted once a concurrency slot is free and the
+    requests-per-minute and tokens-per-minute buckets hold enough for it. The
+    token cost is estimated before sending (see `estimate_request_tokens`) and
+    reconciled with the reported usage when the request finishes. Waiting
+    requests are admitted strictly by priority (see `llm_priority`), then in
+    FIFO order, so bulk eval judgments never delay an interactive step.
+
+    Like the `asyncio.Semaphore` it replaces, the scheduler is not bound to an
+    event loop: the same quota applies to `do_chat_completion` calls from
+    worker threads and to `ado_chat_completion` calls from any event loop.
+
+    Failed requests that are retryable (see `is_retryable_llm_error`) are
+    retried up to `max_retries` times with jittered exponential backoff, or
+    after the delay the server asks for in a retry-after header. A rate limit
+    response (429) also pauses all admissions for that delay, so concurrent
+    callers do not stampede the endpoint.
+
+    Args:
+        max_concurrency: How many requests may be in flight at once.
+        requests_per_minute: The request quota, or 0 for none.
+        tokens_per_minute: The token quota, or 0 for none.
+        max_retries: How many times a failed request is retried.
+        base_delay: The backoff before the first retry, in seconds; it doubles
+            with every retry.
+        max_delay: The longest backoff, in seconds. Requests the server asks to
+            delay longer are not retried.
+
+    Examples:
+        >>> scheduler = LLMScheduler(1, requests_per_minute=600)
+        >>> with scheduler.slot(tokens=100):
+        ...     scheduler.stats()["in_flight"]
+        1
+        >>> attempts = []
+        >>> def flaky():
+        ...     attempts.append(1)
+        ...     if len(attempts) < 3:
+        ...         raise ConnectionResetError()
+        ...     return "ok"
+        >>> scheduler.base_delay = 0.001
+        >>> scheduler.call(flaky), len(attempts), scheduler.stats()["retries"]
+        ('ok', 3, 2)
+    """
+
+    WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 60.0,
+    ):
+        import itertools
+
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._waiters = []  # a heap of _Waiter, ordered by (priority, arrival)
+        self._arrivals = itertools.count()
+        self._wait_seconds = {name: Histogram(self.WAIT_BUCKETS) for name in LLM_PRIORITIES}
+        self._counters = {"admitted": 0, "retries": 0, "rate_limited": 0, "backoff_seconds": 0.0}
+
+    @staticmethod
+    def _priority(priority: str | None) -> str:
+        priority = priority or current_llm_priority()
+        if priority not in LLM_PRIORITIES:
+            raise ValueError(f"Unknown LLM priority {priority!r}")
+        return priority
+
+    def _admission_delay(self, tokens: int) -> float | None:
+        """Returns 0 if a request can be admitted now, else how long to wait (None: until woken)."""
+        import time
+
+        if self.in_flight >= self.max_concurrency:
+            return None
+        delay = self._paused_until - time.monotonic()
+        if self._requests is not None:
+            delay = max(delay, self._requests.time_until(1))
+        if self._tokens is not None:
+            delay = max(delay, self._tokens.time_until(tokens))
+        return max(0.0, delay)
+
+    def _admit(self, tokens: int):
+        self.in_flight += 1
+        self._counters["admitted"] += 1
+        if self._requests is not None:
+            self._requests.take(1)
+        if self._tokens is not None:
+            self._tokens.take(tokens)
+
+    def _try_admit_head(self, waiter: "_Waiter"):
+        """Admits `waiter` if it is first in line and the quota allows it.
+
+        Must be called with the lock held.
+
+        Returns:
+            `_ADMITTED` once admitted. Otherwise the longest time in seconds to
+            wait before trying again, or None to wait until woken, which is the
+            case while `waiter` is not first in line.
+        """
+        import heapq
+
+        if self._waiters[0] is not waiter:
+            return None
+        delay = self._admission_delay(waiter.tokens)
+        if delay is None or delay > 0:
+            return delay
+        heapq.heappop(self._waiters)
+        self._admit(waiter.tokens)
+        # The next request in line may fit too
+        if self._waiters:
+            self._waiters[0].wake()
+        return _ADMITTED
+
+    def _enqueue(self, tokens, priority, loop=None):
+        import heapq
+
+        key = (LLM_PRIORITIES[priority], next(self._arrivals))
+        waiter = _Waiter(key, priority, tokens, loop)
+        heapq.heappush(self._waiters, waiter)
+        return waiter
+
+    def _abandon(self, waiter: "_Waiter"):
+        import heapq
+
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+                if self._waiters:
+                    self._waiters[0].wake()
+
+    def _observe_wait(self, priority, started):
+        import time
+
+        with self._lock:
+            self._wait_seconds[priority].observe(time.monotonic() - started)
+
+    def acquire(self, tokens: int = 0, priority: str | None = None):
+        """Blocks the current thread until the request is admitted.
+
+        Args:
+            tokens: The estimated tokens of the request.
+            priority: The priority, by default the one set with `llm_priority`.
+        """
+        import time
+
+        priority = self._priority(priority)
+        started = time.monotonic()
+        with self._lock:
+            if not self._waiters and self._admission_delay(tokens) == 0:
+                self._admit(tokens)
+                self._wait_seconds[priority].observe(0.0)
+                return
+            waiter = self._enqueue(tokens, priority)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._try_admit_head(waiter)
+                    if delay is _ADMITTED:
+                        break
+                    waiter.event.clear()
+                waiter.event.wait(delay)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        self._observe_wait(priority, started)
+
+    async def aacquire(self, tokens: int = 0, priority: str | None = None):
+        """Waits, without blocking the event loop, until the request is admitted."""
+        import asyncio
+        import time
+
+        priority = self._priority(priority)
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._admission_delay(tokens) == 0:
+                self._admit(tokens)
+                self._wait_seconds[priority].observe(0.0)
+                return
+            waiter = self._enqueue(tokens, priority, loop)
+        try:
+            while True:
+                with self._lock:
+                    delay = self._try_admit_head(waiter)
+                    if delay is _ADMITTED:
+                        break
+                    waiter.future = loop.create_future()
+                await asyncio.wait([waiter.future], timeout=delay)
+        except BaseException:
+            self._abandon(waiter)
+            raise
+        self._observe_wait(priority, started)
+
+    def release(self, tokens: int = 0, used_tokens: int | None = None):
+        """Frees the slot of a finished request and settles its token estimate.
+
+        Args:
+            tokens: The estimate the request was admitted with.
+            used_tokens: The tokens the request actually used, if known.
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if self._tokens is not None and used_tokens is not None:
+                if used_tokens > tokens:
+                    self._tokens.take(used_tokens - tokens)
+                else:
+                    self._tokens.give(tokens - used_tokens)
+            if self._waiters:
+                self._waiters[0].wake()
+
+    @contextlib.contextmanager
+    def slot(self, tokens: int = 0, priority: str | None = None):
+        """Holds an admitted slot for the duration of the block, without retries."""
+        self.acquire(tokens, priority)
+        try:
+            yield self
+        finally:
+            self.release(tokens)
+
+    def retry_delay(self, exc: BaseException, attempt: int) -> float | None:
+        """Returns how long to wait before retrying a failed request, or None to give up.
+
+        Args:
+            exc: The error of the failed attempt.
+            attempt: How many attempts failed so far.
+        """
+        import random
+        import time
+
+        if attempt > self.max_retries or not is_retryable_llm_error(exc):
+            return None
+        retry_after = retry_after_seconds(exc)
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            # A little jitter keeps callers told the same delay from retrying in lockstep
+            delay = retry_after + random.uniform(0, self.base_delay)
+        else:
+            # "Full jitter": a uniform delay up to the exponential backoff
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        with self._lock:
+            self._counters["retries"] += 1
+            self._counters["backoff_seconds"] += delay
+            if _status_code(exc) == 429:
+                self._counters["rate_limited"] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    def call(
+        self, fn, tokens: int = 0, priority: str | None = None, usage=None,
+        on_attempt=None, keep_slot: bool = False,
+    ):
+        """Runs `fn()` once admitted, retrying it with backoff if it fails.
+
+        Args:
+            fn: The request to send.
+            tokens: The estimated tokens of the request.
+            priority: The priority, by default the one set with `llm_priority`.
+            usage: Called with the result, returns the tokens it used (or None).
+            on_attempt: Called right before every attempt is sent.
+            keep_slot: Whether to keep the slot after a successful attempt, e.g.
+                while a stream is read. The caller must then `release` it.
+
+        Returns:
+            The result of `fn`.
+        """
+        import time
+
+        attempt = 0
+        while True:
+            self.acquire(tokens, priority)
+            try:
+                if on_attempt is not None:
+                    on_attempt()
+                result = fn()
+            except Exception as e:
+                self.release(tokens)
+                attempt += 1
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            except BaseException:
+                self.release(tokens)
+                raise
+            else:
+                if not keep_slot:
+                    self.release(tokens, usage(result) if usage is not None else None)
+                return result
+            time.sleep(delay)
+
+    async def acall(self, fn, tokens: int = 0, priority: str | None = None, usage=None, on_attempt=None):
+        """The asyncio counterpart of `call`, for a coroutine function `fn`."""
+        import asyncio
+
+        attempt = 0
+        while True:
+            await self.aacquire(tokens, priority)
+            try:
+                if on_attempt is not None:
+                    on_attempt()
+                result = await fn()
+            except Exception as e:
+                self.release(tokens)
+                attempt += 1
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            except BaseException:
+                self.release(tokens)
+                raise
+            else:
+                self.release(tokens, usage(result) if usage is not None else None)
+                return result
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        """Returns the queue depth and wait times per priority, and the retry counters.
+
+        Examples:
+            >>> stats = LLMScheduler(2).stats()
+            >>> stats["queued"], stats["in_flight"]
+            ({'interactive': 0, 'normal': 0, 'bulk': 0}, 0)
+        """
+        with self._lock:
+            queued = dict.fromkeys(LLM_PRIORITIES, 0)
+            for waiter in self._waiters:
+                queued[waiter.priority] += 1
+            return {
+                "in_flight": self.in_flight,
+                "queued": queued,
+                "wait_seconds": {name: h.to_dict() for name, h in self._wait_seconds.items()},
+                **self._counters,
+            }
+
+
+_LLM_SCHEDULER: LLMScheduler | None = None
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """Returns the scheduler shared by all LLM requests.
+
+    It is created on first use from `LLMConfig.from_env()`: `max_concurrency`,
+    `requests_per_minute`, `tokens_per_minute` and `max_retries`.
+    """
+    global _LLM_SCHEDULER
+
+    with _LLM_REGISTRY_LOCK:
+        if _LLM_SCHEDULER is None:
+            config = LLMConfig.from_env()
+            _LLM_SCHEDULER = LLMScheduler(
+                config.max_concurrency,
+                requests_per_minute=config.requests_per_minute,
+                tokens_per_minute=config.tokens_per_minute,
+                max_retries=config.max_retries,
+            )
+        return _LLM_SCHEDULER
+
+
+def configure_llm_scheduler(**kwargs) -> LLMScheduler:
+    """Replaces the shared scheduler; kwargs are passed to `LLMScheduler`.
+
+    Settings not given are kept from the current scheduler. Requests already
+    waiting on the previous scheduler are not affected.
+
+    Examples:
+        >>> previous = get_llm_scheduler()
+        >>> configure_llm_scheduler(tokens_per_minute=200_000).max_concurrency == previous.max_concurrency
+        True
+        >>> _ = configure_llm_scheduler(tokens_per_minute=previous.tokens_per_minute)
+    """
+    global _LLM_SCHEDULER
+
+    current = get_llm_scheduler()
+    settings = {
+        "max_concurrency": current.max_concurrency,
+        "requests_per_minute": current.requests_per_minute,
+        "tokens_per_minute": current.tokens_per_minute,
+        "max_retries": current.max_retries,
+        "base_delay": current.base_delay,
+        "max_delay": current.max_delay,
+    }
+    settings.update(kwargs)
+    with _LLM_REGISTRY_LOCK:
+        _LLM_SCHEDULER = LLMScheduler(**settings)
+        return _LLM_SCHEDULER
+
+
+def _install_llm_scheduler(scheduler: LLMScheduler | None) -> LLMScheduler | None:
+    """Makes `scheduler` the shared scheduler, and returns the previous one, to restore it."""
+    global _LLM_SCHEDULER
+
+    with _LLM_REGISTRY_LOCK:
+        previous, _LLM_SCHEDULER = _LLM_SCHEDULER, scheduler
+        return previous
+
+
+def set_llm_concurrency(max_concurrency: int):
+    """Replaces the shared scheduler with one allowing `max_concurrency` requests.
+
+    The rate limits and retry settings are kept. Requests already waiting on
+    the previous scheduler are not affected.
+    """
+    configure_llm_scheduler(max_concurrency=max_concurrency)
+
+
+class Span:
+    """A timed unit of work, such as a planning session, a ReAct step or an LLM call.
+
+    Spans nest through a context variable: a span entered while another one is
+    active becomes its child, also in threads started with `run_concurrently`.
+    Use `span` to create one. The attributes of a span and its ancestors are
+    the tags of the LLM calls made inside it (see `Span.tags`).
+
+    Attributes:
+        name: What the span measures.
+        attributes: Tags, e.g. {"agent": "ItineraryAgent", "step": 3}.
+        parent: The enclosing span, if any.
+        children: The spans started inside this one.
+        start: The `time.perf_counter` value when the span started.
+        end: The value when it ended, or None while it is running.
+    """
+
+    __slots__ = ("name", "attributes", "parent", "children", "start", "end", "_token")
+
+    def __init__(self, name: str, attributes: dict | None = None, parent=None):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.children = []
+        self.start = None
+        self.end = None
+        self._token = None
+
+    def __enter__(self):
+        import time
+
+        self.start = time.perf_counter()
+        if self.parent is not None:
+            self.parent.children.append(self)
+        else:
+            get_llm_metrics().add_root_span(self)
+        self._token = _CURRENT_SPAN.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        import time
+
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes.setdefault("error", exc_type.__name__)
+        _CURRENT_SPAN.reset(self._token)
+        return False
+
+    @property
+    def duration(self) -> float | None:
+        if self.start is None:
+            return None
+        import time
+
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def tags(self) -> dict:
+        """The attributes of this span and its ancestors; the innermost value wins."""
+        chain = []
+        node = self
+        while node is not None:
+            chain.append(node)
+            node = node.parent
+        tags = {}
+        for node in reversed(chain):
+            tags.update(node.attributes)
+        return tags
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "duration": self.duration,
+            "children": [child.to_dict() for child in self.children],
+        }
+
+    def timeline(self) -> list[dict]:
+        """Flattens the span tree into rows, for a timeline of a full run.
+
+        Each row has the span's name, depth, start offset from this span and
+        duration in seconds, and its attributes.
+
+        Examples:
+            >>> with span("session", agent="ItineraryAgent") as session:
+            ...     with span("react_step", step=1):
+            ...         pass
+            >>> [(row["name"], row["depth"], row.get("step")) for row in session.timeline()]
+            [('session', 0, None), ('react_step', 1, 1)]
+        """
+        rows = []
+
+        def visit(node, depth):
+            rows.append(
+                {
+                    "name": node.name,
+                    "depth": depth,
+                    "offset": node.start - self.start,
+                    "duration": node.duration,
+                    **node.attributes,
+                }
+            )
+            for child in list(node.children):
+                visit(child, depth + 1)
+
+        visit(self, 0)
+        return rows
+
+    def __repr__(self):
+        return f"Span({self.name!r}, {self.attributes!r})"
+
+
+_CURRENT_SPAN = contextvars.ContextVar("llm_span", default=None)
+# Number of HTTP attempts of the LLM call running in the current context
+_LLM_ATTEMPTS = contextvars.ContextVar("llm_attempts", default=None)
+
+
+def span(name: str, **attributes) -> Span:
+    """Starts a span as a child of the active one; use it as a context manager.
+
+    Examples:
+        >>> with span("react_step", agent="ItineraryAgent", step=2) as step:
+        ...     current_span() is step
+        True
+    """
+    return Span(name, attributes, parent=_CURRENT_SPAN.get())
+
+
+def current_span() -> Span | None:
+    """Returns the active span, if any."""
+    return _CURRENT_SPAN.get()
+
+
+def record_llm_attempt():
+    """Counts one HTTP attempt of the LLM call running in the current context.
+
+    Backends call it for every request they send, so that the metrics can
+    report retries (attempts beyond the first).
+    """
+    attempts = _LLM_ATTEMPTS.get()
+    if attempts is not None:
+        attempts[0] += 1
+
+
+class LLMMetrics:
+    """Aggregates LLM call metrics and keeps recent spans for timelines.
+
+    Every chat completion made through `do_chat_completion` and friends is
+    recorded with its latency, time spent waiting for admission (see
+    `LLMScheduler`), token
+    usage (prompt, completion and cached prompt tokens) and retries. Calls are
+    aggregated into series by model and by the `agent` and `eval_function`
+    tags of the enclosing spans. The ReAct step and any other tags are kept on
+    the call's span.
+
+    Args:
+        latency_buckets: Histogram bounds for latencies, in seconds.
+        token_buckets: Histogram bounds for prompt tokens per call.
+        max_root_spans: How many top-level spans (e.g. planning sessions) to keep.
+
+    Examples:
+        >>> metrics = LLMMetrics()
+        >>> metrics.record_call(
+        ...     {"agent": "ItineraryAgent", "step": 1}, "gpt-4o-mini", latency=0.4,
+        ...     usage={"prompt_tokens": 120, "completion_tokens": 30,
+        ...            "prompt_tokens_details": {"cached_tokens": 64}},
+        ... )
+        >>> series = metrics.snapshot()["series"][0]
+        >>> series["labels"], series["prompt_tokens"], series["cached_tokens"]
+        ({'agent': 'ItineraryAgent', 'eval_function': '', 'model': 'gpt-4o-mini'}, 120, 64)
+        >>> print(metrics.to_prometheus().splitlines()[2])
+        agentsville_llm_calls_total{agent="ItineraryAgent",eval_function="",model="gpt-4o-mini"} 1
+    """
+
+    LABELS = ("agent", "eval_function", "model")
+    DEFAULT_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    DEFAULT_TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+    def __init__(
+        self,
+        latency_buckets=DEFAULT_LATENCY_BUCKETS,
+        token_buckets=DEFAULT_TOKEN_BUCKETS,
+        max_root_spans: int = 100,
+    ):
+        import collections
+
+        self.latency_buckets = latency_buckets
+        self.token_buckets = token_buckets
+        self.root_spans = collections.deque(maxlen=max_root_spans)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def add_root_span(self, root: Span):
+        with self._lock:
+            self.root_spans.append(root)
+
+    def _get_series(self, labels: tuple) -> dict:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = {
+                "calls": 0,
+                "cache_hits": 0,
+                "errors": 0,
+                "retries": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "cached_tokens": 0,
+                "latency_seconds": Histogram(self.latency_buckets),
+                "queue_seconds": Histogram(self.latency_buckets),
+                "prompt_tokens_per_call": Histogram(self.token_buckets),
+            }
+        return series
+
+    def record_call(
+        self,
+        tags: dict,
+        model: str,
+        latency: float = 0.0,
+        queue_time: float = 0.0,
+        usage: dict | None = None,
+        retries: int = 0,
+        cache_hit: bool = False,
+        error: str | None = None,
+    ):
+        """Records one LLM call. Cache hits are counted but not timed."""
+        labels = tuple(
+            str(model if label == "model" else tags.get(label) or "") for label in self.LABELS
+        )
+        usage = usage or {}
+        prompt_tokens = usage.get("prompt_tokens") or 0
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        with self._lock:
+            series = self._get_series(labels)
+            series["calls"] += 1
+            if cache_hit:
+                series["cache_hits"] += 1
+                return
+            series["errors"] += error is not None
+            series["retries"] += retries
+            series["prompt_tokens"] += prompt_tokens
+            series["completion_tokens"] += usage.get("completion_tokens") or 0
+            series["cached_tokens"] += cached_tokens
+            series["latency_seconds"].observe(latency)
+            series["queue_seconds"].observe(queue_time)
+            if usage:
+                series["prompt_tokens_per_call"].observe(prompt_tokens)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self.root_spans.clear()
+
+    def snapshot(self, include_spans: bool = False) -> dict:
+        """Returns the metrics as plain data, optionally with the kept span trees."""
+        with self._lock:
+            series = [
+                {
+                    "labels": dict(zip(self.LABELS, labels)),
+                    **{
+                        name: value.to_dict() if isinstance(value, Histogram) else value
+                        for name, value in values.items()
+                    },
+                }
+                for labels, values in self._series.items()
+            ]
+            roots = list(self.root_spans) if include_spans else []
+        snapshot = {"series": series}
+        if include_spans:
+            snapshot["spans"] = [root.to_dict() for root in roots]
+        return snapshot
+
+    def prompt_cache_report(self, by: str = "agent") -> dict:
+        """Returns the share of prompt tokens served from the provider's prompt cache.
+
+        Args:
+            by: The label to group the calls by, e.g. "agent" or "model".
+
+        Returns:
+            A dict of {label value: {"requests", "prompt_tokens", "cached_tokens",
+            "cached_ratio"}}. Response cache hits are not requests and do not count.
+
+        Examples:
+            >>> metrics = LLMMetrics()
+            >>> metrics.record_call(
+            ...     {"agent": "ItineraryAgent"}, "gpt-4o-mini",
+            ...     usage={"prompt_tokens": 2000, "prompt_tokens_details": {"cached_tokens": 1536}},
+            ... )
+            >>> metrics.prompt_cache_report()
+            {'ItineraryAgent': {'requests': 1, 'prompt_tokens': 2000, 'cached_tokens': 1536, 'cached_ratio': 0.768}}
+        """
+        position = self.LABELS.index(by)
+        report = {}
+        with self._lock:
+            for labels, values in self._series.items():
+                entry = report.setdefault(
+                    labels[position], {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+                )
+                entry["requests"] += values["calls"] - values["cache_hits"]
+                entry["prompt_tokens"] += values["prompt_tokens"]
+                entry["cached_tokens"] += values["cached_tokens"]
+        for entry in report.values():
+            prompt_tokens = entry["prompt_tokens"]
+            entry["cached_ratio"] = entry["cached_tokens"] / prompt_tokens if prompt_tokens else 0.0
+        return report
+
+    def to_json(self, include_spans: bool = False, **kwargs) -> str:
+        """Exports `snapshot` as a JSON string; kwargs are passed to json.dumps."""
+        import json
+
+        return json.dumps(self.snapshot(include_spans), default=str, **kwargs)
+
+    def to_prometheus(self, prefix: str = "agentsville_llm") -> str:
+        """Exports the metrics in the Prometheus text exposition format."""
+
+        def escape(value):
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def label_string(labels, **extra):
+            pairs = list(zip(self.LABELS, labels)) + list(extra.items())
+            return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+        counters = {
+            "calls": "LLM chat completion calls, including response cache hits.",
+            "cache_hits": "LLM calls served from the response cache.",
+            "errors": "LLM calls that raised an error.",
+            "retries": "HTTP retries of LLM calls.",
+        }
+        histograms = {
+            "latency_seconds": "Latency of LLM requests.",
+            "queue_seconds": "Time LLM requests waited for admission by the scheduler.",
+            "prompt_tokens_per_call": "Prompt tokens per LLM request.",
+        }
+        with self._lock:
+            items = [(labels, dict(values)) for labels, values in self._series.items()]
+
+        lines = []
+        for name, help_text in counters.items():
+            lines += [f"# HELP {prefix}_{name}_total {help_text}", f"# TYPE {prefix}_{name}_total counter"]
+            lines += [f"{prefix}_{name}_total{label_string(labels)} {values[name]}" for labels, values in items]
+
+        lines += [f"# HELP {prefix}_tokens_total Tokens used by LLM requests.", f"# TYPE {prefix}_tokens_total counter"]
+        for labels, values in items:
+            for kind in ("prompt", "completion", "cached"):
+                lines.append(
+                    f"{prefix}_tokens_total{label_string(labels, type=kind)} {values[f'{kind}_tokens']}"
+                )
+
+        for name, help_text in histograms.items():
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} histogram"]
+            for labels, values in items:
+                histogram = values[name]
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{prefix}_{name}_bucket{label_string(labels, le=bound)} {count}")
+                lines.append(f"{prefix}_{name}_sum{label_string(labels)} {histogram.sum}")
+                lines.append(f"{prefix}_{name}_count{label_string(labels)} {histogram.count}")
+
+        scheduler = get_llm_scheduler().stats()
+        lines += [
+            f"# HELP {prefix}_in_flight LLM requests in flight.",
+            f"# TYPE {prefix}_in_flight gauge",
+            f"{prefix}_in_flight {scheduler['in_flight']}",
+            f"# HELP {prefix}_queue_depth LLM requests waiting for admission, by priority.",
+            f"# TYPE {prefix}_queue_depth gauge",
+        ]
+        lines += [
+            f'{prefix}_queue_depth{{priority="{priority}"}} {depth}'
+            for priority, depth in scheduler["queued"].items()
+        ]
+        lines += [
+            f"# HELP {prefix}_scheduler_wait_seconds Time LLM requests waited for admission, by priority.",
+            f"# TYPE {prefix}_scheduler_wait_seconds histogram",
+        ]
+        for priority, histogram in scheduler["wait_seconds"].items():
+            for bound, count in histogram["buckets"].items():
+                lines.append(
+                    f'{prefix}_scheduler_wait_seconds_bucket{{priority="{priority}",le="{bound}"}} {count}'
+                )
+            lines.append(f'{prefix}_scheduler_wait_seconds_sum{{priority="{priority}"}} {histogram["sum"]}')
+            lines.append(f'{prefix}_scheduler_wait_seconds_count{{priority="{priority}"}} {histogram["count"]}')
+        for name, help_text in {
+            "retries": "LLM request retries scheduled after a retryable error.",
+            "rate_limited": "LLM requests rejected with a rate limit (429).",
+            "backoff_seconds": "Seconds LLM requests spent backing off before a retry.",
+        }.items():
+            lines += [
+                f"# HELP {prefix}_scheduler_{name}_total {help_text}",
+                f"# TYPE {prefix}_scheduler_{name}_total counter",
+                f"{prefix}_scheduler_{name}_total {scheduler[name]}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+_LLM_METRICS = LLMMetrics()
+
+
+def get_llm_metrics() -> LLMMetrics:
+    """Returns the process-wide LLM metrics."""
+    return _LLM_METRICS
+
+
+class _InstrumentedCall:
+    """Times one LLM request in an "llm_call" span and records it in the metrics.
+
+    Use it around scheduling and sending the request, passing `schedule` to
+    `LLMScheduler.call`: it calls `sent` once the request is admitted, to
+    split queueing from latency, and counts the scheduler's retries.
+    """
+
+    def __init__(self, model: str):
+        self.model = model
+        self.span = span("llm_call", model=model)
+        self.result = None
+        self._sent_at = None
+        self._attempts_token = None
+        self._scheduled_attempts = 0
+
+    def __enter__(self):
+        self.span.__enter__()
+        self._attempts_token = _LLM_ATTEMPTS.set([0])
+        return self
+
+    def sent(self):
+        import time
+
+        self._sent_at = time.perf_counter()
+
+    def schedule(self, messages, kwargs, priority: str) -> dict:
+        """Returns the `LLMScheduler.call` arguments of the request."""
+        tokens = estimate_request_tokens(messages, kwargs)
+        self.span.attributes.update(priority=priority, estimated_tokens=tokens)
+        return {
+            "tokens": tokens,
+            "priority": priority,
+            "usage": _used_tokens,
+            "on_attempt": self._attempt,
+        }
+
+    def _attempt(self):
+        self._scheduled_attempts += 1
+        self.sent()
+
+    def __exit__(self, exc_type, exc, tb):
+        import time
+
+        attempts = _LLM_ATTEMPTS.get()[0]
+        _LLM_ATTEMPTS.reset(self._attempts_token)
+        self.span.__exit__(exc_type, exc, tb)
+
+        sent_at = self._sent_at if self._sent_at is not None else self.span.end
+        usage = self.result.usage if self.result is not None else {}
+        # The scheduler retries, the backend counts its HTTP attempts (if it can)
+        retries = max(0, attempts - 1, self._scheduled_attempts - 1)
+        # A stream closed by its consumer is cancelled on purpose, not failed
+        cancelled = exc_type is GeneratorExit
+        error = exc_type.__name__ if exc_type is not None and not cancelled else None
+        if cancelled:
+            self.span.attributes.pop("error", None)
+            self.span.attributes["cancelled"] = True
+        self.span.attributes.update(
+            queue_seconds=sent_at - self.span.start,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+            retries=retries,
+        )
+        get_llm_metrics().record_call(
+            self.span.tags(),
+            self.model,
+            latency=self.span.end - sent_at,
+            queue_time=sent_at - self.span.start,
+            usage=usage,
+            retries=retries,
+            error=error,
+        )
+        return False
+
+
+def _used_tokens(result: ChatResult) -> int | None:
+    usage = result.usage
+    if "total_tokens" in usage:
+        return usage["total_tokens"]
+    if "prompt_tokens" in usage or "completion_tokens" in usage:
+        return (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+    return None
+
+
+def _record_cache_hit(model: str):
+    active = current_span()
+    get_llm_metrics().record_call(active.tags() if active else {}, model, cache_hit=True)
+
+
+def _prepare_chat_request(messages, kwargs):
+    """Resolves the backend, model and cache entry of a chat completion request.
+
+    Pops the options understood by `do_chat_completion` from `kwargs`, leaving
+    only the parameters that are sent to the API.
+
+    Returns:
+        A (backend, model, priority, cache, key, cached_result) tuple. `cache` is
+        None when the request should not be cached, and `cached_result` is None
+        on a miss.
+    """
+    backend = get_llm_backend(kwargs.pop("backend", None))
+    model = kwargs.pop("model", None) or backend.config.model
+    priority = kwargs.pop("priority", None) or current_llm_priority()
+    use_cache = kwargs.pop("cache", True)
+
+    cache = get_response_cache() if use_cache else None
+    if cache is not None and not cache.is_cacheable(kwargs):
+        cache.bypasses += 1
+        cache = None
+
+    key = None
+    cached_result = None
+    if cache is not None:
+        key = cache.make_key(messages, model, kwargs)
+        cached_result = cache.get(key)
+    return backend, model, priority, cache, key, cached_result
+
+
+def do_chat_completion(messages: list[dict[str, str]], **kwargs):
+    """A simple wrapper around OpenAI's chat completion API.
+
+    Requests go through a shared, connection-pooled LLM backend (see
+    `get_llm_backend`), so repeated calls reuse the same HTTP connections.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        **kwargs: Extra request parameters, e.g. temperature. Pass `model` to
+            override the backend's default model, `backend` to use a named
+            backend instead of the default one and `cache=False` to skip the
+            response cache (see `configure_response_cache`).
+
+    Returns:
+        str: The response from the chat completion API.
+
+    Raises:
+        openai.OpenAIError: If the chat completion API returns an error.
+
+    Examples:
+        >>> messages = [
+        ...     {"role": "user", "content": "Hello, how are you?"},
+        ...     {"role": "assistant", "content": "I'm good, thanks!"},
+        ... ]
+        >>> register_llm_backend(
+        ...     "stub", CallableBackend(lambda messages, model, **kwargs: "I'm good, thanks!")
+        ... )
+        >>> response = do_chat_completion(messages, backend="stub")
+        >>> response
+        "I'm good, thanks!"
+    """
+    backend, model, priority, cache, key, result = _prepare_chat_request(messages, kwargs)
+    if result is not None:
+        _record_cache_hit(model)
+        return result.content
+
+    with _InstrumentedCall(model) as call:
+        result = call.result = get_llm_scheduler().call(
+            lambda: backend.chat(messages, model=model, **kwargs),
+            **call.schedule(messages, kwargs, priority),
+        )
+
+    if cache is not None:
+        cache.set(key, result)
+    return result.content
+
+
+async def ado_chat_completion(messages: list[dict[str, str]], **kwargs):
+    """The asyncio counterpart of `do_chat_completion`.
+
+    Takes the same arguments and goes through the same backend, cache and
+    concurrency limiter, but awaits the request instead of blocking, so many
+    planning sessions can share one event loop.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        **kwargs: The same extra parameters as `do_chat_completion`.
+
+    Returns:
+        str: The response from the chat completion API.
+
+    Examples:
+        >>> import asyncio
+        >>> register_llm_backend(
+        ...     "stub", CallableBackend(lambda messages, model, **kwargs: "4")
+        ... )
+        >>> asyncio.run(
+        ...     ado_chat_completion([{"role": "user", "content": "2+2?"}], backend="stub")
+        ... )
+        '4'
+    """
+    backend, model, priority, cache, key, result = _prepare_chat_request(messages, kwargs)
+    if result is not None:
+        _record_cache_hit(model)
+        return result.content
+
+    with _InstrumentedCall(model) as call:
+        result = call.result = await get_llm_scheduler().acall(
+            lambda: backend.achat(messages, model=model, **kwargs),
+            **call.schedule(messages, kwargs, priority),
+        )
+
+    if cache is not None:
+        cache.set(key, result)
+    return result.content
+
+
+def do_chat_completion_stream(messages: list[dict[str, str]], **kwargs):
+    """The streaming counterpart of `do_chat_completion`.
+
+    Yields the response in chunks as they arrive. Closing the generator early
+    (e.g. breaking out of a loop over it) cancels the request, which saves the
+    time and the output tokens of the rest of the response. Only responses
+    read to the end are stored in the response cache; cache hits are yielded
+    as a single chunk.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        **kwargs: The same extra parameters as `do_chat_completion`.
+
+    Yields:
+        str: The chunks of the response.
+
+    Examples:
+        >>> register_llm_backend(
+        ...     "stub", CallableBackend(lambda messages, model, **kwargs: iter(["<act>", "{}", "</act>", "..."]))
+        ... )
+        >>> text = ""
+        >>> for chunk in do_chat_completion_stream([{"role": "user", "content": "Act"}], backend="stub"):
+        ...     text += chunk
+        ...     if stop_at_complete_act(text):
+        ...         break
+        >>> text
+        '<act>{}</act>'
+    """
+    import time
+
+    backend, model, priority, cache, key, result = _prepare_chat_request(messages, kwargs)
+    if result is not None:
+        _record_cache_hit(model)
+        yield result.content
+        return
+
+    with _InstrumentedCall(model) as call:
+        scheduler = get_llm_scheduler()
+        schedule = call.schedule(messages, kwargs, priority)
+        # Only opening the stream is retried, as chunks already yielded cannot
+        # be taken back. The slot is kept until the stream is closed.
+        stream = scheduler.call(
+            lambda: backend.chat_stream(messages, model=model, **kwargs),
+            keep_slot=True,
+            **schedule,
+        )
+        try:
+            for chunk in stream:
+                if "first_chunk_seconds" not in call.span.attributes:
+                    call.span.attributes["first_chunk_seconds"] = (
+                        time.perf_counter() - call.span.start
+                    )
+                yield chunk
+        finally:
+            stream.close()
+            call.result = ChatResult([stream.text], usage=stream.usage, model=model)
+            scheduler.release(schedule["tokens"], schedule["usage"](call.result))
+
+    if cache is not None and stream.finished:
+        cache.set(key, call.result)
+
+
+def stop_at_complete_act(text: str) -> bool:
+    """Tells whether a (partial) response already holds a complete, valid <act> JSON.
+
+    Use it with `ChatAgent.get_response(stream=True, stop_when=...)` to stop
+    reading a ReAct action as soon as it can be parsed.
+
+    Examples:
+        >>> stop_at_complete_act('<act>{"tool": "weather"')
+        False
+        >>> stop_at_complete_act('<act>{"tool": "weather"}</act> I will now')
+        True
+        >>> stop_at_complete_act('<act>[{"tool": "weather"}, {"tool": "events"}]</act>')
+        True
+    """
+    return parse_act(text) is not None
+
+
+def parse_act(text: str) -> list[dict] | None:
+    """Parses the tool invocations of the last complete <act>...</act> of a response.
+
+    An <act> holds either a single invocation or a list of invocations, which
+    the agents run concurrently. Malformed JSON is repaired locally (see
+    `extract_json`), so a sloppy action does not cost another LLM call.
+
+    Returns:
+        The invocations, as a list of dicts, or None if there is no complete
+        <act> with a usable invocation.
+
+    Examples:
+        >>> parse_act('<act>```json {"tool": "weather", "date": "2025-06-10"} ```</act>')
+        [{'tool': 'weather', 'date': '2025-06-10'}]
+        >>> [a["tool"] for a in parse_act('<act>[{"tool": "weather"}, {"tool": "events"}]</act>')]
+        ['weather', 'events']
+        >>> parse_act("<act>{'tool': 'weather', 'date': '2025-06-10',}</act>")
+        [{'tool': 'weather', 'date': '2025-06-10'}]
+        >>> parse_act("<act>[]</act>") is None
+        True
+    """
+    import re
+
+    bodies = re.findall(r"<act>(.*?)</act>", text, re.DOTALL)
+    if not bodies:
+        return None
+    parsed = extract_json(bodies[-1])
+    actions = [parsed] if isinstance(parsed, dict) else parsed
+    if not isinstance(actions, list) or not actions or not all(isinstance(a, dict) for a in actions):
+        return None
+    return actions
+
+
+def parse_react_step(text: str) -> tuple[str | None, list[dict] | None]:
+    """Parses a ReAct step response holding a <thought> and an <act>.
+
+    The action is validated: every invocation must name its "tool". Without
+    <act> tags, a bare JSON object naming a tool is taken as the action, as
+    LLMs sometimes drop the tags.
+
+    Returns:
+        A (thought, actions) pair. The thought is the text of the last
+        <thought>, or None. The actions are the invocations of the last
+        complete <act> (see `parse_act`); None if the response has no action,
+        so it should be asked for, and an empty list if the action is invalid.
+
+    Examples:
+        >>> parse_react_step('<thought>I need the weather.</thought> <act>{"tool": "weather", "date": "2025-06-10"}</act>')
+        ('I need the weather.', [{'tool': 'weather', 'date': '2025-06-10'}])
+        >>> parse_react_step("<thought>I need the weather.</thought>")
+        ('I need the weather.', None)
+        >>> parse_react_step('<thought>I need the weather.</thought> <act>{"tool": "weath')
+        ('I need the weather.', None)
+        >>> parse_react_step('<act>{"date": "2025-06-10"}</act>')
+        (None, [])
+        >>> parse_react_step('{"tool": "events", "city": "AgentsVille"}')
+        (None, [{'tool': 'events', 'city': 'AgentsVille'}])
+    """
+    import re
+
+    thoughts = re.findall(r"<thought>(.*?)(?:</thought>|<act>|$)", text, re.DOTALL)
+    thought = thoughts[-1].strip() if thoughts else None
+    if re.search(r"<act>.*?</act>", text, re.DOTALL):
+        actions = parse_act(text) or []
+    elif "<act>" in text:
+        # An unfinished <act>, e.g. cut by the token limit, is not repaired into an action
+        actions = None
+    else:
+        bare = extract_json(text, allow_arrays=False)
+        actions = [bare] if bare is not None and "tool" in bare else None
+    if actions and not all(isinstance(action.get("tool"), str) for action in actions):
+        actions = []
+    return thought, actions
+
+
+def _json_candidates(text: str, openers: str = "{["):
+    """Finds the top-level JSON objects (and arrays) of a text with a balanced-brace scan.
+
+    Brackets inside JSON strings are skipped, taking escapes into account.
+    Text outside the candidates (e.g. prose with apostrophes) is ignored.
+
+    Returns:
+        A (spans, unclosed) pair: the (start, end) of every balanced candidate,
+        in order, and the start of a last candidate that is never closed, or None.
+
+    Examples:
+        >>> _json_candidates('Say {"a": "}"} and [1, [2]] then {"b": 1')
+        ([(4, 14), (19, 27)], 33)
+    """
+    import re
+
+    spans = []
+    depth = 0
+    start = None
+    in_string = False
+    resume = 0
+    for match in re.finditer(r'[\[\]{}"\\]', text):
+        idx = match.start()
+        if idx < resume:
+            continue
+        char = text[idx]
+        if not depth:
+            if char in openers:
+                depth, start = 1, idx
+            continue
+        if in_string:
+            if char == "\\":
+                resume = idx + 2
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            # A mismatched closer still closes: the candidate is left to repair
+            depth -= 1
+            if not depth:
+                spans.append((start, idx + 1))
+    return spans, start if depth else None
+
+
+class _LenientJSONParser:
+    """Parses almost-JSON as produced by LLMs, repairing common defects on the way.
+
+    Handles trailing and stray commas, single-quoted strings, Python literals
+    (True, False, None), unquoted keys, duplicated opening braces, mismatched
+    or missing closing brackets, and unterminated strings, which are cut at
+    the first character that could end them.
+    """
+
+    __slots__ = ("text", "pos")
+
+    _LITERALS = {"true": True, "false": False, "null": None, "True": True, "False": False, "None": None}
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+
+    def parse(self):
+        return self._value()
+
+    def _skip_whitespace(self):
+        while self.pos < len(self.text) and self.text[self.pos] in " \t\r\n":
+            self.pos += 1
+
+    def _at_end(self) -> bool:
+        self._skip_whitespace()
+        return self.pos >= len(self.text)
+
+    def _value(self):
+        if self._at_end():
+            raise ValueError("Expected a value")
+        char = self.text[self.pos]
+        if char == "{":
+            return self._object()
+        if char == "[":
+            return self._array()
+        if char in "\"'":
+            return self._string(stops=",}]\n")
+        return self._literal()
+
+    def _object(self) -> dict:
+        self.pos += 1
+        obj = {}
+        while not self._at_end():
+            char = self.text[self.pos]
+            if char in "}]":
+                self.pos += 1
+                return obj
+            if char in ",{":
+                # Stray commas and duplicated opening braces
+                self.pos += 1
+                continue
+            if char in "\"'":
+                key = self._string(stops=":,}\n")
+            else:
+                key = self._word(stops=":,}]\n")
+            if not self._at_end() and self.text[self.pos] == ":":
+                self.pos += 1
+            obj[key] = self._value() if not self._at_end() and self.text[self.pos] not in ",}]" else None
+        return obj
+
+    def _array(self) -> list:
+        self.pos += 1
+        items = []
+        while not self._at_end():
+            char = self.text[self.pos]
+            if char in "]}":
+                self.pos += 1
+                return items
+            if char == ",":
+                self.pos += 1
+                continue
+            items.append(self._value())
+        return items
+
+    def _string(self, stops: str) -> str:
+        import json
+        import re
+
+        quote = self.text[self.pos]
+        idx = self.pos + 1
+        while idx < len(self.text) and self.text[idx] != quote:
+            idx += 2 if self.text[idx] == "\\" else 1
+        if idx < len(self.text):
+            raw, self.pos = self.text[self.pos + 1 : idx], idx + 1
+        else:
+            # Unterminated: end the string where it most likely should have ended
+            ends = [self.text.find(stop, self.pos + 1) for stop in stops]
+            end = min((end for end in ends if end != -1), default=len(self.text))
+            raw, self.pos = self.text[self.pos + 1 : end].rstrip(), end
+        if quote == "'":
+            raw = re.sub(r'(?<!\\)"', r'\\"', raw.replace("\\'", "'"))
+        try:
+            return json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return raw
+
+    def _word(self, stops: str) -> str:
+        end = self.pos
+        while end < len(self.text) and self.text[end] not in stops:
+            end += 1
+        word, self.pos = self.text[self.pos : end].strip(), end
+        if not word:
+            raise ValueError(f"Unexpected {self.text[end:end + 1]!r} at {end}")
+        return word
+
+    def _literal(self):
+        import re
+
+        number = re.compile(r"-?\d+(\.\d+)?([eE][+-]?\d+)?(?=\s*[,}\]\n]|\s*$)")
+        match = number.match(self.text, self.pos)
+        if match:
+            self.pos = match.end()
+            return float(match.group()) if match.group(1) or match.group(2) else int(match.group())
+        word = self._word(stops=",}]\n")
+        return self._LITERALS.get(word, word)
+
+
+def repair_json(text: str):
+    """Parses the JSON value at the start of `text`, repairing common LLM defects.
+
+    See `_LenientJSONParser` for what is repaired. Text after the value is ignored.
+
+    Returns:
+        The parsed object or array, or None if `text` does not start with one.
+
+    Examples:
+        >>> repair_json('{{"a: 1}')
+        {'a': 1}
+        >>> repair_json("{'city': 'AgentsVille', 'days': [1, 2,], ok: True")
+        {'city': 'AgentsVille', 'days': [1, 2], 'ok': True}
+    """
+    text = text.lstrip()
+    if not text or text[0] not in "{[":
+        return None
+    try:
+        return _LenientJSONParser(text).parse()
+    except (ValueError, RecursionError):
+        return None
+
+
+def extract_json(text: str, allow_arrays: bool = True):
+    """Extracts the last JSON object (or array) of an LLM response, without calling an LLM.
+
+    The response is scanned for balanced brackets, skipping those inside JSON
+    strings, so prose and code fences around the JSON do not matter. If the
+    response has <act> tags, only the last complete <act> is considered. The
+    last candidate that parses is returned; if none does, the candidates are
+    repaired, last first (see `repair_json`).
+
+    Args:
+        text: The response.
+        allow_arrays: Whether top-level arrays are candidates, or only objects.
+
+    Returns:
+        The parsed JSON, or None if there is none.
+
+    Examples:
+        >>> extract_json('Here it is: ```json {"name": "Turing", "age": 30} ``` Done!')
+        {'name': 'Turing', 'age': 30}
+        >>> extract_json('```json\\n{{"a: 1}\\n```')
+        {'a': 1}
+        >>> extract_json('<act>{"tool": "weather"}</act> <act>{"tool": "events", "date": "2025-06-10",}</act>')
+        {'tool': 'events', 'date': '2025-06-10'}
+        >>> extract_json("No JSON here, isn't it?") is None
+        True
+    """
+    import json
+    import re
+
+    bodies = re.findall(r"<act>(.*?)</act>", text, re.DOTALL)
+    if bodies:
+        text = bodies[-1]
+    spans, unclosed = _json_candidates(text, "{[" if allow_arrays else "{")
+    for start, end in reversed(spans):
+        try:
+            return json.loads(text[start:end])
+        except json.JSONDecodeError:
+            continue
+
+    starts = [start for start, _ in reversed(spans)]
+    if unclosed is not None:
+        starts.insert(0, unclosed)
+    for start in starts:
+        repaired = repair_json(text[start:])
+        if repaired is not None and (allow_arrays or isinstance(repaired, dict)):
+            return repaired
+    return None
+
+
+# JSON schema keywords that strict structured outputs do not accept
+_UNSUPPORTED_SCHEMA_KEYS = frozenset(
+    {
+        "default",
+        "minimum",
+        "maximum",
+        "exclusiveMinimum",
+        "exclusiveMaximum",
+        "multipleOf",
+        "minLength",
+        "maxLength",
+        "pattern",
+        "format",
+        "minItems",
+        "maxItems",
+    }
+)
+
+
+def json_schema_response_format(model, name: str | None = None) -> dict:
+    """Builds a `response_format` request parameter from a Pydantic model.
+
+    With it, OpenAI-compatible endpoints constrain the response to the model's
+    JSON schema ("structured outputs"), so it parses without repair. Strict
+    mode requires every property to be listed as required and no additional
+    properties, so the schema is adapted: optional fields stay nullable, and
+    defaults and value constraints (e.g. ge=0), which strict mode rejects, are
+    dropped. Validate the parsed response with the model to enforce them.
+
+    Args:
+        model: A Pydantic model class, e.g. TravelPlan or VacationInfo.
+        name: The schema name. Defaults to the model's class name.
+
+    Examples:
+        >>> from pydantic import BaseModel, Field
+        >>> class Point(BaseModel):
+        ...     x: int = Field(ge=0)
+        ...     label: str | None = None
+        >>> response_format = json_schema_response_format(Point)
+        >>> schema = response_format["json_schema"]["schema"]
+        >>> response_format["type"], schema["required"], schema["additionalProperties"]
+        ('json_schema', ['x', 'label'], False)
+        >>> schema["properties"]["x"]
+        {'title': 'X', 'type': 'integer'}
+    """
+
+    def strict(node):
+        if isinstance(node, list):
+            return [strict(item) for item in node]
+        if not isinstance(node, dict):
+            return node
+        node = {key: value for key, value in node.items() if key not in _UNSUPPORTED_SCHEMA_KEYS}
+        for key, value in node.items():
+            if key in ("properties", "$defs"):
+                # Keyed by field and model names, which may shadow schema keywords
+                node[key] = {name: strict(schema) for name, schema in value.items()}
+            else:
+                node[key] = strict(value)
+        if node.get("type") == "object" and "properties" in node:
+            node["required"] = list(node["properties"])
+            node["additionalProperties"] = False
+        return node
+
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name or model.__name__,
+            "schema": strict(model.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+class SlotState:
+    """The partially filled fields ("slots") of a Pydantic model.
+
+    Used for slot-filling conversations, e.g. onboarding: fields extracted
+    from each reply are merged in, and the conversation only asks about the
+    slots still missing or invalid, until the model validates. Known fields
+    can be set up front to skip their questions.
+
+    Args:
+        model: The Pydantic model class, e.g. VacationInfo.
+        values: Known field values.
+
+    Examples:
+        >>> from pydantic import BaseModel, Field
+        >>> class Trip(BaseModel):
+        ...     city: str = Field(description="The destination city")
+        ...     budget: float = Field(description="Total budget", ge=0)
+        >>> state = SlotState(Trip, {"city": "AgentsVille"})
+        >>> state.missing(), state.complete
+        (['budget'], False)
+        >>> state.update({"budget": -5, "unknown": 1, "city": None})
+        ['budget']
+        >>> state.invalid()
+        {'budget': 'Input should be greater than or equal to 0'}
+        >>> print(state.describe_pending())
+        - budget: Total budget (invalid: Input should be greater than or equal to 0)
+        >>> state.update({"budget": 1000})
+        ['budget']
+        >>> state.complete, state.validated()
+        (True, Trip(city='AgentsVille', budget=1000.0))
+    """
+
+    __slots__ = ("model", "values")
+
+    def __init__(self, model, values: dict | None = None):
+        self.model = model
+        self.values = {}
+        if values:
+            self.update(values)
+
+    def update(self, values: dict) -> list[str]:
+        """Sets the given fields. Unknown fields and None values are ignored.
+
+        Returns:
+            The names of the fields set.
+        """
+        updated = [
+            name for name, value in values.items() if name in self.model.model_fields and value is not None
+        ]
+        for name in updated:
+            self.values[name] = values[name]
+        return updated
+
+    def errors(self) -> dict[str, str]:
+        """Validates the values, and returns the first error of each field, in field order."""
+        from pydantic import ValidationError
+
+        try:
+            self.model.model_validate(self.values)
+            return {}
+        except ValidationError as exc:
+            errors = {}
+            for error in exc.errors():
+                name, *path = error["loc"]
+                message = f"{'.'.join(map(str, path))}: {error['msg']}" if path else error["msg"]
+                errors.setdefault(name, message)
+            return {name: errors[name] for name in self.model.model_fields if name in errors}
+
+    def missing(self) -> list[str]:
+        """Returns the required fields that have no value yet."""
+        return [name for name in self.errors() if name not in self.values]
+
+    def invalid(self) -> dict[str, str]:
+        """Returns the fields whose value is invalid, with the validation error."""
+        return {name: message for name, message in self.errors().items() if name in self.values}
+
+    @property
+    def complete(self) -> bool:
+        return not self.errors()
+
+    def validated(self):
+        """Returns the model instance if the values validate, or None."""
+        return self.model.model_validate(self.values) if self.complete else None
+
+    def describe_pending(self) -> str:
+        """Lists the missing and invalid fields with their descriptions, one per line."""
+        lines = []
+        for name, message in self.errors().items():
+            line = f"- {name}: {self.model.model_fields[name].description or name}"
+            if name in self.values:
+                line += f" (invalid: {message})"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        """Returns the values set so far, in field order."""
+        return {name: self.values[name] for name in self.model.model_fields if name in self.values}
+
+
+def sample_chat_completions(
+    messages: list[dict[str, str]], n: int, **kwargs
+) -> list[str]:
+    """Samples `n` responses to the same messages.
+
+    If the backend supports it, all samples are requested at once with the
+    `n` parameter. Otherwise, or if the backend returns fewer choices than
+    asked for, the remaining samples are requested concurrently.
+
+    Samples always bypass the response cache: a cached draw would repeat the
+    same answers on every call, even with `cache_nonzero_temperature=True`.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        n: The number of samples.
+        **kwargs: The same extra parameters as `do_chat_completion`.
+
+    Returns:
+        list[str]: The sampled responses.
+
+    Examples:
+        >>> register_llm_backend(
+        ...     "stub", CallableBackend(lambda messages, model, **kwargs: "yes")
+        ... )
+        >>> sample_chat_completions([{"role": "user", "content": "?"}], 3, backend="stub")
+        ['yes', 'yes', 'yes']
+
+        Repeated calls draw new samples even when sampled responses are cached:
+
+        >>> draws = iter(range(100))
+        >>> register_llm_backend(
+        ...     "counter", CallableBackend(lambda messages, model, **kwargs: str(next(draws)))
+        ... )
+        >>> _ = configure_response_cache(cache_nonzero_temperature=True)
+        >>> question = [{"role": "user", "content": "?"}]
+        >>> sorted(sample_chat_completions(question, 2, backend="counter", temperature=0.7))
+        ['0', '1']
+        >>> sorted(sample_chat_completions(question, 2, backend="counter", temperature=0.7))
+        ['2', '3']
+        >>> disable_response_cache()
+    """
+    if n <= 0:
+        return []
+
+    kwargs = dict(kwargs, cache=False)
+    choices = []
+    if n > 1 and get_llm_backend(kwargs.get("backend")).supports_n:
+        request_kwargs = dict(kwargs, n=n)
+        backend, model, priority, _, _, _ = _prepare_chat_request(messages, request_kwargs)
+        with _InstrumentedCall(model) as call:
+            result = call.result = get_llm_scheduler().call(
+                lambda: backend.chat(messages, model=model, **request_kwargs),
+                **call.schedule(messages, request_kwargs, priority),
+            )
+        choices = list(result.choices[:n])
+
+    choices += run_concurrently(
+        lambda _: do_chat_completion(messages, **dict(kwargs)),
+        range(n - len(choices)),
+        max_workers=n,
+    )
+    return choices
+
+
+class VoteResult:
+    """The outcome of a self-consistency vote.
+
+    Attributes:
+        answer: The winning answer.
+        distribution: How many samples voted for each answer.
+        num_samples: How many samples were drawn.
+        max_samples: How many samples the vote was allowed to draw.
+        settled: Whether the winner could no longer change when voting stopped.
+    """
+
+    def __init__(self, answer, distribution, num_samples, max_samples, settled):
+        self.answer = answer
+        self.distribution = dict(distribution)
+        self.num_samples = num_samples
+        self.max_samples = max_samples
+        self.settled = settled
+
+    @property
+    def confidence(self) -> float:
+        """The share of samples that voted for the winning answer."""
+        if not self.num_samples:
+            return 0.0
+        return self.distribution.get(self.answer, 0) / self.num_samples
+
+    def __repr__(self):
+        return (
+            f"VoteResult(answer={self.answer!r}, distribution={self.distribution!r}, "
+            f"num_samples={self.num_samples}/{self.max_samples}, "
+            f"confidence={self.confidence:.2f})"
+        )
+
+
+def adaptive_vote(sample, max_samples: int) -> VoteResult:
+    """Runs a self-consistency vote that stops as soon as the winner is settled.
+
+    Samples are drawn in rounds. Each round draws the smallest number of samples
+    that could settle the vote, i.e. make the leading answer unbeatable by the
+    samples left in the budget. With unanimous answers, a vote over
+    `max_samples` therefore costs only `max_samples // 2 + 1` samples.
+
+    Ties are broken in favor of the answer seen first, like `Counter.most_common`.
+
+    Args:
+        sample: A function called with a number k that returns k answers.
+        max_samples: The maximum number of samples (the `num_calls` budget).
+
+    Returns:
+        VoteResult: The winning answer with its vote distribution.
+
+    Examples:
+        >>> adaptive_vote(lambda k: [True] * k, 5)
+        VoteResult(answer=True, distribution={True: 3}, num_samples=3/5, confidence=1.00)
+        >>> answers = iter([True, False, True, None, True])
+        >>> adaptive_vote(lambda k: [next(answers) for _ in range(k)], 5).num_samples
+        5
+    """
+    from collections import Counter
+
+    counts = Counter()
+    remaining = max_samples
+    settled = False
+    while remaining > 0:
+        ranked = counts.most_common(2) + [(None, 0), (None, 0)]
+        gap = ranked[0][1] - ranked[1][1]
+        # The smallest k such that the leader could be ahead by more than the
+        # samples left after this round
+        k = min(remaining, max(1, (remaining - gap) // 2 + 1))
+        counts.update(sample(k))
+        remaining -= k
+
+        ranked = counts.most_common(2) + [(None, 0)]
+        if ranked[0][1] - ranked[1][1] > remaining:
+            settled = True
+            break
+
+    if not counts:
+        return VoteResult(None, {}, 0, max_samples, settled=False)
+    return VoteResult(
+        counts.most_common(1)[0][0],
+        counts,
+        max_samples - remaining,
+        max_samples,
+        settled=settled or remaining == 0,
+    )
+
+
+def estimate_tokens(content) -> int:
+    """Roughly estimates the number of tokens of a text or a list of chat messages.
+
+    Uses about four characters per token, plus a few tokens of overhead per
+    message, which is close enough to compare prompt sizes.
+
+    Examples:
+        >>> estimate_tokens("Hello, world!")
+        4
+        >>> estimate_tokens([{"role": "user", "content": "Hello, world!"}])
+        8
+    """
+    if isinstance(content, str):
+        return (len(content) + 3) // 4
+    return sum(4 + estimate_tokens(str(message["content"])) for message in content)
+
+
+DEFAULT_COMPLETION_TOKEN_ESTIMATE = 256
+
+
+def estimate_request_tokens(messages, kwargs: dict | None = None) -> int:
+    """Estimates the tokens a chat completion request counts against a quota.
+
+    That is the prompt, plus the completion limit of every choice, or
+    `DEFAULT_COMPLETION_TOKEN_ESTIMATE` per choice when there is no limit.
+    `LLMScheduler` reconciles the estimate with the actual usage.
+
+    Examples:
+        >>> estimate_request_tokens([{"role": "user", "content": "Hello, world!"}], {"max_tokens": 10, "n": 2})
+        28
+    """
+    kwargs = kwargs or {}
+    completion = (
+        kwargs.get("max_completion_tokens")
+        or kwargs.get("max_tokens")
+        or DEFAULT_COMPLETION_TOKEN_ESTIMATE
+    )
+    return estimate_tokens(messages) + completion * (kwargs.get("n") or 1)
+
+
+def elide_observation(content: str, max_chars: int = 200) -> str:
+    """Shortens the <observation> of a stale message, keeping its beginning.
+
+    Messages without an <observation> tag are returned unchanged.
+
+    Examples:
+        >>> elide_observation("<observation>" + "x" * 300 + "</observation>", max_chars=10)
+        '<observation>xxxxxxxxxx... [290 more characters elided]</observation>'
+    """
+    import re
+
+    def shorten(match):
+        body = match.group(1)
+        if len(body) <= max_chars:
+            return match.group(0)
+        return (
+            f"<observation>{body[:max_chars]}... "
+            f"[{len(body) - max_chars} more characters elided]</observation>"
+        )
+
+    return re.sub(r"<observation>(.*?)</observation>", shorten, content, flags=re.DOTALL)
+
+
+def format_prompt(template: str, **kwargs) -> str:
+    """Dedents a prompt template, then fills it in.
+
+    Dedenting first keeps multi-line values (e.g. the tool descriptions) from
+    defeating the dedent, which would leave the template's indentation in
+    every line of the prompt.
+
+    Examples:
+        >>> format_prompt("    Tools:\\n    {tools}\\n", tools="1. weather\\n2. events")
+        'Tools:\\n1. weather\\n2. events'
+    """
+    from textwrap import dedent
+
+    return dedent(template).format(**kwargs).strip()
+
+
+_PROMPT_PREFIXES: dict[tuple[str, str], str] = {}
+_PROMPT_PREFIXES_LOCK = threading.Lock()
+
+
+def freeze_prompt_prefix(owner: str, template: str, **kwargs) -> str:
+    """Builds a static prompt once per owner and template, and reuses it afterwards.
+
+    Providers cache the longest prompt prefix they have seen recently and bill
+    cached input tokens at a discount, so the static part of every prompt
+    (e.g. an agent class's system prompt) should be byte-identical across
+    calls and sessions, and come before anything that varies. Values that are
+    expensive to build can be passed as callables; they are only called the
+    first time.
+
+    Args:
+        owner: Who the prompt belongs to, e.g. the agent class name.
+        template: The prompt template, see `format_prompt`.
+        **kwargs: The static values of the template's fields.
+
+    Returns:
+        str: The prompt, the very same string object on every call.
+
+    Examples:
+        >>> first = freeze_prompt_prefix("Doc", "Hello {name}", name=lambda: "you")
+        >>> first, freeze_prompt_prefix("Doc", "Hello {name}", name="ignored") is first
+        ('Hello you', True)
+    """
+    key = (owner, template)
+    with _PROMPT_PREFIXES_LOCK:
+        prompt = _PROMPT_PREFIXES.get(key)
+        if prompt is None:
+            values = {name: value() if callable(value) else value for name, value in kwargs.items()}
+            prompt = _PROMPT_PREFIXES[key] = format_prompt(template, **values)
+        return prompt
+
+
+class ConversationMemory:
+    """Decides which part of a chat history is sent to the LLM.
+
+    The full history stays in `ChatAgent.messages`; `build_prompt` returns the
+    messages to send. Without a token budget it sends everything. With one, and
+    once the history is over budget, it:
+
+    1. elides the observations of stale messages, oldest first,
+    2. then drops the oldest stale messages, leaving a note in their place,
+
+    until the prompt fits. The system prompt, the pinned facts and the last
+    `keep_recent` messages are always sent verbatim.
+
+    Pinned facts (e.g. the vacation info, or the current draft itinerary) are
+    sent in a system message after the system prompt, so they survive trimming.
+
+    Every `build_prompt` call is logged in `log`, with the tokens of the full
+    history and of the prompt actually sent.
+
+    Args:
+        token_budget: The maximum estimated tokens per prompt, or None for no limit.
+        keep_recent: The number of latest messages never trimmed.
+        observation_chars: The characters kept from each elided observation.
+
+    Examples:
+        >>> history = [{"role": "system", "content": "You plan trips."}]
+        >>> for step in range(3):
+        ...     history.append({"role": "user", "content": f"<observation>{'x' * 200}</observation>"})
+        ...     history.append({"role": "assistant", "content": "<thought>ok</thought>"})
+        >>> memory = ConversationMemory(token_budget=200, keep_recent=2, observation_chars=20)
+        >>> memory.pin("budget", 1000)
+        >>> prompt = memory.build_prompt(history)
+        >>> prompt[1]["content"]
+        'Pinned facts:\\n\\n## budget\\n1000'
+        >>> prompt[2]["content"]
+        '<observation>xxxxxxxxxxxxxxxxxxxx... [180 more characters elided]</observation>'
+        >>> memory.token_budget = 120
+        >>> memory.build_prompt(history)[2]["content"]
+        '[3 earlier messages omitted to fit the token budget]'
+        >>> [(entry["history_tokens"], entry["prompt_tokens"]) for entry in memory.log]
+        [(221, 196), (221, 118)]
+    """
+
+    def __init__(self, token_budget: int | None = None, keep_recent: int = 6, observation_chars: int = 200):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.observation_chars = observation_chars
+        self.pins: dict[str, str] = {}
+        self.log: list[dict] = []
+
+    def pin(self, key: str, content):
+        """Pins a fact, replacing any earlier fact with the same key."""
+        self.pins[key] = str(content)
+
+    def unpin(self, key: str):
+        self.pins.pop(key, None)
+
+    def reset(self):
+        """Forgets the pinned facts and the log, e.g. when the conversation restarts."""
+        self.pins = {}
+        self.log = []
+
+    def _pinned_message(self) -> list[dict]:
+        if not self.pins:
+            return []
+        facts = "\n\n".join(f"## {key}\n{content}" for key, content in self.pins.items())
+        return [{"role": "system", "content": f"Pinned facts:\n\n{facts}"}]
+
+    def build_prompt(self, messages: list[dict]) -> list[dict]:
+        """Returns the messages to send for the given full history."""
+        head = list(messages[:1]) if messages and messages[0]["role"] == "system" else []
+        rest = list(messages[len(head):])
+        head += self._pinned_message()
+        split = max(0, len(rest) - self.keep_recent)
+        stale, recent = rest[:split], rest[split:]
+
+        history_tokens = estimate_tokens(messages)
+        fixed_tokens = estimate_tokens(head) + estimate_tokens(recent)
+        stale_tokens = [estimate_tokens([message]) for message in stale]
+        elided = dropped = 0
+
+        def note():
+            return f"[{dropped} earlier messages omitted to fit the token budget]"
+
+        def over_budget():
+            note_tokens = estimate_tokens([{"content": note()}]) if dropped else 0
+            return (
+                self.token_budget is not None
+                and fixed_tokens + sum(stale_tokens) + note_tokens > self.token_budget
+            )
+
+        for idx, message in enumerate(stale):
+            if not over_budget():
+                break
+            content = elide_observation(message["content"], self.observation_chars)
+            if content != message["content"]:
+                stale[idx] = {**message, "content": content}
+                stale_tokens[idx] = estimate_tokens([stale[idx]])
+                elided += 1
+
+        while stale and over_budget():
+            stale.pop(0)
+            stale_tokens.pop(0)
+            dropped += 1
+
+        if dropped:
+            stale.insert(0, {"role": "user", "content": note()})
+
+        prompt = head + stale + recent
+        self.log.append(
+            {
+                "step": len(self.log) + 1,
+                "history_messages": len(messages),
+                "prompt_messages": len(prompt),
+                "history_tokens": history_tokens,
+                "prompt_tokens": estimate_tokens(prompt),
+                "elided": elided,
+                "dropped": dropped,
+            }
+        )
+        return prompt
+
+    def stats(self) -> dict:
+        """Summarizes the log: total tokens of the full histories vs. the prompts sent."""
+        history = sum(entry["history_tokens"] for entry in self.log)
+        prompt = sum(entry["prompt_tokens"] for entry in self.log)
+        return {
+            "steps": len(self.log),
+            "history_tokens": history,
+            "prompt_tokens": prompt,
+            "saved_ratio": 1 - prompt / history if history else 0.0,
+        }
+
+
+class CalendarDataset:
+    """A lazily loaded, hot-reloaded dataset stored as a JSON Lines file.
+
+    Nothing is read until `records` is first called. Plain ".jsonl" files are
+    parsed from a memory map, so only the pages actually read are loaded;
+    ".jsonl.gz" files are decompressed on load. After the first load, the
+    file's size and modification time are checked (at most every
+    check_interval seconds), and the records are reloaded if the file changed.
+    Each reload increments `version`.
+
+    Args:
+        path: The path of the JSON Lines file.
+        check_interval: The minimum number of seconds between two checks for changes.
+
+    Examples:
+        >>> import os, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), "weather.jsonl")
+        >>> write_jsonl(path, [{"date": "2025-06-10", "condition": "clear"}])
+        >>> dataset = CalendarDataset(path, check_interval=0)
+        >>> dataset.records()[0]["condition"], dataset.version
+        ('clear', 1)
+        >>> write_jsonl(path, [{"date": "2025-06-10", "condition": "rainy"}] * 2)
+        >>> len(dataset.records()), dataset.version
+        (2, 2)
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.version = 0
+        self._records = None
+        self._signature = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CalendarDataset({self.path!r})"
+
+    def _stat_signature(self):
+        import os
+
+        stat = os.stat(self.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _read(self) -> list[dict]:
+        import gzip
+        import json
+        import mmap
+
+        if self.path.endswith(".gz"):
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        with open(self.path, "rb") as f:
+            if not f.seek(0, 2):
+                return []  # empty files cannot be memory-mapped
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return [json.loads(line) for line in iter(mapped.readline, b"") if line.strip()]
+
+    def records(self) -> list[dict]:
+        """Returns the records, loading them on first use and reloading them if the file changed."""
+        import time
+
+        with self._lock:
+            now = time.monotonic()
+            if self._records is not None and now - self._checked_at < self.check_interval:
+                return self._records
+            self._checked_at = now
+            signature = self._stat_signature()
+            if self._records is None or signature != self._signature:
+                self._records = self._read()
+                self._signature = signature
+                self.version += 1
+            return self._records
+
+
+def write_jsonl(path: str, records):
+    """Writes records to a JSON Lines file, gzip-compressed if the path ends with ".gz".
+
+    The file is written next to its destination and then renamed over it, so a
+    `CalendarDataset` reading the same path never sees a partial file.
+    """
+    import gzip
+    import json
+    import os
+
+    tmp_path = f"{path}.tmp"
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(tmp_path, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _data_path(env_var: str, filename: str) -> str:
+    import os
+
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", filename)
+    return os.environ.get(env_var) or default
+
+
+# The calendar data lives in data/, or wherever these environment variables point
+EVENT_CALENDAR_DATASET = CalendarDataset(_data_path("AGENTSVILLE_EVENTS_PATH", "event_calendar.jsonl"))
+WEATHER_FORECAST_DATASET = CalendarDataset(_data_path("AGENTSVILLE_WEATHER_PATH", "weather_forecast.jsonl"))
+
+
+def __getattr__(name: str):
+    # EVENT_CALENDAR and WEATHER_FORECAST are loaded on first access, not at import time
+    if name == "EVENT_CALENDAR":
+        return EVENT_CALENDAR_DATASET.records()
+    if name == "WEATHER_FORECAST":
+        return WEATHER_FORECAST_DATASET.records()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+DEFAULT_CITY = "AgentsVille"
+
+
+class PriceKind(enum.Enum):
+    """How an event is priced. Only FIXED prices have a non-zero amount."""
+
+    FIXED = "fixed"
+    FREE = "free"
+    DONATION = "donation"
+    UNKNOWN = "unknown"
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_price_text(text: str) -> tuple[int | float, PriceKind]:
+    import re
+
+    normalized = text.strip().lower()
+    if normalized.startswith("free"):
+        return 0, PriceKind.FREE
+    if "donation" in normalized:
+        return 0, PriceKind.DONATION
+    match = re.match(r"^\$?\s*(\d+(?:\.\d+)?)", normalized)
+    if not match:
+        return 0, PriceKind.UNKNOWN
+    amount = float(match.group(1))
+    return (int(amount) if amount.is_integer() else amount), PriceKind.FIXED
+
+
+def parse_price(price) -> tuple[int | float, PriceKind]:
+    """Normalizes a price, as found in events or itineraries, to an (amount, kind) tuple.
+
+    Free, donation-based and unparseable prices have an amount of 0, so they can
+    be summed safely. Parsed strings are cached.
+
+    Examples:
+        >>> parse_price("10"), parse_price(12.5), parse_price("$7.50")
+        ((10, <PriceKind.FIXED: 'fixed'>), (12.5, <PriceKind.FIXED: 'fixed'>), (7.5, <PriceKind.FIXED: 'fixed'>))
+        >>> parse_price("Free"), parse_price("Donation-based"), parse_price("TBD")
+        ((0, <PriceKind.FREE: 'free'>), (0, <PriceKind.DONATION: 'donation'>), (0, <PriceKind.UNKNOWN: 'unknown'>))
+    """
+    if isinstance(price, (int, float)) and not isinstance(price, bool):
+        return price, PriceKind.FIXED
+    if not isinstance(price, str):
+        return 0, PriceKind.UNKNOWN
+    return _parse_price_text(price)
+
+
+def price_amount(price) -> int | float:
+    """Returns the numeric amount of a price, 0 unless it is a fixed price. See `parse_price`.
+
+    Examples:
+        >>> sum(price_amount(p) for p in ["10", 25, "Free", "Donation-based"])
+        35
+    """
+    return parse_price(price)[0]
+
+
+class EventRecord:
+    """A compact, typed calendar event.
+
+    The repeated strings (city, category and location) are interned, the price
+    is parsed once into `price_amount` and `price_kind`, and the start time is
+    parsed into `start`. `to_dict` gives back the dictionary shape returned by
+    the tools.
+
+    Examples:
+        >>> record = EventRecord.from_dict({"name": "Jazz Night", "time": "2025-06-10 20:00",
+        ...     "location": "Riverfront Stage", "category": "Music", "description": "Live jazz.",
+        ...     "price": "Donation-based"})
+        >>> record.start.hour, record.price_amount, record.price_kind, record.city
+        (20, 0, <PriceKind.DONATION: 'donation'>, 'AgentsVille')
+        >>> record.to_dict()["price"]
+        'Donation-based'
+    """
+
+    __slots__ = (
+        "name",
+        "time",
+        "start",
+        "location",
+        "category",
+        "description",
+        "price",
+        "price_amount",
+        "price_kind",
+        "city",
+    )
+
+    def __init__(self, name, time, location, category, description, price, city=DEFAULT_CITY):
+        import datetime
+        import sys
+
+        self.name = name
+        self.time = time
+        self.start = datetime.datetime.fromisoformat(time)
+        self.location = sys.intern(location)
+        self.category = sys.intern(category)
+        self.description = description
+        self.price = price
+        self.price_amount, self.price_kind = parse_price(price)
+        self.city = sys.intern(city)
+
+    def __repr__(self):
+        return f"EventRecord({self.name!r}, {self.time!r}, city={self.city!r})"
+
+    @classmethod
+    def from_dict(cls, event: dict, city: str | None = None) -> "EventRecord":
+        """Creates a record from an event dictionary.
+
+        Args:
+            event: The event. Its "city" key, if any, takes precedence over `city`.
+            city: The city of the event. Defaults to DEFAULT_CITY.
+        """
+        return cls(
+            event["name"],
+            event["time"],
+            str(event.get("location", "")),
+            str(event.get("category", "")),
+            event.get("description", ""),
+            event.get("price", ""),
+            event.get("city") or city or DEFAULT_CITY,
+        )
+
+    def to_dict(self) -> dict:
+        """Returns the event in the dictionary shape returned by the tools."""
+        return {
+            "name": self.name,
+            "time": self.time,
+            "location": self.location,
+            "category": self.category,
+            "description": self.description,
+            "price": self.price,
+        }
+
+
+class EventStore:
+    """An indexed, multi-city store of calendar events.
+
+    Events are indexed by (city, date), by (city, category) and by start time so
+    that the tools used by the agents do not need to scan the whole calendar on
+    every call. Date lookups are O(1); category and time range queries are
+    O(log n) plus the size of the result.
+
+    Events are added as dictionaries, as found in `EVENT_CALENDAR`, or as
+    `EventRecord`s, and kept as compact records. Queries return dictionaries in
+    the shape of `EVENT_CALENDAR`, or the records themselves with
+    as_records=True. If an event has no "city" key, the city passed to `add`
+    (or the store default) is used.
+
+    Examples:
+        >>> store = EventStore(EVENT_CALENDAR_DATASET.records())
+        >>> [e["name"] for e in store.by_date("AgentsVille", "2025-06-10")][:2]
+        ['Yoga in the Park', 'Capture the Moment: Photography Workshop']
+        >>> len(store.in_range("AgentsVille", "2025-06-10 18:00", "2025-06-10 20:00"))
+        5
+        >>> store.date_range("AgentsVille")
+        ('2025-06-10', '2025-06-15')
+    """
+
+    def __init__(self, events=(), default_city: str = DEFAULT_CITY):
+        self.default_city = default_city
+        # city -> events sorted by start time, with a parallel list of sort keys
+        self._events_by_city: dict[str, list[EventRecord]] = {}
+        self._times_by_city: dict[str, list[str]] = {}
+        # (city, date) -> events sorted by start time
+        self._by_city_date: dict[tuple[str, str], list[EventRecord]] = {}
+        # (city, lowercased category) -> events sorted by start time
+        self._by_category: dict[tuple[str, str], list[EventRecord]] = {}
+        self._category_times: dict[tuple[str, str], list[str]] = {}
+
+        if events:
+            self.add_many(events)
+
+    def __len__(self):
+        return sum(len(events) for events in self._events_by_city.values())
+
+    def _record_of(self, event, city=None) -> EventRecord:
+        if isinstance(event, EventRecord):
+            return event
+        return EventRecord.from_dict(event, city or self.default_city)
+
+    def add(self, event: dict | EventRecord, city: str | None = None):
+        """Adds a single event to the store, keeping all indexes sorted by time.
+
+        Args:
+            event: The event to add. Must have a "time" key in "YYYY-MM-DD HH:MM" format.
+            city: The city of the event, if the event itself has no "city" key.
+        """
+        from bisect import bisect_right
+
+        event = self._record_of(event, city)
+        city = event.city
+        time = event.time
+
+        times = self._times_by_city.setdefault(city, [])
+        idx = bisect_right(times, time)
+        times.insert(idx, time)
+        self._events_by_city.setdefault(city, []).insert(idx, event)
+
+        day = self._by_city_date.setdefault((city, time[:10]), [])
+        day.insert(bisect_right([e.time for e in day], time), event)
+
+        key = (city, event.category.lower())
+        category_times = self._category_times.setdefault(key, [])
+        idx = bisect_right(category_times, time)
+        category_times.insert(idx, time)
+        self._by_category.setdefault(key, []).insert(idx, event)
+
+    def add_many(self, events, city: str | None = None):
+        """Adds many events at once.
+
+        This is much faster than calling `add` repeatedly for large calendars,
+        since each index is sorted only once. Sorting is stable, so events that
+        start at the same time keep their original order.
+
+        Args:
+            events: An iterable of events.
+            city: The city of the events that have no "city" key.
+        """
+        touched_cities = set()
+        touched_dates = set()
+        touched_categories = set()
+
+        for event in events:
+            event = self._record_of(event, city)
+            event_city = event.city
+            time = event.time
+            self._events_by_city.setdefault(event_city, []).append(event)
+            self._by_city_date.setdefault((event_city, time[:10]), []).append(event)
+            key = (event_city, event.category.lower())
+            self._by_category.setdefault(key, []).append(event)
+
+            touched_cities.add(event_city)
+            touched_dates.add((event_city, time[:10]))
+            touched_categories.add(key)
+
+        def by_time(event):
+            return event.time
+
+        for event_city in touched_cities:
+            self._events_by_city[event_city].sort(key=by_time)
+            self._times_by_city[event_city] = [
+                e.time for e in self._events_by_city[event_city]
+            ]
+        for key in touched_dates:
+            self._by_city_date[key].sort(key=by_time)
+        for key in touched_categories:
+            self._by_category[key].sort(key=by_time)
+            self._category_times[key] = [e.time for e in self._by_category[key]]
+
+    def cities(self) -> list[str]:
+        """Returns the cities with at least one event, sorted alphabetically."""
+        return sorted(self._events_by_city)
+
+    def has_city(self, city: str) -> bool:
+        """Returns True if the store has any events for the given city."""
+        return city in self._events_by_city
+
+    def date_range(self, city: str) -> tuple[str, str] | None:
+        """Returns the (first, last) dates with events for a city, or None."""
+        times = self._times_by_city.get(city)
+        if not times:
+            return None
+        return times[0][:10], times[-1][:10]
+
+    @staticmethod
+    def _output(records, as_records):
+        return list(records) if as_records else [record.to_dict() for record in records]
+
+    def by_date(self, city: str, date: str, as_records: bool = False) -> list[dict]:
+        """Returns the events for a city on a given date (YYYY-MM-DD), sorted by time."""
+        return self._output(self._by_city_date.get((city, date), ()), as_records)
+
+    def in_range(self, city: str, start: str, end: str, as_records: bool = False) -> list[dict]:
+        """Returns the events for a city starting between `start` and `end` (inclusive).
+
+        Args:
+            city: The city to get events for.
+            start: The start of the range, as "YYYY-MM-DD" or "YYYY-MM-DD HH:MM".
+            end: The end of the range, as "YYYY-MM-DD" or "YYYY-MM-DD HH:MM". A bare
+                date includes the whole day.
+            as_records: Whether to return `EventRecord`s instead of dictionaries.
+
+        Returns:
+            The matching events, sorted by time.
+        """
+        records = self._slice(
+            self._events_by_city.get(city, []),
+            self._times_by_city.get(city, []),
+            start,
+            end,
+        )
+        return self._output(records, as_records)
+
+    def by_category(
+        self,
+        city: str,
+        category: str,
+        start: str | None = None,
+        end: str | None = None,
+        as_records: bool = False,
+    ) -> list[dict]:
+        """Returns the events of a category (case-insensitive) for a city.
+
+        Args:
+            city: The city to get events for.
+            category: The event category, e.g. "Music".
+            start: Optional start of a time range, see `in_range`.
+            end: Optional end of a time range, see `in_range`.
+            as_records: Whether to return `EventRecord`s instead of dictionaries.
+
+        Returns:
+            The matching events, sorted by time.
+        """
+        key = (city, category.lower())
+        records = self._slice(
+            self._by_category.get(key, []),
+            self._category_times.get(key, []),
+            start,
+            end,
+        )
+        return self._output(records, as_records)
+
+    @staticmethod
+    def _slice(events, times, start, end):
+        from bisect import bisect_left, bisect_right
+
+        lo = 0 if start is None else bisect_left(times, start)
+        if end is None:
+            hi = len(times)
+        else:
+            # A bare date should include every event on that day
+            hi = bisect_right(times, end + "\uffff" if len(end) == 10 else end)
+        return events[lo:hi]
+
+
+_EVENT_STORE = None
+# The EVENT_CALENDAR_DATASET version the store was built from, or None if it was set explicitly
+_EVENT_STORE_VERSION = None
+
+
+def get_event_store() -> EventStore:
+    """Returns the module-level EventStore.
+
+    Unless a store was set with `set_event_store`, it is built from
+    EVENT_CALENDAR_DATASET on first use and rebuilt whenever the data file changes.
+    """
+    global _EVENT_STORE, _EVENT_STORE_VERSION
+
+    if _EVENT_STORE is None or _EVENT_STORE_VERSION is not None:
+        records = EVENT_CALENDAR_DATASET.records()
+        if _EVENT_STORE is None or _EVENT_STORE_VERSION != EVENT_CALENDAR_DATASET.version:
+            _EVENT_STORE = EventStore(records)
+            _EVENT_STORE_VERSION = EVENT_CALENDAR_DATASET.version
+    return _EVENT_STORE
+
+
+def set_event_store(store: EventStore | None):
+    """Replaces the module-level EventStore used by `get_events`.
+
+    Args:
+        store: The new store, or None to go back to the default store, built from
+            EVENT_CALENDAR_DATASET on next use.
+    """
+    global _EVENT_STORE, _EVENT_STORE_VERSION
+
+    _EVENT_STORE = store
+    _EVENT_STORE_VERSION = None
+
+
+def get_events(date: str, city: str, max_events=5) -> list[dict[str, str | int]]:
+    """Returns a list of events for a given date and city.
+
+    Args:
+        date: The date to get events for. Must be in the format YYYY-MM-DD.
+        city: The city to get events for.
+        max_events: The maximum number of events to return.
+
+    Returns:
+        A list of events for the given date and city, sorted by time. Events are
+        looked up in the module-level EventStore (see `get_event_store`), which
+        by default holds the AgentsVille events between 2025-06-10 and 2025-06-15.
+
+    Examples:
+        >>> from pprint import pprint
+        >>> pprint(get_events("2025-06-10", "AgentsVille")[0])
+        {'category': 'Fitness',
+         'description': 'Join us for a refreshing outdoor yoga session with certified '
+                        'instructor Maria Zen. This all-levels class will focus on '
+                        'breathwork, stretching, and relaxation, set against the '
+                        'beautiful backdrop of the Riverfront. Attendees are '
+                        'encouraged to bring their own mats and water. Perfect for '
+                        'anyone seeking to improve their mental and physical '
+                        'well-being in a tranquil environment. Note: This event is '
+                        'suitable for all ages; however, some poses may require '
+                        'modification for beginners or those with physical '
+                        'limitations.',
+         'location': 'Riverfront Stage',
+         'name': 'Yoga in the Park',
+         'price': '10',
+         'time': '2025-06-10 13:00'}
+    """
+    import datetime
+
+    store = get_event_store()
+
+    # If the city has no events, return an empty list
+    if not store.has_city(city):
+        return []
+
+    # Verify the date format
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        print(f"Invalid date format: {date}")
+        return []
+
+    # If the date is outside the calendar of the city, return an empty list
+    first_date, last_date = store.date_range(city)
+    if date < first_date or date > last_date:
+        print(f"Date {date} is outside the valid range ({first_date} - {last_date})")
+        return []
+
+    return [record.to_dict() for record in store.by_date(city, date, as_records=True)[:max_events]]
+
+
+class WeatherStore:
+    """A multi-city store of daily weather forecasts, indexed by (city, date).
+
+    Forecasts are plain dictionaries as found in `WEATHER_FORECAST`. If a
+    forecast has no "city" key, the store default city is used.
+
+    Examples:
+        >>> store = WeatherStore(WEATHER_FORECAST_DATASET.records())
+        >>> store.get("AgentsVille", "2025-06-12")["condition"]
+        'thunderstorm'
+        >>> store.date_range("AgentsVille")
+        ('2025-06-10', '2025-06-15')
+    """
+
+    def __init__(self, forecasts=(), default_city: str = DEFAULT_CITY):
+        self.default_city = default_city
+        self._by_city_date: dict[tuple[str, str], dict] = {}
+        self._dates_by_city: dict[str, list[str]] = {}
+        if forecasts:
+            self.add_many(forecasts)
+
+    def __len__(self):
+        return len(self._by_city_date)
+
+    def add_many(self, forecasts):
+        """Adds forecasts, replacing any earlier forecast for the same city and date."""
+        touched = set()
+        for forecast in forecasts:
+            city = forecast.get("city") or self.default_city
+            if (city, forecast["date"]) not in self._by_city_date:
+                self._dates_by_city.setdefault(city, []).append(forecast["date"])
+            self._by_city_date[(city, forecast["date"])] = forecast
+            touched.add(city)
+        for city in touched:
+            self._dates_by_city[city].sort()
+
+    def cities(self) -> list[str]:
+        return sorted(self._dates_by_city)
+
+    def has_city(self, city: str) -> bool:
+        return city in self._dates_by_city
+
+    def date_range(self, city: str) -> tuple[str, str] | None:
+        """Returns the (first, last) forecast dates for a city, or None."""
+        dates = self._dates_by_city.get(city)
+        if not dates:
+            return None
+        return dates[0], dates[-1]
+
+    def get(self, city: str, date: str) -> dict | None:
+        return self._by_city_date.get((city, date))
+
+
+_WEATHER_STORE = None
+# The WEATHER_FORECAST_DATASET version the store was built from, or None if it was set explicitly
+_WEATHER_STORE_VERSION = None
+
+
+def get_weather_store() -> WeatherStore:
+    """Returns the module-level WeatherStore.
+
+    Unless a store was set with `set_weather_store`, it is built from
+    WEATHER_FORECAST_DATASET on first use and rebuilt whenever the data file changes.
+    """
+    global _WEATHER_STORE, _WEATHER_STORE_VERSION
+
+    if _WEATHER_STORE is None or _WEATHER_STORE_VERSION is not None:
+        records = WEATHER_FORECAST_DATASET.records()
+        if _WEATHER_STORE is None or _WEATHER_STORE_VERSION != WEATHER_FORECAST_DATASET.version:
+            _WEATHER_STORE = WeatherStore(records)
+            _WEATHER_STORE_VERSION = WEATHER_FORECAST_DATASET.version
+    return _WEATHER_STORE
+
+
+def set_weather_store(store: WeatherStore | None):
+    """Replaces the module-level WeatherStore used by `get_weather`.
+
+    Args:
+        store: The new store, or None to go back to the default store, built from
+            WEATHER_FORECAST_DATASET on next use.
+    """
+    global _WEATHER_STORE, _WEATHER_STORE_VERSION
+
+    _WEATHER_STORE = store
+    _WEATHER_STORE_VERSION = None
+
+
+@contextlib.contextmanager
+def use_calendar(events: list[dict], forecasts: list[dict]):
+    """Swaps in event and weather stores built from these records.
+
+    Stores built from the data files are rebuilt afterwards rather than
+    restored, so they keep reloading when the files change.
+
+    Args:
+        events: Event records, shaped like EVENT_CALENDAR.
+        forecasts: Weather records, shaped like WEATHER_FORECAST.
+
+    Examples:
+        >>> forecast = {"date": "2025-06-10", "city": "Nowhere", "temperature": 20,
+        ...     "temperature_unit": "celsius", "condition": "foggy", "description": "Fog."}
+        >>> with use_calendar([], [forecast]):
+        ...     get_weather("2025-06-10", "Nowhere")["condition"]
+        'foggy'
+    """
+    previous_events = None if _EVENT_STORE_VERSION is not None else _EVENT_STORE
+    previous_weather = None if _WEATHER_STORE_VERSION is not None else _WEATHER_STORE
+    set_event_store(EventStore(events))
+    set_weather_store(WeatherStore(forecasts))
+    try:
+        yield
+    finally:
+        set_event_store(previous_events)
+        set_weather_store(previous_weather)
+
+
+def get_weather(date: str, city: str) -> dict[str, str | int]:
+    """
+    Returns the weather forecast for a given date and city.
+
+    Args:
+        date: The date to get weather for. Must be in the format YYYY-MM-DD.
+        city: The city to get weather for.
+
+    Returns:
+        A dictionary containing the weather forecast for the given date and city.
+        Forecasts are looked up in the module-level WeatherStore (see
+        `get_weather_store`), which by default holds the AgentsVille forecasts
+        between 2025-06-10 and 2025-06-15.
+    """
+    import datetime
+
+    store = get_weather_store()
+
+    # If the city has no forecasts, return an empty dictionary
+    if not store.has_city(city):
+        return {}
+
+    # Verify the date format
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        print(f"Invalid date format: {date}")
+        return {}
+
+    # If the date is outside the forecasts of the city, return an empty dictionary
+    first_date, last_date = store.date_range(city)
+    if date < first_date or date > last_date:
+        print(f"Date {date} is outside the valid range ({first_date} - {last_date})")
+        return {}
+
+    return store.get(city, date) or {}
+
+
+def trip_dates(vacation_info: dict) -> list[str]:
+    """Returns the dates of a trip, from arrival to departure, as YYYY-MM-DD.
+
+    Examples:
+        >>> trip_dates({"date_of_arrival": "2025-06-10", "date_of_departure": "2025-06-12"})
+        ['2025-06-10', '2025-06-11', '2025-06-12']
+    """
+    import datetime
+
+    first = datetime.date.fromisoformat(vacation_info["date_of_arrival"])
+    last = datetime.date.fromisoformat(vacation_info["date_of_departure"])
+    return [(first + datetime.timedelta(days=n)).isoformat() for n in range((last - first).days + 1)]
+
+
+def prefetch_trip_data(vacation_info: dict, fetchers: dict | None = None, max_workers: int = 8) -> dict:
+    """Fetches the data of every trip date concurrently, before an agent asks for it.
+
+    Args:
+        vacation_info: The vacation info, with the destination and dates.
+        fetchers: Functions called as fn(date=..., city=...), keyed by the name of
+            their result. Defaults to `get_weather` as "weather" and `get_events`
+            as "activities".
+        max_workers: The maximum number of concurrent fetches.
+
+    Returns:
+        A dict of {date: {name: result}}.
+
+    Examples:
+        >>> data = prefetch_trip_data({"destination": "AgentsVille",
+        ...     "date_of_arrival": "2025-06-10", "date_of_departure": "2025-06-11"})
+        >>> data["2025-06-11"]["weather"]["condition"], len(data["2025-06-10"]["activities"])
+        ('partly cloudy', 5)
+    """
+    fetchers = fetchers or {"weather": get_weather, "activities": get_events}
+    city = vacation_info["destination"]
+    jobs = [(date, name) for date in trip_dates(vacation_info) for name in fetchers]
+    results = run_concurrently(
+        lambda job: fetchers[job[1]](date=job[0], city=city), jobs, max_workers=max_workers
+    )
+    data = {}
+    for (date, name), result in zip(jobs, results):
+        data.setdefault(date, {})[name] = result
+    return data
+
+
+def narrate_my_trip(vacation_info, itinerary, filename="speech.mp3"):
+    from IPython.display import Audio, Markdown, display
+
+    resp = do_chat_completion(
+        messages=[
+            {
+                "role": "user",
+                "content": f"""
+                Here is information on the trip collected by the Onboarding Agent:
+                {vacation_info}.
+
+                Here is the final itinerary:
+                {itinerary}
+                
+                Introduce the trip (travelers, interests, restrictions, and total cost) and
+                then discuss each day of the itinerary.
+
+                Do not specify the cost of each activity.
+
+                Do not reference the the narrative itself in the response.
+                """,
+            }
+        ]
+    )
+    display(Markdown(resp))
+
+    backend = get_llm_backend()
+    backend.speech_to_file(
+        resp,
+        filename,
+        model=backend.config.tts_model,
+        voice="coral",
+        instructions="Speak in a cheerful and positive tone.",
+    )
+
+    display(Audio(filename))
+
+
+# List of available tools and their descriptions
+TOOLS = [
+    {
+        "name": "weather",
+        "description": "Get weather conditions for specific dates and locations",
+        "purpose": "Verify weather compatibility with planned activities",
+        "parameters": '{"tool": "weather", "date": "YYYY-MM-DD", "city": "CityName"}',
         "use_when": "Evaluation shows weather-activity conflicts"
     },
     {
@@ -825,14 +4279,1239 @@ TOOLS = [
     },
 ]
 
-def get_tool_descriptions_string():
+def get_tool_descriptions_string():
+    """
+    Returns a formatted string of all available tools and their descriptions for prompt insertion.
+    """
+    lines = ["### Available Tools and Their Purposes:\n"]
+    for idx, tool in enumerate(TOOLS, 1):
+        lines.append(f"{idx}. **{tool['name']}** – {tool['description']}")
+        lines.append(f"   - Purpose: {tool['purpose']}")
+        lines.append(f"   - Parameters: {tool['parameters']}")
+        lines.append(f"   - Use when: {tool['use_when']}\n")
+    return "\n".join(lines)
+
+
+def run_concurrently(fn, items, max_workers: int = 8) -> list:
+    """Calls `fn` on every item using a bounded pool of worker threads.
+
+    Args:
+        fn: The function to call with each item.
+        items: The items to process.
+        max_workers: The maximum number of concurrent calls.
+
+    Returns:
+        list: The results, in the same order as `items`.
+
+    Raises:
+        Exception: The first exception raised by `fn`, in item order.
+
+    Examples:
+        >>> run_concurrently(lambda x: x * x, [1, 2, 3])
+        [1, 4, 9]
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [fn(item) for item in items]
+
+    # Worker threads do not inherit context variables, so each call runs in a
+    # copy of the caller's context (e.g. the active judgment session)
+    contexts = [contextvars.copy_context() for _ in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(
+            executor.map(lambda ctx, item: ctx.run(fn, item), contexts, items)
+        )
+
+
+def run_tool_calls(calls: list[dict], tools: dict, max_workers: int = 8) -> list[dict]:
+    """Runs tool invocations concurrently, as parsed by `parse_act`.
+
+    Each invocation is a dict with a "tool" name and the tool's keyword
+    arguments. A failing invocation does not stop the others: its error is
+    returned in place of its result, so the agent can correct it.
+
+    Args:
+        calls: The invocations.
+        tools: The tool functions, keyed by name.
+        max_workers: The maximum number of tools running at once.
+
+    Returns:
+        One dict per invocation, in order: the invocation with a "result" or
+        an "error" key added.
+
+    Examples:
+        >>> tools = {"double": lambda x: 2 * x}
+        >>> run_tool_calls([{"tool": "double", "x": 2}, {"tool": "double"}, {"tool": "nope"}], tools)  # doctest: +ELLIPSIS
+        [{'tool': 'double', 'x': 2, 'result': 4}, {'tool': 'double', 'error': "TypeError: ...missing 1 required positional argument: 'x'"}, {'tool': 'nope', 'error': 'Unknown tool: nope'}]
     """
-    Returns a formatted string of all available tools and their descriptions for prompt insertion.
+
+    def run(call):
+        arguments = {key: value for key, value in call.items() if key != "tool"}
+        tool = tools.get(call.get("tool"))
+        if tool is None:
+            return {**call, "error": f"Unknown tool: {call.get('tool')}"}
+        try:
+            return {**call, "result": tool(**arguments)}
+        except Exception as e:
+            return {**call, "error": f"{type(e).__name__}: {e}"}
+
+    return run_concurrently(run, calls, max_workers=max_workers)
+
+
+class EvalReport(list):
+    """The error messages of an evaluation run, with per-eval timings.
+
+    An EvalReport is a list of error messages, so it can be used anywhere the
+    plain list returned by `get_eval_results` was used before.
+
+    Attributes:
+        timings: Seconds spent in each eval function, keyed by function name.
+        skipped: Names of eval functions not run because of fail-fast.
+        wall_time: Total seconds spent running the suite.
     """
-    lines = ["### Available Tools and Their Purposes:\n"]
-    for idx, tool in enumerate(TOOLS, 1):
-        lines.append(f"{idx}. **{tool['name']}** – {tool['description']}")
-        lines.append(f"   - Purpose: {tool['purpose']}")
-        lines.append(f"   - Parameters: {tool['parameters']}")
-        lines.append(f"   - Use when: {tool['use_when']}\n")
-    return "\n".join(lines)
+
+    def __init__(self, errors=(), timings=None, skipped=None, wall_time=0.0):
+        super().__init__(errors)
+        self.timings = dict(timings or {})
+        self.skipped = list(skipped or [])
+        self.wall_time = wall_time
+
+
+def run_eval_suite(
+    vacation_info,
+    final_output,
+    deterministic_evals,
+    llm_evals,
+    error_type: type[Exception] = Exception,
+    max_workers: int = 4,
+    fail_fast: bool = False,
+) -> EvalReport:
+    """Runs evaluation functions, cheap deterministic ones first.
+
+    Deterministic evals run one after another. Evals that make LLM calls then
+    run concurrently in a bounded thread pool. With `fail_fast`, the suite stops
+    at the first failure and LLM evals that have not started are skipped.
+
+    Each eval function is called with (vacation_info, final_output) and signals
+    failure by raising `error_type`. Other exceptions propagate. Evals run
+    with the "bulk" LLM priority (see `llm_priority`).
+
+    Args:
+        vacation_info: The vacation information.
+        final_output: The itinerary to evaluate.
+        deterministic_evals: Eval functions that do not call an LLM.
+        llm_evals: Eval functions that call an LLM.
+        error_type: The exception type raised by failing evals.
+        max_workers: How many LLM evals may run at once.
+        fail_fast: Whether to stop at the first failing eval.
+
+    Returns:
+        EvalReport: The error messages, in the order of the eval functions.
+
+    Examples:
+        >>> def ok(vacation_info, final_output):
+        ...     pass
+        >>> def bad(vacation_info, final_output):
+        ...     raise ValueError("bad")
+        >>> report = run_eval_suite({}, {}, [ok, bad], [ok], error_type=ValueError)
+        >>> list(report), sorted(report.timings)
+        (['bad'], ['bad', 'ok'])
+        >>> run_eval_suite({}, {}, [bad], [ok], ValueError, fail_fast=True).skipped
+        ['ok']
+    """
+    import time
+    from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+    suite_start = time.perf_counter()
+    errors = {}
+    timings = {}
+
+    def run_one(eval_fn):
+        start = time.perf_counter()
+        try:
+            # Eval judgments are bulk work: interactive LLM calls go first
+            with span("eval", eval_function=eval_fn.__name__), llm_priority("bulk"):
+                eval_fn(vacation_info, final_output)
+        except error_type as e:
+            errors[eval_fn] = str(e)
+            if fail_fast:
+                raise
+        finally:
+            timings[eval_fn.__name__] = time.perf_counter() - start
+
+    def report(skipped=()):
+        order = list(deterministic_evals) + list(llm_evals)
+        return EvalReport(
+            [errors[fn] for fn in order if fn in errors],
+            timings=timings,
+            skipped=[fn.__name__ for fn in skipped],
+            wall_time=time.perf_counter() - suite_start,
+        )
+
+    for idx, eval_fn in enumerate(deterministic_evals):
+        try:
+            run_one(eval_fn)
+        except error_type:
+            return report(list(deterministic_evals)[idx + 1 :] + list(llm_evals))
+
+    if not llm_evals:
+        return report()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(llm_evals))))
+    futures = {
+        executor.submit(contextvars.copy_context().run, run_one, eval_fn): eval_fn
+        for eval_fn in llm_evals
+    }
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    if not_done and fail_fast:
+        # Stop evals that have not started yet; running ones finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
+        skipped = [futures[f] for f in not_done if f.cancelled()]
+    else:
+        executor.shutdown(wait=True)
+        skipped = []
+
+    for future in futures:
+        if future.done() and not future.cancelled():
+            exc = future.exception()
+            if exc is not None and not isinstance(exc, error_type):
+                raise exc
+
+    return report(skipped)
+
+
+def format_numbered_questions(queries: list[str]) -> str:
+    """Formats questions for a batched yes/no request.
+
+    Examples:
+        >>> print(format_numbered_questions(["Is it sunny?", "Is it late?"]))
+        <question id=1>
+        Is it sunny?
+        </question>
+        <question id=2>
+        Is it late?
+        </question>
+    """
+    return "\n".join(
+        f"<question id={idx}>\n{query}\n</question>"
+        for idx, query in enumerate(queries, 1)
+    )
+
+
+def parse_numbered_bool_responses(text: str) -> dict[int, bool | None]:
+    """Parses the answers to a batched yes/no request.
+
+    Accepts `<response id=N>True|False|None</response>` tags with any quoting,
+    spacing or case, and Yes/No as synonyms. The last answer for an id wins, so
+    models that correct themselves are handled.
+
+    Args:
+        text: The model response.
+
+    Returns:
+        dict[int, bool | None]: The answer for each id that could be parsed. Ids
+        without a parsable answer are missing from the result.
+
+    Examples:
+        >>> parse_numbered_bool_responses(
+        ...     "<think>...</think><response id=1>True</response>"
+        ...     "<response id='2'> false </response><RESPONSE ID=3>None</RESPONSE>"
+        ...     "<response id=4>maybe</response>"
+        ... )
+        {1: True, 2: False, 3: None}
+    """
+    import re
+
+    values = {"true": True, "yes": True, "false": False, "no": False, "none": None}
+    pattern = re.compile(
+        r"<response\s+id\s*=\s*[\"']?(\d+)[\"']?\s*>\s*(\w+)\s*</response>",
+        re.IGNORECASE,
+    )
+    answers = {}
+    for match in pattern.finditer(text):
+        value = match.group(2).lower()
+        if value in values:
+            answers[int(match.group(1))] = values[value]
+    return answers
+
+
+class JudgmentUnit:
+    """A single LLM judgment, identified by the inputs it depends on.
+
+    The fingerprint is a hash of the kind of question and of its inputs (e.g.
+    the activity and a traveler's interests), so an unchanged unit of an
+    itinerary maps to the same fingerprint across revisions, whatever day it
+    is scheduled on.
+
+    Attributes:
+        kind: The kind of question, e.g. "matches_interests".
+        inputs: The values the answer depends on.
+        query: The question sent to the LLM.
+
+    Examples:
+        >>> a = JudgmentUnit("outdoors", {"activity": {"name": "Yoga"}}, "Is it outdoors?")
+        >>> b = JudgmentUnit("outdoors", {"activity": {"name": "Yoga"}}, "Outdoors?")
+        >>> a.fingerprint == b.fingerprint
+        True
+    """
+
+    __slots__ = ("kind", "inputs", "query", "_fingerprint")
+
+    def __init__(self, kind: str, inputs: dict, query: str):
+        self.kind = kind
+        self.inputs = inputs
+        self.query = query
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self) -> str:
+        """A content hash of the kind and inputs of the judgment."""
+        import hashlib
+        import json
+
+        if self._fingerprint is None:
+            payload = json.dumps(
+                [self.kind, self.inputs], sort_keys=True, default=str, ensure_ascii=False
+            )
+            self._fingerprint = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return self._fingerprint
+
+    def __repr__(self):
+        return f"JudgmentUnit({self.kind!r}, {self.fingerprint[:12]})"
+
+
+class JudgmentSession:
+    """Keeps the LLM judgments made during a session, for incremental re-evaluation.
+
+    When an itinerary is evaluated again after a revision, only the units whose
+    inputs changed are sent to the LLM. The answers for the other units are
+    reused, and aggregate checks are recomputed from them.
+
+    Attributes:
+        hits: Number of judgments served from the session.
+        misses: Number of judgments sent to the LLM.
+
+    Examples:
+        >>> session = JudgmentSession()
+        >>> asked = []
+        >>> def ask(queries):
+        ...     asked.extend(queries)
+        ...     return [True] * len(queries)
+        >>> units = [JudgmentUnit("outdoors", {"activity": "Yoga"}, "Is Yoga outdoors?")]
+        >>> session.resolve(units, ask), session.resolve(units, ask)
+        ([True], [True])
+        >>> asked, session.hits, session.misses
+        (['Is Yoga outdoors?'], 1, 1)
+    """
+
+    def __init__(self):
+        self._results: dict[tuple[str, str], bool | None] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def resolve(self, units: list[JudgmentUnit], ask, namespace: str = "") -> list:
+        """Answers judgment units, asking the LLM only for unseen fingerprints.
+
+        Args:
+            units: The judgments to answer.
+            ask: A function that takes a list of queries and returns their answers.
+            namespace: Separates judgments made by different agents or prompts.
+
+        Returns:
+            list: The answers, in the same order as the units.
+        """
+        keys = [(namespace, unit.fingerprint) for unit in units]
+        with self._lock:
+            missing = {}
+            for key, unit in zip(keys, units):
+                if key not in self._results and key not in missing:
+                    missing[key] = unit
+            self.hits += len(units) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            answers = ask([unit.query for unit in missing.values()])
+            with self._lock:
+                self._results.update(zip(missing, answers))
+
+        with self._lock:
+            return [self._results[key] for key in keys]
+
+    def stats(self) -> dict[str, int]:
+        """Returns the hit/miss counters and the number of stored judgments."""
+        return {"hits": self.hits, "misses": self.misses, "judgments": len(self)}
+
+
+_JUDGMENT_SESSION = contextvars.ContextVar("judgment_session", default=None)
+
+
+def get_judgment_session() -> JudgmentSession | None:
+    """Returns the judgment session active in the current context, if any."""
+    return _JUDGMENT_SESSION.get()
+
+
+@contextlib.contextmanager
+def judgment_session(session: JudgmentSession | None = None):
+    """Makes a JudgmentSession active in the current context.
+
+    Code running inside the block (including threads started with
+    `run_concurrently` and `run_eval_suite`) can reach the session with
+    `get_judgment_session`.
+
+    Args:
+        session: The session to activate. A new one is created if omitted.
+
+    Yields:
+        JudgmentSession: The active session.
+
+    Examples:
+        >>> with judgment_session() as session:
+        ...     get_judgment_session() is session
+        True
+        >>> get_judgment_session() is None
+        True
+    """
+    session = session if session is not None else JudgmentSession()
+    token = _JUDGMENT_SESSION.set(session)
+    try:
+        yield session
+    finally:
+        _JUDGMENT_SESSION.reset(token)
+
+
+class LocalClassification:
+    """The answer of the local pre-classifier to a yes/no question.
+
+    Attributes:
+        answer: The predicted answer.
+        confidence: How sure the classifier is, between 0.5 and 1.
+        evidence: The keywords that led to the answer.
+    """
+
+    __slots__ = ("answer", "confidence", "evidence")
+
+    def __init__(self, answer: bool, confidence: float, evidence=()):
+        self.answer = answer
+        self.confidence = confidence
+        self.evidence = tuple(evidence)
+
+    def __repr__(self):
+        return (
+            f"LocalClassification(answer={self.answer}, "
+            f"confidence={self.confidence:.2f}, evidence={self.evidence})"
+        )
+
+
+# Keyword rules of the local pre-classifier. Each rule maps a regular expression
+# to a weight; a location match is strong evidence, a description cue is weak.
+_OUTDOOR_LOCATION_RULES = {
+    r"\b(park|beach|boardwalk|gardens?|plaza|square|riverfront|waterfront|trail|"
+    r"field|courts?|pier|harbou?r|lake|stadium|fairgrounds|zoo|vineyard)\b": 3,
+}
+_INDOOR_LOCATION_RULES = {
+    r"\b(library|cent(er|re)|theat(er|re)|museum|gallery|hall|caf[eé]|restaurant|"
+    r"studio|arena|auditorium|bookstore|shop|mall|kitchen|school|club|cinema|hotel)\b": 3,
+}
+_OUTDOOR_DESCRIPTION_RULES = {
+    r"\b(outdoors?|open[- ]air|under the stars|in the park|hike|hiking|picnic)\b": 1,
+}
+_INDOOR_DESCRIPTION_RULES = {r"\b(indoors?)\b": 1}
+_FOOD_CATEGORY_RULES = {
+    r"\b(culinary|food|dining|restaurant|tasting|gastronomy|cooking)\b": 3,
+}
+_FOOD_DESCRIPTION_RULES = {
+    r"\b(foods?|dish(es)?|tast(e|ing)|dinner|lunch|breakfast|brunch|snacks?|"
+    r"refreshments?|drinks?|wine|beer|cocktails?|coffee|tea|desserts?|food trucks?|"
+    r"picnic|eat|eating|cook(ing)?|meals?|buffet|bbq|barbecue|pizza|tacos|"
+    r"burgers?|cheeseburgers?|brownies?|tiramisu|pasta|hungry|treats?|ice cream|grill(ed)?)\b": 2,
+}
+_BAD_WEATHER_RULES = {
+    r"\b(thunderstorms?|storms?|stormy|rain|rainy|showers|downpour|snow|snowy|hail|"
+    r"blizzard|hurricane|tornado|sleet|lightning|heavy|gales?|freezing|typhoon)\b": 3,
+    r"\b(extremely (cold|hot)|extreme heat|heat ?wave|strong winds)\b": 3,
+    r"\b(drizzle|windy|gusty)\b": 1,
+}
+_GOOD_WEATHER_RULES = {
+    r"\b(clear|sunny|sunshine|bright|fair|mild|pleasant)\b": 3,
+    r"\b(partly cloudy|cloudy|overcast|breezy|warm)\b": 1,
+}
+# Negated mentions such as "no chance of rain" are not evidence
+_NEGATION_PATTERN = r"\b(no|without|zero)\s+(chance\s+of\s+|sign\s+of\s+)?\w+"
+
+
+def _score_rules(text: str, rules: dict[str, int]) -> tuple[int, list[str]]:
+    import re
+
+    score = 0
+    evidence = []
+    for pattern, weight in rules.items():
+        for match in re.finditer(pattern, text):
+            score += weight
+            evidence.append(match.group(0))
+    return score, evidence
+
+
+def _weigh_evidence(yes, yes_evidence, no, no_evidence, saturation=3):
+    """Turns yes/no evidence scores into a LocalClassification, or None if undecided.
+
+    Unanimous evidence of at least `saturation` gives a confidence close to 1.
+    Conflicting or weak evidence lowers it towards 0.5.
+    """
+    if yes == no:
+        return None
+    margin = abs(yes - no) / (yes + no)
+    strength = min(1.0, (yes + no) / saturation)
+    confidence = min(0.99, 0.5 + 0.5 * margin * strength)
+    if yes > no:
+        return LocalClassification(True, confidence, yes_evidence)
+    return LocalClassification(False, confidence, no_evidence)
+
+
+def _activity_fields(activity) -> dict[str, str]:
+    if not isinstance(activity, dict):
+        return {"location": "", "category": "", "text": str(activity).lower()}
+    return {
+        "location": str(activity.get("location") or "").lower(),
+        "category": str(activity.get("category") or "").lower(),
+        "text": f"{activity.get('name', '')} {activity.get('description', '')}".lower(),
+    }
+
+
+def classify_is_outdoors(activity) -> LocalClassification | None:
+    """Predicts whether an activity takes place outdoors.
+
+    Examples:
+        >>> classify_is_outdoors({"name": "Reading", "location": "Public Library"}).answer
+        False
+        >>> classify_is_outdoors({"name": "Walk", "location": "Beach Boardwalk"}).answer
+        True
+    """
+    fields = _activity_fields(activity)
+    outdoor, outdoor_evidence = _score_rules(fields["location"], _OUTDOOR_LOCATION_RULES)
+    indoor, indoor_evidence = _score_rules(fields["location"], _INDOOR_LOCATION_RULES)
+    score, evidence = _score_rules(fields["text"], _OUTDOOR_DESCRIPTION_RULES)
+    outdoor, outdoor_evidence = outdoor + score, outdoor_evidence + evidence
+    score, evidence = _score_rules(fields["text"], _INDOOR_DESCRIPTION_RULES)
+    indoor, indoor_evidence = indoor + score, indoor_evidence + evidence
+    return _weigh_evidence(outdoor, outdoor_evidence, indoor, indoor_evidence)
+
+
+def classify_involves_eating_or_drinking(activity) -> LocalClassification | None:
+    """Predicts whether an activity involves eating or drinking.
+
+    Only food is evidence: an activity that mentions none of the known food
+    words may still involve food described in other words, so it is left to
+    the LLM (None).
+
+    Examples:
+        >>> classify_involves_eating_or_drinking(
+        ...     {"category": "Culinary", "description": "Italian cooking class"}
+        ... ).answer
+        True
+        >>> classify_involves_eating_or_drinking(
+        ...     {"category": "Literature", "description": "Readings by local poets."}
+        ... ) is None
+        True
+    """
+    fields = _activity_fields(activity)
+    food, evidence = _score_rules(fields["category"], _FOOD_CATEGORY_RULES)
+    score, description_evidence = _score_rules(fields["text"], _FOOD_DESCRIPTION_RULES)
+    food += score
+    evidence += description_evidence
+    if not food:
+        return None
+    return LocalClassification(True, min(0.99, 0.5 + food / 8), evidence)
+
+
+def classify_prevents_outdoor_activities(weather) -> LocalClassification | None:
+    """Predicts whether a weather condition prevents outdoor activities.
+
+    Accepts a weather string, such as the "weather" of an itinerary day, or a
+    `WEATHER_FORECAST` entry, whose "condition" field is used.
+
+    Examples:
+        >>> classify_prevents_outdoor_activities("thunderstorm").answer
+        True
+        >>> classify_prevents_outdoor_activities("Sunny, no chance of rain").answer
+        False
+    """
+    import re
+
+    if isinstance(weather, dict):
+        weather = weather.get("condition") or weather.get("description") or ""
+    text = re.sub(_NEGATION_PATTERN, " ", str(weather).lower())
+    bad, bad_evidence = _score_rules(text, _BAD_WEATHER_RULES)
+    good, good_evidence = _score_rules(text, _GOOD_WEATHER_RULES)
+    return _weigh_evidence(bad, bad_evidence, good, good_evidence)
+
+
+def classify_avoid_in_weather(activity, weather) -> LocalClassification | None:
+    """Predicts whether an activity should be avoided in the given weather.
+
+    Only outdoor activities in weather that prevents outdoor activities should
+    be avoided, so a confident "indoors" or "fine weather" is enough to say no.
+
+    Examples:
+        >>> classify_avoid_in_weather({"location": "City Museum"}, "thunderstorm").answer
+        False
+        >>> classify_avoid_in_weather({"location": "Central Park"}, "thunderstorm").answer
+        True
+    """
+    outdoors = classify_is_outdoors(activity)
+    prevents = classify_prevents_outdoor_activities(weather)
+    reasons = [c for c in (outdoors, prevents) if c is not None and not c.answer]
+    if reasons:
+        best = max(reasons, key=lambda c: c.confidence)
+        return LocalClassification(False, best.confidence, best.evidence)
+    if outdoors is None or prevents is None:
+        return None
+    return LocalClassification(
+        True,
+        min(outdoors.confidence, prevents.confidence),
+        outdoors.evidence + prevents.evidence,
+    )
+
+
+LOCAL_CLASSIFIERS = {
+    "is_outdoors": lambda inputs: classify_is_outdoors(inputs["activity"]),
+    "involves_eating_or_drinking": lambda inputs: classify_involves_eating_or_drinking(
+        inputs["activity"]
+    ),
+    "prevents_outdoor_activities": lambda inputs: classify_prevents_outdoor_activities(
+        inputs["weather"]
+    ),
+    "avoid_in_weather": lambda inputs: classify_avoid_in_weather(
+        inputs["activity"], inputs["weather"]
+    ),
+}
+
+
+class PreClassifier:
+    """A fast, rule-based tier in front of LLM yes/no judgments.
+
+    Judgment units whose kind has a local classifier (see `LOCAL_CLASSIFIERS`)
+    are answered locally when the classifier is at least `min_confidence`
+    sure. The others are escalated to the LLM.
+
+    Every escalated unit that the classifier had an opinion on is compared
+    with the LLM's answer. Units below the threshold are escalated anyway.
+    With `audit_rate`, a deterministic sample of the confident units is also
+    escalated, so the agreement of confident answers can be measured too. See
+    `agreement_report`: with an audit_rate of 0, it only covers the escalated,
+    less confident units, and says nothing about the local answers.
+
+    Args:
+        min_confidence: The confidence needed to answer locally. Use a value
+            above 1 to escalate everything.
+        audit_rate: The share of confident units also sent to the LLM, 5% by default.
+
+    Examples:
+        >>> classifier = PreClassifier(min_confidence=0.9)
+        >>> units = [
+        ...     JudgmentUnit("prevents_outdoor_activities", {"weather": "rainy"}, "Rain?"),
+        ...     JudgmentUnit("prevents_outdoor_activities", {"weather": "cloudy"}, "Clouds?"),
+        ... ]
+        >>> answers, escalated = classifier.triage(units)
+        >>> answers, escalated
+        ([True, None], [1])
+        >>> classifier.observe([units[i] for i in escalated], [False])
+        >>> classifier.agreement_report()["prevents_outdoor_activities"]["agreement_rate"]
+        1.0
+        >>> classifier._predictions  # predictions are only kept until observed
+        {}
+    """
+
+    CONFIDENCE_BUCKETS = (0.5, 0.6, 0.7, 0.8, 0.9, 0.95)
+
+    def __init__(self, min_confidence: float = 0.9, audit_rate: float = 0.05):
+        self.min_confidence = min_confidence
+        self.audit_rate = audit_rate
+        self._lock = threading.Lock()
+        self._predictions: dict[str, LocalClassification] = {}
+        self._counts = {}
+
+    def _count(self, kind: str) -> dict:
+        return self._counts.setdefault(
+            kind,
+            {
+                "local": 0,
+                "escalated": 0,
+                "compared": 0,
+                "agreed": 0,
+                "buckets": {b: [0, 0] for b in self.CONFIDENCE_BUCKETS},
+            },
+        )
+
+    def _audited(self, unit: JudgmentUnit) -> bool:
+        # Sample by fingerprint so the same units are audited on every run
+        return int(unit.fingerprint[:8], 16) / 0xFFFFFFFF < self.audit_rate
+
+    def classify(self, unit: JudgmentUnit) -> LocalClassification | None:
+        """Returns the local classification of a unit, or None if it has no opinion."""
+        classifier = LOCAL_CLASSIFIERS.get(unit.kind)
+        if classifier is None:
+            return None
+        try:
+            return classifier(unit.inputs)
+        except (KeyError, TypeError):
+            return None
+
+    def triage(self, units: list[JudgmentUnit]) -> tuple[list, list[int]]:
+        """Answers the units it is confident about.
+
+        Returns:
+            A (answers, escalated) tuple. `answers` has the local answer of each
+            unit answered locally and None elsewhere, and `escalated` the indexes
+            of the units to send to the LLM.
+        """
+        answers = [None] * len(units)
+        escalated = []
+        with self._lock:
+            for idx, unit in enumerate(units):
+                if unit.kind not in LOCAL_CLASSIFIERS:
+                    escalated.append(idx)
+                    continue
+                prediction = self.classify(unit)
+                counts = self._count(unit.kind)
+                if prediction is not None:
+                    if prediction.confidence >= self.min_confidence and not self._audited(unit):
+                        answers[idx] = prediction.answer
+                        counts["local"] += 1
+                        continue
+                    # Kept until observe() compares it with the LLM's answer
+                    self._predictions[unit.fingerprint] = prediction
+                counts["escalated"] += 1
+                escalated.append(idx)
+        return answers, escalated
+
+    def observe(self, units: list[JudgmentUnit], llm_answers: list):
+        """Records the LLM answers of escalated units, for the agreement report."""
+        with self._lock:
+            for unit, llm_answer in zip(units, llm_answers):
+                prediction = self._predictions.pop(unit.fingerprint, None)
+                if prediction is None or llm_answer is None:
+                    continue
+                counts = self._count(unit.kind)
+                agreed = prediction.answer == llm_answer
+                counts["compared"] += 1
+                counts["agreed"] += agreed
+                bucket = max(
+                    b for b in self.CONFIDENCE_BUCKETS if b <= prediction.confidence
+                )
+                counts["buckets"][bucket][0] += 1
+                counts["buckets"][bucket][1] += agreed
+
+    def agreement_report(self) -> dict[str, dict]:
+        """Returns, per kind of question, how often the classifier agreed with the LLM.
+
+        Each entry has the number of units answered locally and escalated, the
+        overall agreement rate, and the agreement rate per confidence bucket
+        (keyed by the bucket's lower bound), to help choose `min_confidence`.
+        """
+        report = {}
+        with self._lock:
+            for kind, counts in self._counts.items():
+                report[kind] = {
+                    "answered_locally": counts["local"],
+                    "escalated": counts["escalated"],
+                    "compared": counts["compared"],
+                    "agreement_rate": (
+                        counts["agreed"] / counts["compared"] if counts["compared"] else None
+                    ),
+                    "agreement_by_confidence": {
+                        bucket: {"compared": n, "agreement_rate": agreed / n}
+                        for bucket, (n, agreed) in counts["buckets"].items()
+                        if n
+                    },
+                }
+        return report
+
+
+# Foods that conflict with a dietary restriction, keyed by a word of the restriction
+_MEAT = r"meat|beef|pork|bacon|ham|chicken|turkey|sausages?|steaks?|burgers?|cheeseburgers?|fish|seafood|shrimp|bbq|barbecue"
+_DAIRY = r"cheese|milk|cream|butter|yogh?urt|ice cream|dairy"
+_DIET_CONFLICT_RULES = {
+    "vegetarian": rf"\b({_MEAT})\b",
+    "vegan": rf"\b({_MEAT}|{_DAIRY}|eggs?|honey|tiramisu|brownies?)\b",
+    "gluten": r"\b(bread|pasta|pizza|beer|wheat|flour|pastry|pastries|cakes?|brownies?|cookies?|tacos)\b",
+    "nut": r"\b(nuts?|peanuts?|almonds?|walnuts?|pecans?|hazelnuts?|pistachios?|cashews?|praline)\b",
+    "dairy": rf"\b({_DAIRY})\b",
+    "lactose": rf"\b({_DAIRY})\b",
+}
+# Dishes explicitly labeled as suitable, e.g. "gluten-free pizza" or "vegan tacos", do not conflict
+_DIET_LABELED_DISH_PATTERN = r"\b(\w+[- ]free|vegan|vegetarian|plant[- ]based)\s+\w+"
+
+
+def keyword_interest_tagger(activities: list[dict], travelers: list[dict]) -> list[set[str]]:
+    """Tags activities with the names of the travelers whose interests they match.
+
+    An interest matches if it (or its singular form) appears in the activity's
+    name, category or description.
+
+    Args:
+        activities: Activities, as dictionaries.
+        travelers: Travelers, as in vacation_info["travelers"].
+
+    Returns:
+        One set of traveler names per activity.
+
+    Examples:
+        >>> keyword_interest_tagger(
+        ...     [{"name": "Tennis Clinic", "category": "Sports", "description": ""}],
+        ...     [{"name": "Yuri", "interests": ["tennis"]}, {"name": "Hiro", "interests": ["books"]}],
+        ... )
+        [{'Yuri'}]
+    """
+    import re
+
+    patterns = {
+        traveler["name"]: [
+            re.compile(rf"\b{re.escape(interest.lower().removesuffix('s'))}", re.IGNORECASE)
+            for interest in traveler.get("interests", [])
+            if interest.strip()
+        ]
+        for traveler in travelers
+    }
+    tags = []
+    for activity in activities:
+        text = f"{activity.get('name', '')} {activity.get('category', '')} {activity.get('description', '')}"
+        tags.append({name for name, regexes in patterns.items() if any(r.search(text) for r in regexes)})
+    return tags
+
+
+def is_weather_safe(activity: dict, weather) -> bool:
+    """Returns False if the local pre-classifier thinks the activity should be avoided in the weather.
+
+    When the classifier cannot tell whether the activity is outdoors, it is
+    avoided on days whose weather prevents outdoor activities.
+
+    Examples:
+        >>> is_weather_safe({"location": "Central Park"}, "thunderstorm")
+        False
+        >>> is_weather_safe({"location": "City Museum"}, "thunderstorm")
+        True
+    """
+    avoid = classify_avoid_in_weather(activity, weather)
+    if avoid is not None:
+        return not avoid.answer
+    prevents = classify_prevents_outdoor_activities(weather)
+    return not (prevents is not None and prevents.answer)
+
+
+def is_diet_safe(activity: dict, restrictions: list[str]) -> bool:
+    """Returns False if a food activity explicitly mentions a food that conflicts with a restriction.
+
+    Like the dietary eval, only foods mentioned in the activity count: dishes
+    labeled as suitable ("gluten-free pizza") are ignored, and activities that
+    do not involve food are always safe. Restrictions without known
+    conflicting foods (see `_DIET_CONFLICT_RULES`) never make an activity unsafe.
+
+    Examples:
+        >>> tasting = {"category": "Culinary", "description": "Taste vegan tacos and cheeseburgers."}
+        >>> is_diet_safe(tasting, ["gluten-free"]), is_diet_safe(tasting, ["vegetarian"])
+        (True, False)
+        >>> festival = {"category": "Festival", "description": "Live music, corn and ice cream (dairy-free options)."}
+        >>> is_diet_safe(festival, ["dairy"])
+        False
+    """
+    import re
+
+    if not restrictions:
+        return True
+    # Only a confident "no food" skips the scan. Without evidence either way, the
+    # classifier escalates (None), and the conflict scan below decides.
+    food = classify_involves_eating_or_drinking(activity)
+    if food is not None and not food.answer:
+        return True
+    text = f"{activity.get('name', '')} {activity.get('description', '')}".lower()
+    text = re.sub(_DIET_LABELED_DISH_PATTERN, " ", text)
+    for restriction in restrictions:
+        for key, rule in _DIET_CONFLICT_RULES.items():
+            if key in restriction.lower() and re.search(rule, text):
+                return False
+    return True
+
+
+def _activity_from_record(record: EventRecord, activity_hours: float) -> dict:
+    return {
+        "name": record.name,
+        "description": record.description,
+        "time": record.time[11:],
+        "duration": f"{activity_hours:g} hours",
+        "price": record.price_amount,
+        "category": record.category,
+        "location": record.location,
+    }
+
+
+def solve_itinerary(
+    vacation_info: dict,
+    max_activities_per_day: int = 3,
+    beam_width: int = 16,
+    candidates_per_day: int = 12,
+    activity_hours: float = 2.0,
+    interest_tagger=None,
+) -> dict | None:
+    """Plans an itinerary locally, with a beam search over the event calendar.
+
+    Each day, the events that are unsafe in the day's weather (see
+    `is_weather_safe`) or for any traveler's diet (see `is_diet_safe`) are
+    dropped, and the remaining events are tagged with the travelers whose
+    interests they match. The search then picks up to max_activities_per_day
+    non-overlapping events per day, keeping the beam_width best partial plans
+    after each day. Plans are ranked by, in order: the fewest interest matches
+    of any traveler, whether no traveler has more than twice that number, the
+    total number of matches, the number of activities and the lowest cost. The total cost,
+    times the number of travelers (prices are per person), stays within the
+    budget.
+
+    Args:
+        vacation_info: The vacation info, as gathered by the onboarding agent.
+        max_activities_per_day: The maximum number of activities per day.
+        beam_width: The number of partial plans kept after each day.
+        candidates_per_day: The number of best-matching events considered each day.
+        activity_hours: The assumed duration of each activity, used to avoid overlaps.
+        interest_tagger: A function (activities, travelers) -> list of sets of
+            traveler names, e.g. backed by LLM judgments. Defaults to
+            `keyword_interest_tagger`.
+
+    Returns:
+        An itinerary in the shape of the TravelPlan model, or None if the
+        destination has no events.
+
+    Examples:
+        >>> plan = solve_itinerary({
+        ...     "travelers": [
+        ...         {"name": "Yuri", "interests": ["tennis", "cooking"], "dietary_restrictions": ["nut allergies"]},
+        ...         {"name": "Hiro", "interests": ["reading", "music"], "dietary_restrictions": ["vegetarian"]},
+        ...     ],
+        ...     "destination": "AgentsVille",
+        ...     "date_of_arrival": "2025-06-10",
+        ...     "date_of_departure": "2025-06-11",
+        ...     "budget": 130,
+        ... })
+        >>> for day in plan["itinerary"]:
+        ...     print(day["date"], day["weather"], [a["name"] for a in day["activities"]])
+        2025-06-10 clear ['AgentsVille Summer Jam', 'Cinematic Under the Stars', 'Under the Stars: Poetry Night']
+        2025-06-11 partly cloudy ['Laughter Fest 2025', 'AgentsVille Cooking Class: Italian Night']
+        >>> plan["total_cost"]
+        50
+    """
+    import datetime
+    import itertools
+
+    city = vacation_info["destination"]
+    store = get_event_store()
+    if not store.has_city(city):
+        return None
+    interest_tagger = interest_tagger or keyword_interest_tagger
+    travelers = vacation_info["travelers"]
+    names = [traveler["name"] for traveler in travelers]
+    restrictions = [r for traveler in travelers for r in traveler.get("dietary_restrictions", [])]
+    # Prices are per person, the budget is for the whole group
+    max_cost = float(vacation_info.get("budget") or 0) / max(1, len(travelers))
+
+    dates = trip_dates(vacation_info)
+    weathers = [(get_weather_store().get(city, date) or {}).get("condition", "unknown") for date in dates]
+
+    # Candidate events per day, with their start times and the travelers they match
+    day_candidates = []
+    for date, weather in zip(dates, weathers):
+        candidates = []
+        for record in store.by_date(city, date, as_records=True):
+            activity = _activity_from_record(record, activity_hours)
+            if is_weather_safe(activity, weather) and is_diet_safe(activity, restrictions):
+                candidates.append((record.start, activity))
+        tags = interest_tagger([activity for _, activity in candidates], travelers) if candidates else []
+        ranked = sorted(
+            zip(candidates, tags),
+            key=lambda item: (-len(item[1]), item[0][1]["price"], item[0][0]),
+        )[:candidates_per_day]
+        day_candidates.append(
+            sorted(
+                ((start, activity, frozenset(tag)) for (start, activity), tag in ranked),
+                key=lambda candidate: candidate[0],
+            )
+        )
+
+    # The non-overlapping selections of up to max_activities_per_day events of each day
+    gap = datetime.timedelta(hours=activity_hours)
+    day_options = []
+    for candidates in day_candidates:
+        options = [()]
+        for size in range(1, max_activities_per_day + 1):
+            for combo in itertools.combinations(candidates, size):
+                if all(b[0] - a[0] >= gap for a, b in zip(combo, combo[1:])):
+                    options.append(combo)
+        day_options.append(options)
+
+    # Travelers that no event matches cannot be balanced against the others
+    matchable = [name for name in names if any(name in c[2] for day in day_candidates for c in day)]
+
+    def rank(state):
+        _, cost, hits = state
+        counts = [hits[name] for name in matchable]
+        lowest = min(counts, default=0)
+        # Aim for at least one match each, with nobody above twice the lowest count
+        balanced = max(counts, default=0) <= 2 * max(lowest, 1)
+        activities = sum(len(option) for option in state[0])
+        return (lowest, balanced, sum(counts), activities, -cost)
+
+    beam = [((), 0, dict.fromkeys(names, 0))]
+    for options in day_options:
+        expanded = []
+        for chosen, cost, hits in beam:
+            for option in options:
+                option_cost = cost + sum(activity["price"] for _, activity, _ in option)
+                if option_cost > max_cost:
+                    continue
+                option_hits = dict(hits)
+                for _, _, tag in option:
+                    for name in tag:
+                        option_hits[name] += 1
+                expanded.append((chosen + (option,), option_cost, option_hits))
+        # Ties are broken by the event names, so the search is deterministic
+        expanded.sort(key=lambda s: [a["name"] for day in s[0] for _, a, _ in day])
+        expanded.sort(key=rank, reverse=True)
+        beam = expanded[:beam_width]
+
+    chosen, cost, _ = beam[0]
+    return {
+        "city": city,
+        "start_date": vacation_info["date_of_arrival"],
+        "end_date": vacation_info["date_of_departure"],
+        "itinerary": [
+            {"date": date, "weather": weather, "activities": [activity for _, activity, _ in option]}
+            for date, weather, option in zip(dates, weathers, chosen)
+        ],
+        "total_cost": cost,
+    }
+
+
+@contextlib.contextmanager
+def isolated_llm_environment(backend: LLMBackend):
+    """Runs LLM requests on `backend` only, isolated from the process-wide settings.
+
+    For the duration, `backend` is the default backend (under a unique name),
+    the response cache is disabled, traces go to a NullTraceSink and requests
+    go through an unthrottled scheduler, so the caller's rate limits do not
+    skew timings. Everything is restored afterwards. The previous objects are
+    swapped back rather than replaced through the setters, which would close
+    them.
+
+    Examples:
+        >>> offline = CallableBackend(lambda messages, model, **kwargs: "offline")
+        >>> with isolated_llm_environment(offline):
+        ...     do_chat_completion([{"role": "user", "content": "?"}])
+        'offline'
+    """
+    import uuid
+
+    global _DEFAULT_LLM_BACKEND, _RESPONSE_CACHE, _TRACE_SINK
+
+    name = f"isolated-{uuid.uuid4().hex}"
+    scheduler = LLMScheduler(get_llm_scheduler().max_concurrency, max_retries=0)
+    with _LLM_REGISTRY_LOCK:
+        previous_entry = _LLM_BACKENDS.get(name)
+        previous = _DEFAULT_LLM_BACKEND, _RESPONSE_CACHE, _TRACE_SINK
+        _LLM_BACKENDS[name] = backend
+        _DEFAULT_LLM_BACKEND, _RESPONSE_CACHE, _TRACE_SINK = name, None, NullTraceSink()
+    previous_scheduler = _install_llm_scheduler(scheduler)
+    try:
+        yield backend
+    finally:
+        _install_llm_scheduler(previous_scheduler)
+        with _LLM_REGISTRY_LOCK:
+            if previous_entry is None:
+                _LLM_BACKENDS.pop(name, None)
+            else:
+                _LLM_BACKENDS[name] = previous_entry
+            _DEFAULT_LLM_BACKEND, _RESPONSE_CACHE, _TRACE_SINK = previous
+
+
+def _read_batch_output(path: str) -> dict:
+    """Reads the records already written to a batch output file, keyed by request id.
+
+    A partly written last line (e.g. after a crash) is ignored.
+    """
+    import json
+    import os
+
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[record["id"]] = record
+    return done
+
+
+def _ends_with_newline(path: str) -> bool:
+    with open(path, "rb") as f:
+        f.seek(-1, 2)
+        return f.read(1) == b"\n"
+
+
+def _write_batch_record(out, record: dict, counts: dict):
+    import json
+
+    # A line is written (and flushed) in one go, so a crash leaves at most one partial line
+    out.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    out.flush()
+    counts["succeeded" if record["status"] == "ok" else "failed"] += 1
+
+
+def run_batch_planning(
+    input_path: str,
+    output_path: str,
+    plan_trip,
+    max_workers: int = 8,
+    max_concurrency: int | None = None,
+    retry_failed: bool = True,
+    quiet: bool = False,
+) -> dict:
+    """Plans many trips concurrently, streaming the results to a JSON Lines file.
+
+    Each line of the input file is a vacation request: a vacation info dict,
+    optionally with an "id" (the line number is used otherwise). Requests are
+    planned by plan_trip(vacation_info) -> JSON-serializable result on a pool
+    of max_workers threads, which share the response cache, the calendar
+    stores and the global LLM concurrency limit (see `set_llm_concurrency`).
+
+    Every finished request is appended to the output file right away, as
+    {"id", "status": "ok", "result", "seconds"} or {"id", "status": "error",
+    "error", "seconds"}. Requests already in the output file are skipped, so
+    an interrupted batch resumes where it stopped; failed requests are retried
+    unless retry_failed is False.
+
+    Args:
+        input_path: The JSON Lines file of vacation requests.
+        output_path: The JSON Lines file to append the results to.
+        plan_trip: The function planning one trip.
+        max_workers: The number of trips planned concurrently.
+        max_concurrency: If given, the limit of LLM requests in flight during the batch.
+        retry_failed: Whether to plan again the requests that failed in a previous run.
+        quiet: Whether to skip printing the summary.
+
+    Returns:
+        A summary with the request counts, the wall time and the throughput in
+        trips per minute.
+
+    Examples:
+        >>> import json, os, tempfile
+        >>> folder = tempfile.mkdtemp()
+        >>> requests_path = os.path.join(folder, "requests.jsonl")
+        >>> write_jsonl(requests_path, [{"id": "a", "destination": "AgentsVille"}, {"destination": "Nowhere"}])
+        >>> def plan(vacation_info):
+        ...     if not get_event_store().has_city(vacation_info["destination"]):
+        ...         raise ValueError("Unknown city")
+        ...     return {"city": vacation_info["destination"]}
+        >>> summary = run_batch_planning(requests_path, os.path.join(folder, "out.jsonl"), plan, quiet=True)
+        >>> summary["succeeded"], summary["failed"], summary["skipped"]
+        (1, 1, 0)
+        >>> summary = run_batch_planning(requests_path, os.path.join(folder, "out.jsonl"), plan,
+        ...                              retry_failed=False, quiet=True)
+        >>> summary["planned"], summary["skipped"]
+        (0, 2)
+    """
+    import json
+    import time
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
+    done = _read_batch_output(output_path)
+    finished = {
+        request_id
+        for request_id, record in done.items()
+        if record["status"] == "ok" or not retry_failed
+    }
+    counts = {"succeeded": 0, "failed": 0, "skipped": 0}
+
+    def requests():
+        with open(input_path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                vacation_info = json.loads(line)
+                request_id = vacation_info.pop("id", line_number)
+                if request_id in finished:
+                    counts["skipped"] += 1
+                else:
+                    yield request_id, vacation_info
+
+    def plan(request_id, vacation_info):
+        start = time.perf_counter()
+        with span("batch_trip", trip_id=str(request_id)):
+            try:
+                record = {"id": request_id, "status": "ok", "result": plan_trip(vacation_info)}
+            except Exception as e:
+                record = {"id": request_id, "status": "error", "error": f"{type(e).__name__}: {e}"}
+        record["seconds"] = round(time.perf_counter() - start, 3)
+        return record
+
+    # The previous scheduler is restored afterwards, so the limit only applies to this batch
+    previous_scheduler = None
+    if max_concurrency is not None:
+        previous_scheduler = get_llm_scheduler()
+        set_llm_concurrency(max_concurrency)
+
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers)
+    pending = set()
+
+    def write_done(out):
+        for future in [future for future in pending if future.done() and not future.cancelled()]:
+            pending.discard(future)
+            _write_batch_record(out, future.result(), counts)
+
+    try:
+        with open(output_path, "a", encoding="utf-8") as out:
+            if out.tell() and not _ends_with_newline(output_path):
+                out.write("\n")  # terminate the partial line of an interrupted run
+            try:
+                # Only a bounded window of requests is in flight, so huge input files
+                # are read lazily; each trip is written as soon as it is done
+                for request_id, vacation_info in requests():
+                    write_done(out)
+                    if len(pending) >= 2 * max_workers:
+                        wait(pending, return_when=FIRST_COMPLETED)
+                        write_done(out)
+                    context = contextvars.copy_context()
+                    pending.add(executor.submit(context.run, plan, request_id, vacation_info))
+                for future in as_completed(list(pending)):
+                    pending.discard(future)
+                    _write_batch_record(out, future.result(), counts)
+            except BaseException:
+                # Keep the trips already planned, or planned while the running ones
+                # finish, so that the next run does not plan them again
+                write_done(out)
+                executor.shutdown(cancel_futures=True)
+                write_done(out)
+                raise
+    finally:
+        executor.shutdown()
+        if previous_scheduler is not None:
+            _install_llm_scheduler(previous_scheduler)
+    elapsed = time.perf_counter() - start
+
+    planned = counts["succeeded"] + counts["failed"]
+    summary = {
+        "planned": planned,
+        "succeeded": counts["succeeded"],
+        "failed": counts["failed"],
+        "skipped": counts["skipped"],
+        "seconds": round(elapsed, 3),
+        "trips_per_minute": round(planned / elapsed * 60, 2) if elapsed else 0.0,
+    }
+    if not quiet:
+        print_in_box(json.dumps(summary, indent=2), title="Batch planning")
+    return summary